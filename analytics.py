@@ -0,0 +1,168 @@
+"""
+Upvote statistics per sub over the posts table, to help pick `threshold_upvotes`.
+
+The `highest_ups` of every post created in a window are loaded once into columnar NumPy
+arrays and sorted by (sub, upvotes). Every statistic is then a handful of
+vectorized operations over the whole table rather than a loop over memes:
+
+- percentiles are read at computed offsets into each sub's sorted run
+- the number of posts above a threshold is a `searchsorted` on a combined (sub, upvotes) key
+- a threshold giving a sub n memes is the upvotes at offset n from the end of its run
+
+Posts count as postable when their upvotes are above the threshold, as when posting.
+"""
+import time
+
+import utils
+
+
+PERCENTILES = (50, 75, 90, 99)
+WINDOW_DAYS = 14
+# the bot posts between 9:00 and midnight, see AutoMemer.post_to_slack_repeatedly
+POSTING_MINUTES_PER_DAY = 15 * 60
+
+
+class PostStats:
+    """
+    Columnar upvotes of the posts created in the last `days`, sorted by sub then upvotes
+    :param subs: an array of the (lowercased) sub names
+    :param sub_index: an array with the index into subs of every post
+    :param ups: an array with the highest upvotes of every post
+    """
+
+    def __init__(self, subs, sub_index, ups, days):
+        import numpy as np
+
+        self.days = days
+        self.subs = subs
+        order = np.lexsort((ups, sub_index))
+        self.sub_index = sub_index[order]
+        self.ups = ups[order]
+        # the run of each sub in the sorted arrays is [starts[i], ends[i])
+        counts = np.bincount(self.sub_index, minlength=len(subs))
+        self.ends = np.cumsum(counts)
+        self.starts = self.ends - counts
+        # upvotes are non negative, so (sub, upvotes) sorts the same as this key
+        self._scale = int(self.ups.max()) + 2 if len(self.ups) else 1
+        self._keys = self.sub_index * self._scale + self.ups
+
+    @classmethod
+    def load(cls, db, days=WINDOW_DAYS, now=None):
+        """Loads the sfw posts created in the last `days` from db, a storage.Storage object"""
+        import numpy as np
+
+        now = time.time() if now is None else now
+        since = time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(now - days * 24 * 3600))
+        # upvote counts repeat a lot, so the database sends (sub, upvotes, number of posts)
+        # and the columns are expanded from that
+        rows = db.get_ups_histogram(since)
+        subs = np.array([(row['sub'] or '').lower() for row in rows], dtype=str)
+        ups = np.array([row['highest_ups'] or 0 for row in rows], dtype=np.int64)
+        repeats = np.array([row['posts'] for row in rows], dtype=np.int64)
+        names, sub_index = np.unique(subs, return_inverse=True)
+        return cls(names, np.repeat(sub_index.astype(np.int64), repeats), np.repeat(ups, repeats), days)
+
+    def counts(self):
+        """Returns an array with the number of posts of every sub"""
+        return self.ends - self.starts
+
+    def percentiles(self, percentiles=PERCENTILES):
+        """Returns a (subs x percentiles) array of upvote percentiles, -1 for subs without posts"""
+        import numpy as np
+
+        counts = self.counts()
+        fractions = np.asarray(percentiles, dtype=np.float64) / 100
+        offsets = self.starts[:, None] + np.floor(fractions[None, :] * (counts[:, None] - 1)).astype(np.int64)
+        values = self.ups[np.clip(offsets, 0, max(len(self.ups) - 1, 0))] if len(self.ups) else \
+            np.zeros(offsets.shape, dtype=np.int64)
+        return np.where(counts[:, None] > 0, values, -1)
+
+    def postable(self, thresholds):
+        """Returns an array with the number of posts of every sub with more upvotes than its threshold"""
+        import numpy as np
+
+        thresholds = np.clip(np.asarray(thresholds, dtype=np.int64), -1, self._scale - 2)
+        keys = np.arange(len(self.subs), dtype=np.int64) * self._scale + thresholds
+        return self.ends - np.searchsorted(self._keys, keys, side='right')
+
+    def per_day(self, thresholds):
+        """Returns an array with the projected number of postable memes per day of every sub"""
+        return self.postable(thresholds) / self.days
+
+    def suggest(self, per_day):
+        """
+        Returns an array with the threshold of every sub that would give it about per_day
+        (a number, or an array with one per sub) postable memes per day
+        """
+        import numpy as np
+
+        counts = self.counts()
+        wanted = np.clip(np.round(np.broadcast_to(per_day, counts.shape) * self.days).astype(np.int64), 1, None)
+        # the post at offset `wanted` from the end of the run is the last one left out
+        offsets = self.ends - wanted - 1
+        values = self.ups[np.clip(offsets, 0, max(len(self.ups) - 1, 0))] if len(self.ups) else \
+            np.zeros(counts.shape, dtype=np.int64)
+        return np.where(offsets >= self.starts, values, 0)
+
+    def thresholds_for(self, threshold_upvotes):
+        """Returns the array of thresholds of every sub under the threshold_upvotes setting"""
+        import numpy as np
+
+        return np.array(
+            [threshold_upvotes.get(sub, threshold_upvotes.get('global', 0)) for sub in self.subs],
+            dtype=np.int64,
+        )
+
+
+def posts_per_day(settings):
+    """
+    The number of memes to aim for a day, from the target_memes_per_day setting or else
+    one per post interval (the scrape_interval setting)
+    """
+    if 'target_memes_per_day' in settings:
+        return settings['target_memes_per_day']
+    return POSTING_MINUTES_PER_DAY / max(settings.get('scrape_interval', 60), 1)
+
+
+def format_stats(stats, settings, subs=None):
+    """Returns a slack formatted table of upvote percentiles and postable memes a day per sub"""
+    thresholds = stats.thresholds_for(settings.get('threshold_upvotes', {'global': 0}))
+    counts, percentiles, per_day = stats.counts(), stats.percentiles(), stats.per_day(thresholds)
+    header = f"{'sub':<20}{'posts':>8}" + ''.join(f'{"p" + str(p):>8}' for p in PERCENTILES) + \
+        f"{'thresh':>8}{'per day':>9}"
+    lines = [header]
+    for i, sub in enumerate(stats.subs):
+        if subs is not None and sub not in subs:
+            continue
+        lines.append(
+            f'{sub[:19]:<20}{counts[i]:>8,d}' + ''.join(f'{v:>8,d}' for v in percentiles[i]) +
+            f'{thresholds[i]:>8,d}{per_day[i]:>9.1f}'
+        )
+    return f'last {stats.days} days\n```\n' + '\n'.join(lines) + '\n```'
+
+
+def format_suggestions(stats, settings, subs, per_day=None):
+    """
+    Returns slack formatted threshold suggestions for subs, sharing per_day memes (by
+    default as many as the bot posts a day) equally between them
+    """
+    per_day = posts_per_day(settings) if per_day is None else per_day
+    subs = sorted(sub.lower() for sub in subs)
+    share = per_day / max(len(subs), 1)
+    index = {sub: i for i, sub in enumerate(stats.subs)}
+    current = stats.thresholds_for(settings.get('threshold_upvotes', {'global': 0}))
+    suggested = stats.suggest(share)
+    projected = stats.per_day(suggested)
+
+    lines = [f"{'sub':<20}{'current':>10}{'suggested':>11}{'per day':>9}"]
+    for sub in subs:
+        if sub not in index:
+            lines.append(f'{sub[:19]:<20}{"no posts in the window":>30}')
+            continue
+        i = index[sub]
+        lines.append(f'{sub[:19]:<20}{current[i]:>10,d}{suggested[i]:>11,d}{projected[i]:>9.1f}')
+    utils.log_usage(f'analytics - suggested thresholds for {len(subs)} subs, {per_day:.1f} memes a day')
+    return (
+        f'thresholds for about {per_day:.1f} memes a day ({share:.1f} per sub), from the last {stats.days} days\n'
+        '```\n' + '\n'.join(lines) + '\n```'
+    )
@@ -0,0 +1,233 @@
+"""
+Backfills the posts table from local dumps of Reddit submissions, e.g. archive files with
+one json submission per line (plain, .gz, .bz2, .xz, or .zst with zstandard installed).
+
+The dump is read in batches of lines that are parsed and mapped to posts rows in a pool
+of worker processes, while the main process inserts finished batches with one multi-row
+insert and one commit each. After every commit the position in the dump is written to a
+checkpoint file, so an interrupted backfill picks up where it stopped when rerun.
+
+    python3 backfill.py RS_2019-01.zst --sub me_irl --sub wholesomememes
+"""
+import argparse
+import bz2
+import calendar
+import collections
+import gzip
+import importlib.util
+import io
+import json
+import lzma
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import records
+import storage
+import utils
+
+
+CHECKPOINT_FILE = 'memes/backfill.json'
+BATCH_LINES = 20000
+# batches being parsed at a time, per worker
+BATCHES_PER_WORKER = 2
+# ids looked up per query when skipping existing posts, below sqlite's limit on parameters
+ID_LOOKUP_SIZE = 900
+
+
+def open_dump(path):
+    """Opens a (possibly compressed) dump for reading bytes, by its extension"""
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rb')
+    elif path.endswith('.bz2'):
+        return bz2.open(path, 'rb')
+    elif path.endswith('.xz'):
+        return lzma.open(path, 'rb')
+    elif path.endswith('.zst'):
+        if importlib.util.find_spec('zstandard') is None:
+            raise ValueError('reading .zst dumps needs zstandard, `pip install zstandard`')
+        import zstandard
+
+        # archive dumps are compressed with a long window
+        reader = zstandard.ZstdDecompressor(max_window_size=2 ** 31).stream_reader(open(path, 'rb'))
+        return io.BufferedReader(reader)
+    return open(path, 'rb')
+
+
+def skip_to(f, offset):
+    """Moves f to offset, reading up to it if the (decompressed) stream can't seek"""
+    try:
+        f.seek(offset)
+    except (OSError, io.UnsupportedOperation):
+        while offset > 0:
+            chunk = f.read(min(offset, 1024 * 1024))
+            if not chunk:
+                break
+            offset -= len(chunk)
+
+
+def read_batches(f, offset=0, batch_lines=BATCH_LINES):
+    """
+    Yields (lines, offset after the last line) for batches of lines of f
+    :param offset: the position f starts at
+    """
+    batch = []
+    for line in f:
+        batch.append(line)
+        offset += len(line)
+        if len(batch) >= batch_lines:
+            yield batch, offset
+            batch = []
+    if batch:
+        yield batch, offset
+
+
+def parse_lines(lines, subs=None, since=None, now=None):
+    """
+    Maps lines of a dump to posts rows. Runs in a worker process
+    :param subs: a set of lowercased sub names to keep, or None to keep every sub
+    :param since: only keep submissions created at or after this time, in seconds since the epoch
+    :return: a (list of tuples in the order of storage.POST_COLUMNS, number of lines skipped) tuple
+    """
+    rows, skipped = [], 0
+    for line in lines:
+        try:
+            data = json.loads(line)
+            if subs is not None and (data.get('subreddit') or '').lower() not in subs:
+                skipped += 1
+                continue
+            meme = records.Meme.from_archive(data, now)
+            if since is not None and meme.created_utc < since:
+                skipped += 1
+                continue
+        except (ValueError, KeyError, TypeError):
+            skipped += 1
+            continue
+        row = meme.to_row()
+        rows.append(tuple(row[column] for column in storage.POST_COLUMNS))
+    return rows, skipped
+
+
+class Checkpoints:
+    """How far into each dump a backfill has got, persisted as json"""
+
+    def __init__(self, path=CHECKPOINT_FILE):
+        self.path = path
+
+    def load(self):
+        try:
+            with open(self.path, 'r') as f:
+                return json.loads(f.read() or '{}')
+        except OSError:
+            return {}
+
+    def get(self, dump):
+        return self.load().get(os.path.abspath(dump), {'offset': 0, 'rows': 0, 'skipped': 0})
+
+    def set(self, dump, progress):
+        checkpoints = self.load()
+        checkpoints[os.path.abspath(dump)] = progress
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write(json.dumps(checkpoints, indent=2))
+        os.replace(tmp_path, self.path)
+
+
+def backfill(db, dump, subs=None, since=None, workers=None, batch_lines=BATCH_LINES,
+             checkpoints=None, skip_existing=True, print_output=False):
+    """
+    Inserts the submissions in dump into the posts table, resuming from its checkpoint
+    :param db: a storage.Storage object
+    :param subs: an iterable of sub names to import, defaults to every sub
+    :param since: only import submissions created at or after this time, in seconds since the epoch
+    :param skip_existing: whether to leave out posts whose id is already in the table
+    :return: the final progress, a dict with the offset reached and the rows inserted / skipped
+    """
+    checkpoints = checkpoints or Checkpoints()
+    progress = checkpoints.get(dump)
+    subs = {sub.lower() for sub in subs} if subs else None
+    now = time.time()
+    workers = workers or os.cpu_count() or 1
+    started = time.perf_counter()
+
+    with open_dump(dump) as f, ProcessPoolExecutor(max_workers=workers) as pool:
+        if progress['offset']:
+            skip_to(f, progress['offset'])
+        # parse ahead of the inserts, without reading the whole dump into memory
+        in_flight = collections.deque()
+        batches = read_batches(f, progress['offset'], batch_lines)
+        while True:
+            while len(in_flight) < workers * BATCHES_PER_WORKER:
+                batch = next(batches, None)
+                if batch is None:
+                    break
+                lines, offset = batch
+                in_flight.append((pool.submit(parse_lines, lines, subs, since, now), offset))
+            if not in_flight:
+                break
+
+            future, offset = in_flight.popleft()
+            rows, skipped = future.result()
+            # dumps can repeat a submission, keep its first line
+            seen, unique = set(), []
+            for row in rows:
+                if row[0] not in seen:
+                    seen.add(row[0])
+                    unique.append(row)
+            skipped += len(rows) - len(unique)
+            rows = unique
+            with db.transaction():
+                if skip_existing and rows:
+                    existing = set()
+                    for i in range(0, len(rows), ID_LOOKUP_SIZE):
+                        existing |= db.get_existing_ids([row[0] for row in rows[i:i + ID_LOOKUP_SIZE]])
+                    skipped += sum(1 for row in rows if row[0] in existing)
+                    rows = [row for row in rows if row[0] not in existing]
+                if rows:
+                    db.add_posts(rows)
+            progress = {
+                'offset': offset,
+                'rows': progress['rows'] + len(rows),
+                'skipped': progress['skipped'] + skipped,
+            }
+            checkpoints.set(dump, progress)
+            if print_output:
+                rate = progress['rows'] / max(time.perf_counter() - started, 1e-9)
+                print(f"\r{progress['rows']:,} rows, {progress['skipped']:,} skipped, {rate:,.0f} rows/s", end='')
+    if print_output:
+        print()
+    return progress
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('dumps', nargs='+', help='ndjson dumps of reddit submissions')
+    parser.add_argument('--sub', action='append', help='only import this subreddit, can be repeated')
+    parser.add_argument('--since', help='only import submissions created on or after this date, YYYY-MM-DD')
+    parser.add_argument('--workers', type=int, help='parsing processes, defaults to the number of cpus')
+    parser.add_argument('--batch', type=int, default=BATCH_LINES, help='lines per batch / insert')
+    parser.add_argument('--keep-duplicates', action='store_true', help="don't check for ids already in the table")
+    parser.add_argument('--restart', action='store_true', help='ignore checkpoints and start from the beginning')
+    parser.add_argument('--db', default='db.json', help='the database config file')
+    args = parser.parse_args()
+
+    # created_utc is in UTC, so is the date
+    since = calendar.timegm(time.strptime(args.since, '%Y-%m-%d')) if args.since else None
+    utils.init()
+    checkpoints = Checkpoints()
+    db = storage.load_storage(args.db)
+    try:
+        for dump in args.dumps:
+            if args.restart:
+                checkpoints.set(dump, {'offset': 0, 'rows': 0, 'skipped': 0})
+            print(f'importing {dump}')
+            backfill(
+                db, dump, subs=args.sub, since=since, workers=args.workers, batch_lines=args.batch,
+                checkpoints=checkpoints, skip_existing=not args.keep_duplicates, print_output=True,
+            )
+    finally:
+        db.close()
+
+
+if __name__ == '__main__':
+    main()
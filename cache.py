@@ -0,0 +1,106 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class _InFlight:
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+        # set when the key is invalidated mid computation, so the result isn't cached
+        self.stale = False
+
+
+class TTLCache:
+    """
+    A thread safe cache whose entries expire `ttl` seconds after being stored. Concurrent
+    `get_or_compute` calls for the same key share a single computation: the first caller
+    computes the value while the others wait for it.
+    """
+
+    def __init__(self, ttl, max_size=1024, now=time.monotonic):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.now = now
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()  # key -> (expires, value), oldest first
+        self._in_flight = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Returns the cached value for key, or None if there is no fresh one"""
+        with self._lock:
+            return self._get(key)
+
+    def _get(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expires, value = entry
+        if expires <= self.now():
+            del self._entries[key]
+            return None
+        return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._put(key, value)
+
+    def _put(self, key, value):
+        self._entries.pop(key, None)
+        self._entries[key] = (self.now() + self.ttl, value)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def get_or_compute(self, key, compute):
+        """
+        Returns the cached value for key, calling compute() to create it if needed. None
+        results (which the bot uses to signal errors) are returned but not cached
+        """
+        with self._lock:
+            value = self._get(key)
+            if value is not None:
+                self.hits += 1
+                return value
+            in_flight = self._in_flight.get(key)
+            owner = in_flight is None
+            if owner:
+                self.misses += 1
+                in_flight = self._in_flight[key] = _InFlight()
+            else:
+                self.hits += 1
+
+        if not owner:
+            in_flight.done.wait()
+            if in_flight.error is not None:
+                raise in_flight.error
+            return in_flight.value
+
+        try:
+            in_flight.value = compute()
+        except Exception as e:
+            in_flight.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._in_flight[key]
+                if in_flight.error is None and in_flight.value is not None and not in_flight.stale:
+                    self._put(key, in_flight.value)
+            in_flight.done.set()
+        return in_flight.value
+
+    def invalidate(self, key):
+        self.invalidate_many([key])
+
+    def invalidate_many(self, keys):
+        with self._lock:
+            for key in keys:
+                self._entries.pop(key, None)
+                if key in self._in_flight:
+                    self._in_flight[key].stale = True
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
@@ -0,0 +1,148 @@
+"""
+Circuit breakers around the bot's dependencies: Reddit, Slack and the database.
+
+While a dependency is down, every call to it would otherwise wait for its own timeout,
+and the threads making them (scrapes, command handlers) pile up behind each other and
+behind the lock. A breaker counts consecutive failures, and after `failure_threshold` of
+them it opens: calls fail straight away with CircuitOpen. Once `reset_timeout` seconds
+have passed it lets a single call through to probe the dependency (half open). If the
+probe succeeds the breaker closes, if it fails the breaker opens again for twice as long,
+up to `max_reset_timeout`, so a long outage is probed less and less often.
+
+Only the errors passed to `guard` count as failures. Anything else (e.g. a 404 from
+Reddit) means the dependency answered, and counts as a success.
+"""
+import threading
+import time
+from contextlib import contextmanager
+
+import utils
+
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half open'
+
+
+class CircuitOpen(Exception):
+    """Raised instead of calling a dependency whose breaker is open"""
+
+    def __init__(self, breaker):
+        self.breaker = breaker
+        super().__init__(f'{breaker.name} is unavailable, retrying in {breaker.retry_in():.0f}s')
+
+
+class CircuitBreaker:
+
+    def __init__(self, name, failure_threshold=5, reset_timeout=30, max_reset_timeout=600, now=time.monotonic):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.base_reset_timeout = reset_timeout
+        self.max_reset_timeout = max_reset_timeout
+        self.now = now
+        self.failures = 0
+        self.reset_timeout = reset_timeout
+        self._opened = None  # when the breaker last opened, None while closed
+        self._probing = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        with self._lock:
+            return self._state()
+
+    def _state(self):
+        if self._opened is None:
+            return CLOSED
+        if self._probing or self.now() - self._opened >= self.reset_timeout:
+            return HALF_OPEN
+        return OPEN
+
+    def available(self):
+        """Whether a call would be let through right now, without letting one through"""
+        with self._lock:
+            state = self._state()
+            return state == CLOSED or (state == HALF_OPEN and not self._probing)
+
+    def retry_in(self):
+        """Seconds until the next probe, 0 unless the breaker is open"""
+        with self._lock:
+            if self._opened is None:
+                return 0
+            return max(self._opened + self.reset_timeout - self.now(), 0)
+
+    def allow(self):
+        """
+        Returns whether a call may go ahead. In the half open state only the first caller
+        is let through, as a probe, until it reports back
+        """
+        with self._lock:
+            state = self._state()
+            if state == CLOSED:
+                return True
+            if state == HALF_OPEN and not self._probing:
+                self._probing = True
+                return True
+            return False
+
+    def succeeded(self):
+        with self._lock:
+            if self._opened is not None:
+                self._opened = None
+                self._probing = False
+                self.reset_timeout = self.base_reset_timeout
+            self.failures = 0
+
+    def failed(self):
+        opened = False
+        with self._lock:
+            self.failures += 1
+            if self._probing:
+                # the probe failed, wait longer before the next one
+                self._probing = False
+                self.reset_timeout = min(self.reset_timeout * 2, self.max_reset_timeout)
+                self._opened = self.now()
+            elif self._opened is None and self.failures >= self.failure_threshold:
+                self._opened = self.now()
+                opened = True
+        if opened:
+            utils.log_usage(f'circuit - {self.name} opened after {self.failures} failures')
+
+    @contextmanager
+    def guard(self, errors=(Exception,), unavailable=None):
+        """
+        Runs the enclosed call to the dependency, raising CircuitOpen instead if the breaker
+        is open. Yields whether the call is a half open probe
+        :param errors: the exception types that mean the dependency is unavailable
+        :param unavailable: a function telling whether an exception of one of those types
+        means it, for types that also cover the caller's own mistakes. By default they all do
+        """
+        if not self.allow():
+            raise CircuitOpen(self)
+        # while a probe is out every other caller is turned away, so this is the probe
+        probe = self._probing
+        try:
+            yield probe
+        except errors as e:
+            if unavailable is None or unavailable(e):
+                self.failed()
+            else:
+                self.succeeded()
+            raise
+        except BaseException:
+            self.succeeded()
+            raise
+        else:
+            self.succeeded()
+
+    def describe(self):
+        state = self.state
+        if state == OPEN:
+            return f'{self.name}: {state}, retrying in {self.retry_in():.0f}s'
+        return f'{self.name}: {state}'
+
+
+# shared by everything that calls them
+reddit = CircuitBreaker('reddit')
+slack = CircuitBreaker('slack')
+database = CircuitBreaker('the database')
@@ -0,0 +1,10 @@
+"""Shared pytest fixtures. Being at the top of the repo, it also puts the modules on the import path"""
+import pytest
+
+
+@pytest.fixture(autouse=True)
+def memes_dir(tmp_path, monkeypatch):
+    """Runs every test in an empty directory with a memes/ directory, where the logs go"""
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / 'memes').mkdir()
+    return tmp_path / 'memes'
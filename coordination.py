@@ -0,0 +1,126 @@
+"""
+Lets several replicas of the bot run against the same database, for failover.
+
+Every replica keeps a heartbeat row in `replicas` and tries to take the `leader` lease
+in `leases` every HEARTBEAT_SECONDS. The replica holding the lease is the leader: it
+posts memes and answers commands, while the others only keep their slack connection
+open. The leader renews the lease with every heartbeat, so if it dies a standby takes
+over within LEASE_SECONDS and a heartbeat, and a leader that is stopped gracefully
+releases the lease so a standby takes over at its next heartbeat.
+
+A leader that can't renew its lease (e.g. it lost the database) steps down on its own
+once the lease would have expired, so there is never more than one leader as long as
+the replicas' clocks agree to within a few seconds.
+
+Scraping can also be split between all live replicas (`shard_scrapes`): each sub is
+assigned to one of them by a hash of its name. Scraped memes are added to the pending
+stores on disk, so the replicas must share the `memes/` directory for the leader to
+post them, on one host: writes to the stores are serialized with flock (see
+records.PendingStore.lock), which doesn't work reliably across hosts.
+"""
+import os
+import socket
+import zlib
+from threading import Event
+from threading import Thread
+
+import utils
+
+
+LEASE_NAME = 'leader'
+# how long a lease lasts without being renewed, and how often it is renewed
+LEASE_SECONDS = 15
+HEARTBEAT_SECONDS = 5
+# a replica without a heartbeat for this long is left out of the scrape shards
+REPLICA_TIMEOUT_SECONDS = 3 * HEARTBEAT_SECONDS
+
+
+def default_replica_id():
+    return f'{socket.gethostname()}-{os.getpid()}'
+
+
+class Coordinator:
+    """Elects a leader among the replicas sharing a database, and assigns subs to live replicas"""
+
+    def __init__(self, db, replica_id=None, shard_scrapes=False, lease_name=LEASE_NAME,
+                 lease_seconds=LEASE_SECONDS, heartbeat_seconds=HEARTBEAT_SECONDS, clock=None):
+        """
+        :param db: a storage.Storage object, or a function returning one. It should be a
+        connection of its own, so heartbeats never wait for the bot's lock
+        :param replica_id: a name unique to this replica, defaults to <hostname>-<pid>
+        :param shard_scrapes: whether subs are split between the live replicas, or all scraped by the leader
+        """
+        self.replica_id = replica_id or default_replica_id()
+        self.shard_scrapes = shard_scrapes
+        self.lease_name = lease_name
+        self.lease_seconds = lease_seconds
+        self.heartbeat_seconds = heartbeat_seconds
+        self.clock = clock or utils.Clock()
+        self.stopping = Event()
+        self._db = utils.Deferred(db if callable(db) else lambda: db, name='coordination-db')
+        self._lease_until = 0  # when our lease runs out, if we hold it
+        self._replicas = [self.replica_id]
+        self._thread = None
+
+    def is_leader(self):
+        return self.clock.now() < self._lease_until
+
+    def beat(self):
+        """Records a heartbeat, takes or renews the lease if possible and refreshes the live replicas"""
+        now = self.clock.now()
+        was_leader = self.is_leader()
+        try:
+            db = self._db.get()
+            db.heartbeat(self.replica_id, now)
+            if db.acquire_lease(self.lease_name, self.replica_id, now, self.lease_seconds):
+                # stop leading a heartbeat before the lease expires and another replica can take it
+                self._lease_until = now + self.lease_seconds - self.heartbeat_seconds
+            else:
+                self._lease_until = 0
+            self._replicas = db.get_live_replicas(now - REPLICA_TIMEOUT_SECONDS) or [self.replica_id]
+        except Exception as e:
+            # the lease still runs out at _lease_until, when is_leader turns false
+            utils.log_error(e)
+        if self.is_leader() != was_leader:
+            utils.log_usage(
+                f"coordination - {self.replica_id} is {'now' if self.is_leader() else 'no longer'} the leader"
+            )
+
+    def run(self):
+        """Beats every heartbeat_seconds until stopped, then steps down"""
+        while not self.stopping.is_set():
+            self.beat()
+            self.clock.wait(self.stopping, self.heartbeat_seconds)
+        self.release()
+
+    def start(self):
+        """Runs the heartbeats in a daemon thread, returns self"""
+        self._thread = Thread(target=self.run, name='coordination')
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """Stops the heartbeats, waiting for the lease to be released if they run in a thread"""
+        self.stopping.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def release(self):
+        """Gives up the lease and removes this replica, so the others take over straight away"""
+        self._lease_until = 0
+        try:
+            db = self._db.get()
+            db.release_lease(self.lease_name, self.replica_id)
+            db.remove_replica(self.replica_id)
+        except Exception as e:
+            utils.log_error(e)
+
+    def owns(self, sub):
+        """Whether this replica fetches sub. Without sharding the leader fetches every sub"""
+        if not self.shard_scrapes:
+            return self.is_leader()
+        replicas = self._replicas
+        if self.replica_id not in replicas:
+            return False
+        return zlib.crc32(sub.lower().encode()) % len(replicas) == replicas.index(self.replica_id)
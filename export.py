@@ -0,0 +1,175 @@
+"""
+Streams the posts table out to a file, in constant memory however big the table is.
+
+Rows are read through an unbuffered cursor (see `Storage.stream`) and written as they
+arrive, as gzipped csv, gzipped ndjson, or parquet (columnar, written one row group at a
+time, which needs pyarrow).
+
+    python3 export.py memes/exports/posts.csv.gz --sub me_irl --since 2019-01-01 --posted
+    python3 export.py posts.parquet --format parquet --until 2019-06-01
+"""
+import argparse
+import csv
+import datetime
+import gzip
+import importlib.util
+import io
+import json
+import os
+
+import storage
+import utils
+
+
+EXPORTS_DIR = 'memes/exports'
+FORMATS = ('csv', 'ndjson', 'parquet')
+COLUMNS = storage.POST_COLUMNS + ('phash',)
+# rows per parquet row group, the most rows held in memory at once
+ROW_GROUP_SIZE = 10000
+
+
+def parquet_available():
+    """Whether pyarrow, which is needed to write parquet, is installed"""
+    return importlib.util.find_spec('pyarrow') is not None
+
+
+def _value(value):
+    """Converts a value from either database driver into something json / csv friendly"""
+    if isinstance(value, (datetime.datetime, datetime.date)):
+        return value.isoformat()
+    return value
+
+
+def _record(row):
+    return {column: _value(row.get(column)) for column in COLUMNS}
+
+
+def _open_text(path, compress):
+    if compress:
+        return io.TextIOWrapper(gzip.open(path, 'wb'), encoding='utf-8', newline='')
+    return open(path, 'w', encoding='utf-8', newline='')
+
+
+def write_csv(rows, path, compress=True):
+    with _open_text(path, compress) as f:
+        writer = csv.DictWriter(f, fieldnames=COLUMNS)
+        writer.writeheader()
+        count = 0
+        for row in rows:
+            writer.writerow(_record(row))
+            count += 1
+    return count
+
+
+def write_ndjson(rows, path, compress=True):
+    with _open_text(path, compress) as f:
+        count = 0
+        for row in rows:
+            f.write(json.dumps(_record(row)) + '\n')
+            count += 1
+    return count
+
+
+def write_parquet(rows, path, row_group_size=ROW_GROUP_SIZE):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    types = {
+        'over_18': pa.bool_(), 'posted_to_slack': pa.bool_(),
+        'ups': pa.int64(), 'highest_ups': pa.int64(), 'phash': pa.int64(),
+        'upvote_ratio': pa.float64(),
+    }
+    schema = pa.schema([(column, types.get(column, pa.string())) for column in COLUMNS])
+
+    def to_table(batch):
+        columns = {column: [] for column in COLUMNS}
+        for row in batch:
+            for column, value in _record(row).items():
+                if value is not None and types.get(column) == pa.bool_():
+                    value = bool(value)  # sqlite stores booleans as integers
+                elif value is not None and column not in types:
+                    value = str(value)
+                columns[column].append(value)
+        return pa.table(columns, schema=schema)
+
+    count = 0
+    with pq.ParquetWriter(path, schema, compression='snappy') as writer:
+        batch = []
+        for row in rows:
+            batch.append(row)
+            if len(batch) >= row_group_size:
+                writer.write_table(to_table(batch))
+                count += len(batch)
+                batch = []
+        if batch or not count:
+            writer.write_table(to_table(batch))
+            count += len(batch)
+    return count
+
+
+def default_path(fmt, compress=True):
+    """Returns a timestamped path in EXPORTS_DIR for an export in format fmt"""
+    timestamp = datetime.datetime.now().strftime('%Y%m%d-%H%M%S')
+    extension = fmt + ('.gz' if compress and fmt != 'parquet' else '')
+    return os.path.join(EXPORTS_DIR, f'posts-{timestamp}.{extension}')
+
+
+def export(db, path, fmt='csv', compress=True, **filters):
+    """
+    Writes the posts matching filters (see `Storage.iter_posts`) to path
+    :param db: a storage.Storage object, which is busy until the export is done
+    :param fmt: one of FORMATS
+    :param compress: whether to gzip csv / ndjson output
+    :return: the number of rows written
+    """
+    if fmt not in FORMATS:
+        raise ValueError(f'unknown export format {fmt!r}, expected one of {", ".join(FORMATS)}')
+    if fmt == 'parquet' and not parquet_available():
+        raise ValueError('exporting to parquet needs pyarrow, `pip install pyarrow`')
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+
+    rows = db.iter_posts(**filters)
+    try:
+        if fmt == 'csv':
+            return write_csv(rows, path, compress)
+        elif fmt == 'ndjson':
+            return write_ndjson(rows, path, compress)
+        return write_parquet(rows, path)
+    finally:
+        rows.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('path', nargs='?', help='the file to write, defaults to a new file in memes/exports/')
+    parser.add_argument('--format', choices=FORMATS, help='defaults to the extension of path, or csv')
+    parser.add_argument('--no-compress', action='store_true', help="don't gzip csv / ndjson output")
+    parser.add_argument('--sub', help='only export posts from this subreddit')
+    parser.add_argument('--since', help='only export posts created on or after this date, YYYY-MM-DD')
+    parser.add_argument('--until', help='only export posts created before this date, YYYY-MM-DD')
+    posted = parser.add_mutually_exclusive_group()
+    posted.add_argument('--posted', dest='posted', action='store_true', default=None, help='only posted memes')
+    posted.add_argument('--not-posted', dest='posted', action='store_false', help='only memes never posted')
+    parser.add_argument('--db', default='db.json', help='the database config file')
+    args = parser.parse_args()
+
+    fmt = args.format
+    if fmt is None and args.path:
+        fmt = next((f for f in FORMATS if f'.{f}' in os.path.basename(args.path)), None)
+    fmt = fmt or 'csv'
+    path = args.path or default_path(fmt, not args.no_compress)
+
+    utils.init()
+    db = storage.load_storage(args.db)
+    try:
+        count = export(
+            db, path, fmt, compress=not args.no_compress,
+            sub=args.sub, since=args.since, until=args.until, posted=args.posted,
+        )
+    finally:
+        db.close()
+    print(f'exported {count:,} posts to {path}')
+
+
+if __name__ == '__main__':
+    main()
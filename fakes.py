@@ -0,0 +1,154 @@
+"""
+Local stand-ins for the Slack and Reddit clients, used to replay traffic against the
+bot and to run it offline. They implement only what AutoMemer and scrape_reddit use.
+"""
+import itertools
+import queue
+import random
+import threading
+import time
+
+
+class FakeSlackClient:
+    """
+    Records every api call instead of making it, and serves RTM events pushed with
+    `push_events`. `latency` seconds are slept on every api call to mimic the network
+    """
+
+    def __init__(self, users=(), latency=0.0, now=time.time, sleep=time.sleep):
+        self.users = list(users)
+        self.latency = latency
+        self.now = now
+        self.sleep = sleep
+        self.calls = []
+        self._events = queue.Queue()
+        self._calls_lock = threading.Lock()
+        self._ts = itertools.count(1)
+
+    def push_events(self, events):
+        self._events.put(list(events))
+
+    def pending(self):
+        """Whether there are pushed events that haven't been read yet"""
+        return not self._events.empty()
+
+    def rtm_connect(self, *args, **kwargs):
+        return True
+
+    def rtm_read(self):
+        events = []
+        while True:
+            try:
+                events.extend(self._events.get_nowait())
+            except queue.Empty:
+                return events
+
+    def api_call(self, method, **kwargs):
+        if self.latency:
+            self.sleep(self.latency)
+        now = self.now()
+        with self._calls_lock:
+            self.calls.append((now, method, kwargs))
+            ts = f'{now:.6f}{next(self._ts) % 1000:03d}'
+        if method == 'users.list':
+            return {'ok': True, 'members': self.users}
+        if method == 'chat.postMessage':
+            return {'ok': True, 'channel': kwargs.get('channel'), 'ts': ts, 'message': {'text': kwargs.get('text')}}
+        return {'ok': True}
+
+    def posted(self, channel=None):
+        """Returns the (time, kwargs) of every chat.postMessage call, optionally for one channel"""
+        with self._calls_lock:
+            return [
+                (when, kwargs) for when, method, kwargs in self.calls
+                if method == 'chat.postMessage' and (channel is None or kwargs.get('channel') == channel)
+            ]
+
+
+class _Named:
+    def __init__(self, display_name):
+        self.display_name = display_name
+
+    def __str__(self):
+        return self.display_name
+
+
+class FakeSubmission:
+
+    def __init__(self, reddit, sub, index, created_utc, quality):
+        self.reddit = reddit
+        self.id = f'{sub}{index}'.lower()
+        self.subreddit = _Named(sub)
+        self.title = f'meme {index} from {sub}'
+        self.url = f'https://i.example.com/{sub}/{index}.jpg'
+        self.shortlink = f'https://redd.it/{self.id}'
+        self.author = _Named(f'user{index % 97}')
+        self.created_utc = created_utc
+        self.quality = quality
+        self.over_18 = False
+        self.upvote_ratio = 0.9
+
+    @property
+    def ups(self):
+        # upvotes grow quickly at first and then level off
+        minutes = max(self.reddit.now() - self.created_utc, 0) / 60
+        return int(self.quality * (minutes ** 0.5) * 10)
+
+
+class FakeSubreddit:
+
+    def __init__(self, reddit, name):
+        self.reddit = reddit
+        self.display_name = name
+        self.over18 = False
+
+    def hot(self, limit=100):
+        # like reddit, `a+b+c` is a combined listing of several subs, and every 100 posts is a request
+        subs = self.display_name.split('+')
+        posts = sorted(
+            (post for sub in subs for post in self.reddit.posts(sub)),
+            key=lambda post: post.ups,
+            reverse=True,
+        ) if len(subs) > 1 else self.reddit.posts(subs[0])
+        self.reddit.requests += 1
+        for i, post in enumerate(posts[:limit]):
+            if i and i % 100 == 0:
+                self.reddit.requests += 1
+            yield post
+
+
+class FakeReddit:
+    """
+    A deterministic stand in for praw.Reddit. Every sub gets a new post every
+    `60 / posts_per_hour` minutes, with a random quality that decides how fast it gains
+    upvotes. `now` is a function returning the current time, so it can follow a
+    virtual clock
+    """
+
+    def __init__(self, posts_per_hour=4, seed=0, now=time.time, start=None):
+        self.posts_per_hour = posts_per_hour
+        self.now = now
+        self.start = now() - 24 * 3600 if start is None else start
+        self.requests = 0
+        self._random = random.Random(seed)
+        self._posts = {}
+        self._by_id = {}
+        self._lock = threading.Lock()
+
+    def subreddit(self, name):
+        return FakeSubreddit(self, name)
+
+    def submission(self, id):
+        self.requests += 1
+        return self._by_id[id]
+
+    def posts(self, sub):
+        """Returns the posts of sub created so far, newest first"""
+        interval = 3600 / self.posts_per_hour
+        with self._lock:
+            posts = self._posts.setdefault(sub, [])
+            while self.start + len(posts) * interval <= self.now():
+                post = FakeSubmission(self, sub, len(posts), self.start + len(posts) * interval, self._random.random())
+                posts.append(post)
+                self._by_id[post.id] = post
+            return posts[::-1]
@@ -0,0 +1,295 @@
+"""
+Perceptual hashing of scraped images, to catch reposts of the same image under a
+different url or sub.
+
+Images are downloaded and hashed (a 64 bit difference hash) in a process pool, off the
+scrape's critical path. Finished hashes are buffered and written to `posts.phash` in
+batches by `flush`, and the hashes of memes that have been posted are kept in a BK-tree
+so near-duplicate lookups only visit a small part of the index.
+"""
+import importlib.util
+import io
+import multiprocessing
+import os
+import threading
+import urllib.request
+from urllib.parse import urlparse
+
+import utils
+
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.gif', '.webp')
+IMAGE_HOSTS = ('i.redd.it', 'i.imgur.com')
+# images whose hashes differ in at most this many of their 64 bits are considered the same
+MAX_DISTANCE = 6
+MAX_IMAGE_BYTES = 10 * 1024 * 1024
+# hashes are summed modulo this in checksums, so the sums of millions of them fit in a BIGINT
+CHECKSUM_MODULUS = 1000003
+
+
+def available():
+    """Whether Pillow, which is needed to hash images, is installed"""
+    return importlib.util.find_spec('PIL') is not None
+
+
+def is_image_url(url):
+    parsed = urlparse(url)
+    return parsed.path.lower().endswith(IMAGE_EXTENSIONS) or parsed.netloc.lower() in IMAGE_HOSTS
+
+
+def download(url, timeout=10):
+    """The default downloader, fetching url over http(s)"""
+    request = urllib.request.Request(url, headers={'User-Agent': 'automemer'})
+    with urllib.request.urlopen(request, timeout=timeout) as response:
+        return response.read(MAX_IMAGE_BYTES)
+
+
+class DirectoryDownloader:
+    """A downloader serving every url from the file with the same name in `root`, for tests"""
+
+    def __init__(self, root):
+        self.root = root
+
+    def __call__(self, url):
+        with open(os.path.join(self.root, os.path.basename(urlparse(url).path)), 'rb') as f:
+            return f.read()
+
+
+def dhash(image_bytes, size=8):
+    """Returns the difference hash of an image as a (size * size) bit unsigned integer"""
+    from PIL import Image
+
+    image = Image.open(io.BytesIO(image_bytes)).convert('L').resize((size + 1, size), Image.LANCZOS)
+    pixels = list(image.getdata())
+    value = 0
+    for row in range(size):
+        for col in range(size):
+            left = pixels[row * (size + 1) + col]
+            right = pixels[row * (size + 1) + col + 1]
+            value = (value << 1) | (left > right)
+    return value
+
+
+def fingerprint_url(downloader, url):
+    """Downloads and hashes url. Runs in a worker process"""
+    return dhash(downloader(url))
+
+
+def hamming(a, b):
+    return bin(a ^ b).count('1')
+
+
+def to_signed(value):
+    """Maps an unsigned 64 bit hash into the range of a signed BIGINT column"""
+    return value - (1 << 64) if value >= (1 << 63) else value
+
+
+def to_unsigned(value):
+    return value + (1 << 64) if value < 0 else value
+
+
+def checksum(values):
+    """
+    An order independent checksum of unsigned hashes, the same as Storage.summarize_posted_phashes
+    computes over the stored (signed) ones
+    """
+    return sum(to_signed(value) % CHECKSUM_MODULUS for value in values)
+
+
+class BKTree:
+    """A BK-tree over 64 bit hashes under hamming distance"""
+
+    def __init__(self):
+        # nodes are [hash, items, {distance: child}]
+        self.root = None
+        self.size = 0
+
+    def add(self, value, item):
+        self.size += 1
+        if self.root is None:
+            self.root = [value, [item], {}]
+            return
+        node = self.root
+        while True:
+            distance = hamming(value, node[0])
+            if distance == 0:
+                node[1].append(item)
+                return
+            child = node[2].get(distance)
+            if child is None:
+                node[2][distance] = [value, [item], {}]
+                return
+            node = child
+
+    def items(self):
+        """Yields (hash, item) for every item in the tree"""
+        stack = [self.root] if self.root is not None else []
+        while stack:
+            node = stack.pop()
+            for item in node[1]:
+                yield node[0], item
+            stack.extend(node[2].values())
+
+    def search(self, value, max_distance):
+        """Returns a list of (distance, item) for every item within max_distance of value"""
+        found = []
+        stack = [self.root] if self.root is not None else []
+        while stack:
+            node = stack.pop()
+            distance = hamming(value, node[0])
+            if distance <= max_distance:
+                found.extend((distance, item) for item in node[1])
+            # by the triangle inequality only children in this range can be close enough
+            for child_distance, child in node[2].items():
+                if distance - max_distance <= child_distance <= distance + max_distance:
+                    stack.append(child)
+        return found
+
+
+class Fingerprinter:
+    """
+    Hashes scraped images in a process pool and answers "has something like this been
+    posted" queries. Does nothing (and never starts the pool) if Pillow isn't installed
+    """
+
+    def __init__(self, downloader=download, max_workers=None, max_distance=MAX_DISTANCE):
+        self.downloader = downloader
+        self.max_workers = max_workers
+        self.max_distance = max_distance
+        self.enabled = available()
+        self.posted = BKTree()
+        self._posted_loaded = False
+        self._posted_seed = None
+        self._pool = None
+        self._lock = threading.Lock()
+        self._index_lock = threading.Lock()
+        self._submitted = set()
+        self._results = []
+
+    def submit(self, memes):
+        """
+        Queues the image memes among memes (records.Meme) for hashing, without waiting. Memes
+        whose hash is being computed, or waiting to be flushed, are skipped
+        """
+        if not self.enabled:
+            return
+        with self._lock:
+            if self._pool is None:
+                # the bot's threads may hold locks, which a forked worker would inherit held
+                self._pool = multiprocessing.get_context('spawn').Pool(self.max_workers)
+            for meme in memes:
+                if meme.id in self._submitted or not is_image_url(meme.url):
+                    continue
+                self._submitted.add(meme.id)
+                # the callbacks run in the pool's result thread, never in this one
+                self._pool.apply_async(
+                    fingerprint_url, (self.downloader, meme.url),
+                    callback=lambda value, meme_id=meme.id: self._done(meme_id, value),
+                    error_callback=lambda e, meme_id=meme.id: self._failed(meme_id, e),
+                )
+
+    def _done(self, meme_id, value):
+        with self._lock:
+            # stays in _submitted until flushed, so it isn't hashed again in the meantime
+            self._results.append((to_signed(value), meme_id))
+
+    def _failed(self, meme_id, e):
+        utils.log_usage(f'fingerprint - {meme_id} - {type(e).__name__}: {e}')
+        with self._lock:
+            self._submitted.discard(meme_id)
+
+    def flush(self, db):
+        """Writes the hashes computed since the last flush to the database, in one batch"""
+        with self._lock:
+            results, self._results = self._results, []
+        try:
+            if results:
+                db.set_phashes(results)
+        except BaseException:
+            with self._lock:
+                self._results = results + self._results
+            raise
+        with self._lock:
+            self._submitted.difference_update(meme_id for _, meme_id in results)
+        return len(results)
+
+    def seed(self, posted, expected):
+        """
+        Provides the index of posted images from a snapshot, used instead of reading it from
+        the database as long as the database's posted images still match it
+        :param posted: a function returning an iterable of (id, unsigned hash), called when
+        the index is needed
+        :param expected: the (number, `checksum`) of the hashes posted returns
+        """
+        with self._index_lock:
+            if not self._posted_loaded:
+                self._posted_seed = (posted, expected)
+
+    def posted_items(self):
+        """Returns a list of (id, unsigned hash) for every image in the index of posted images"""
+        with self._index_lock:
+            if not self._posted_loaded:
+                # never needed since startup, keep whatever the last snapshot had
+                return list(self._posted_seed[0]()) if self._posted_seed is not None else []
+            return [(meme_id, value) for value, meme_id in self.posted.items()]
+
+    def _load_posted(self, db):
+        with self._index_lock:
+            if not self._posted_loaded:
+                seed, self._posted_seed = self._posted_seed, None
+                if seed is not None and db.summarize_posted_phashes(CHECKSUM_MODULUS) == seed[1]:
+                    for meme_id, value in seed[0]():
+                        self.posted.add(value, meme_id)
+                else:
+                    if seed is not None:
+                        utils.log_usage(
+                            'fingerprint - snapshot is out of date, reading posted hashes from the database',
+                        )
+                    for meme_id, value in db.get_posted_phashes():
+                        self.posted.add(to_unsigned(value), meme_id)
+                self._posted_loaded = True
+
+    def image_hash(self, db, meme_id):
+        """Returns the (unsigned) hash of meme_id's image, or None if it hasn't been hashed (yet)"""
+        if not self.enabled:
+            return None
+        value = db.get_phash(meme_id)
+        return to_unsigned(value) if value is not None else None
+
+    def find_posted_duplicates(self, db, meme_id, value, picked=()):
+        """
+        Returns a list of (distance, id) of posted memes whose image is a near duplicate of
+        meme_id's, or an empty list if it hasn't been hashed (yet)
+        :param value: the hash of meme_id's image, from `image_hash`
+        :param picked: (id, hash) of the memes about to be posted, which aren't in the index yet
+        """
+        if not self.enabled or value is None:
+            return []
+        self._load_posted(db)
+        with self._index_lock:
+            matches = self.posted.search(value, self.max_distance)
+        for other, other_value in picked:
+            distance = hamming(value, other_value)
+            if distance <= self.max_distance:
+                matches.append((distance, other))
+        return [(distance, other) for distance, other in matches if other != meme_id]
+
+    def mark_posted(self, db, meme_id):
+        """Adds meme_id's hash, if it has one, to the index of posted images"""
+        if not self.enabled:
+            return
+        self._load_posted(db)
+        value = db.get_phash(meme_id)
+        if value is not None:
+            with self._index_lock:
+                self.posted.add(to_unsigned(value), meme_id)
+
+    def close(self):
+        with self._lock:
+            if self._pool is not None:
+                self._pool.terminate()
+                self._pool = None
+
+
+# the fingerprinter shared by the scraper and the bot(s)
+fingerprinter = Fingerprinter()
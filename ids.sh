@@ -3,3 +3,7 @@
 export MEME_SPAM_CHANNEL='fill in'
 export SLACK_BOT_TOKEN='fill in'
 export BOT_ID='fill in'
+# set to 0 to set up the database, reddit client and user list before connecting to slack
+export FAST_START=1
+# to serve several channels from one process, list them in a json file instead (see the README)
+# export CHANNELS_FILE='channels.json'
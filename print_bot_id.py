@@ -1,11 +1,11 @@
 import os
 
-from slackclient import SlackClient
+import transport
 
 
 BOT_NAME = 'automemer'
 
-slack_client = SlackClient(os.environ.get('SLACK_BOT_TOKEN'))
+slack_client = transport.PooledSlackClient(os.environ.get('SLACK_BOT_TOKEN'))
 
 
 if __name__ == '__main__':
@@ -0,0 +1,191 @@
+import cProfile
+import functools
+import io
+import os
+import pstats
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+import utils
+
+
+PROFILES_DIR = 'memes/profiles'
+
+
+class Profiler:
+    """
+    Opt-in cProfile wrapper around the bot's hot paths. When disabled, `profile` is
+    a no-op context manager, so the instrumented code pays almost nothing for it.
+    Only one section is profiled at a time; sections entered while another is being
+    profiled simply run unprofiled. cProfile only sees the thread that enabled it, so
+    threads working for a profiled section profile themselves as a section of their own
+    with `alongside=True`. From python 3.12 a profile covers every thread, and such
+    sections run unprofiled instead, since their work is in the first profile already.
+    """
+
+    def __init__(self, profiles_dir=PROFILES_DIR, top=15, sort_by='cumulative'):
+        self.profiles_dir = profiles_dir
+        self.top = top
+        self.sort_by = sort_by
+        self.enabled = False
+        # where summaries are posted back to, set by `profile on`
+        self.reply_to = None
+        self._active = threading.Lock()
+        self._listeners = []
+
+    def enable(self, reply_to=None):
+        os.makedirs(self.profiles_dir, exist_ok=True)
+        self.reply_to = reply_to
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+        self.reply_to = None
+
+    def toggle(self, *args):
+        """Flips profiling on/off. Accepts (and ignores) signal handler arguments"""
+        if self.enabled:
+            self.disable()
+        else:
+            self.enable()
+        utils.log_usage(f'profiling toggled - enabled={self.enabled}')
+
+    def add_listener(self, callback):
+        """
+        Registers callback(name, path, summary, reply_to), called every time a
+        profile has been written to disk
+        """
+        self._listeners.append(callback)
+
+    @contextmanager
+    def profile(self, name, alongside=False):
+        """
+        Profiles the enclosed block as `name` if profiling is enabled
+        :param alongside: whether to profile it even while another section is being profiled
+        """
+        if not self.enabled:
+            yield
+            return
+        active = None if alongside else self._active
+        if active is not None and not active.acquire(blocking=False):
+            yield
+            return
+
+        reply_to = self.reply_to
+        profiler = cProfile.Profile()
+        start = time.perf_counter()
+        try:
+            profiler.enable()
+        except ValueError:  # another profiler (e.g. a debugger) is already active
+            if active is not None:
+                active.release()
+            yield
+            return
+        try:
+            yield
+        finally:
+            profiler.disable()
+            elapsed = time.perf_counter() - start
+            if active is not None:
+                active.release()
+            try:
+                self._dump(name, profiler, elapsed, reply_to)
+            except Exception as e:
+                utils.log_error(e)
+
+    def list_profiles(self):
+        try:
+            return sorted(f for f in os.listdir(self.profiles_dir) if f.endswith('.prof'))
+        except OSError:
+            return []
+
+    def _dump(self, name, profiler, elapsed, reply_to):
+        timestamp = datetime.utcnow().strftime('%Y%m%dT%H%M%S%f')
+        path = os.path.join(self.profiles_dir, f'{timestamp}-{name}.prof')
+        profiler.dump_stats(path)
+        summary = self.summarize(profiler, name, elapsed)
+        utils.log_usage(f'profile written - {path} - {elapsed:.3f}s')
+        for callback in self._listeners:
+            callback(name, path, summary, reply_to)
+
+    def summarize(self, profiler, name, elapsed):
+        """Returns a short plain text table of the top functions in profiler"""
+        stats = pstats.Stats(profiler, stream=io.StringIO())
+        lines = [f'{name} took {elapsed:.3f}s, top {self.top} by {self.sort_by} time:']
+        entries = sorted(
+            stats.stats.items(),
+            key=lambda item: item[1][3] if self.sort_by == 'cumulative' else item[1][2],
+            reverse=True,
+        )
+        for (filename, lineno, func), (_, ncalls, tottime, cumtime, _) in entries[:self.top]:
+            if lineno:
+                func = f'{func} ({os.path.basename(filename)}:{lineno})'
+            lines.append(f'{cumtime:8.3f} {tottime:8.3f} {ncalls:7d}  {func}')
+        return '\n'.join(lines)
+
+
+class TimedLock:
+    """
+    A drop-in replacement for the bot's Lock that records how often it was acquired,
+    how often a thread had to wait for it and for how long
+    """
+
+    def __init__(self, lock=None):
+        self._lock = lock or threading.Lock()
+        self._stats_lock = threading.Lock()
+        self.acquisitions = 0
+        self.contended = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def acquire(self, blocking=True, timeout=-1):
+        if self._lock.acquire(blocking=False):
+            wait = 0.0
+        else:
+            start = time.perf_counter()
+            if not self._lock.acquire(blocking, timeout):
+                return False
+            wait = time.perf_counter() - start
+        with self._stats_lock:
+            self.acquisitions += 1
+            if wait:
+                self.contended += 1
+                self.total_wait += wait
+                self.max_wait = max(self.max_wait, wait)
+        return True
+
+    def release(self):
+        self._lock.release()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+    def stats(self):
+        with self._stats_lock:
+            return {
+                'acquisitions': self.acquisitions,
+                'contended': self.contended,
+                'total_wait': self.total_wait,
+                'max_wait': self.max_wait,
+            }
+
+
+# the profiler shared by the bot and the scraper
+profiler = Profiler()
+
+
+def profiled(name):
+    """Decorator profiling every call of the decorated function as `name` with the shared profiler"""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapped(*args, **kwargs):
+            with profiler.profile(name):
+                return func(*args, **kwargs)
+        return wrapped
+    return decorator
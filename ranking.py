@@ -0,0 +1,121 @@
+"""
+Velocity based ranking for scraped memes.
+
+Every time a meme is scraped its upvote count is appended to the `score_history`
+table, and its upvote velocity (upvotes / hour) is updated as an exponentially
+weighted moving average of the rate between the last two observations. Memes are
+ranked by velocity decayed by age, halving every `half_life_hours`:
+
+    score(now) = velocity * 2 ** -((now - created_utc) / half_life)
+
+Since the decay is the same for every meme, the ordering never changes with time
+between updates, so what is stored is the time independent key
+
+    rank = log2(1 + velocity) + created_utc / half_life
+
+which only needs to be recomputed when a meme is observed again.
+"""
+import heapq
+import math
+import time
+from collections import defaultdict
+
+
+HALF_LIFE_HOURS = 6
+# memes older than this are dropped from the backlog, overridable with the max_backlog_age_hours setting
+MAX_BACKLOG_AGE_HOURS = 48
+# weight of the newest observation in the velocity moving average
+SMOOTHING = 0.5
+# don't trust rates measured over less than this many hours
+MIN_INTERVAL_HOURS = 1 / 60
+
+
+def velocity(ups, now, created_utc, previous=None, smoothing=SMOOTHING):
+    """
+    Returns the updated upvote velocity (upvotes / hour) of a meme
+    :param ups: the current number of upvotes
+    :param now: the current time, in seconds since the epoch
+    :param created_utc: when the post was created, in seconds since the epoch
+    :param previous: the meme's previous meme_scores row, if it has been scored before
+    :param smoothing: the weight of the newest observation
+    """
+    if previous is None:
+        # first observation: average rate since the post was created
+        hours = max((now - (created_utc or now)) / 3600, MIN_INTERVAL_HOURS)
+        return max(ups, 0) / hours
+
+    hours = max((now - previous['last_seen']) / 3600, MIN_INTERVAL_HOURS)
+    rate = max(ups - previous['ups'], 0) / hours
+    return smoothing * rate + (1 - smoothing) * previous['velocity']
+
+
+def rank_key(velocity, created_utc, half_life_hours=HALF_LIFE_HOURS):
+    """Returns the time independent key memes are ordered by, see the module docstring"""
+    return math.log2(1 + max(velocity, 0)) + (created_utc or 0) / (half_life_hours * 3600)
+
+
+def current_score(key, now, half_life_hours=HALF_LIFE_HOURS):
+    """Converts a rank key back into the decayed velocity at time `now`"""
+    return 2 ** (key - now / (half_life_hours * 3600)) - 1
+
+
+def record_scores(db, memes, now=None, half_life_hours=HALF_LIFE_HOURS):
+    """
+    Appends the current upvotes of memes to the score history and updates their
+    velocity / rank in one batch. Sets `velocity` and `score` on every meme passed.
+    :param db: a storage.Storage object
+    :param memes: a list of records.Meme, as just scraped
+    :param now: the time of the scrape, defaults to now
+    """
+    if not memes:
+        return
+    now = time.time() if now is None else now
+    previous = db.get_meme_scores([meme.id for meme in memes])
+
+    history, scores = [], []
+    for meme in memes:
+        meme.velocity = velocity(meme.ups, now, meme.created_utc, previous.get(meme.id))
+        meme.score = rank_key(meme.velocity, meme.created_utc, half_life_hours)
+        history.append((meme.id, meme.ups, meme.upvote_ratio, now))
+        scores.append((meme.id, meme.sub, meme.url, meme.ups, meme.velocity, meme.score, now))
+
+    db.add_score_history(history)
+    db.set_meme_scores(scores)
+
+
+def is_stale(meme, now, max_age_hours):
+    """Returns whether meme is too old to be worth keeping in the backlog"""
+    return max_age_hours is not None and meme.created_utc is not None and \
+        now - meme.created_utc > max_age_hours * 3600
+
+
+def prune(memes, now=None, max_age_hours=MAX_BACKLOG_AGE_HOURS):
+    """
+    Removes memes older than max_age_hours from memes (a dict of url -> Meme) in place,
+    returning how many were removed
+    """
+    now = time.time() if now is None else now
+    stale = [url for url, meme in memes.items() if is_stale(meme, now, max_age_hours)]
+    for url in stale:
+        del memes[url]
+    return len(stale)
+
+
+def heaps_by_sub(memes):
+    """
+    Groups memes (an iterable of records.Meme) by sub into heaps, so that the best
+    ranked memes of a sub can be popped in O(log n) each, without sorting the backlog
+    :return: a dict of sub -> heap, to be used with `pop_best`
+    """
+    heaps = defaultdict(list)
+    for meme in memes:
+        # the url is unique, so Meme objects themselves are never compared
+        heaps[meme.sub].append((-meme.score, meme.created_utc or 0, meme.url, meme))
+    for heap in heaps.values():
+        heapq.heapify(heap)
+    return heaps
+
+
+def pop_best(heap):
+    """Pops the best ranked meme from a heap built by `heaps_by_sub`"""
+    return heapq.heappop(heap)[-1]
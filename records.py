@@ -0,0 +1,335 @@
+import fcntl
+import json
+import os
+import sys
+import time
+from collections import Counter
+from contextlib import contextmanager
+from datetime import datetime
+from datetime import timezone
+
+
+def _to_timestamp(value, local=False):
+    """
+    Converts a DB / json datetime value (a datetime, an isoformat string or a number)
+    to seconds since the epoch. Naive values are treated as UTC unless local=True.
+    """
+    if value is None or value == '':
+        return None
+    if isinstance(value, (int, float)):
+        return float(value)
+    if isinstance(value, str):
+        value = _parse_iso(value)
+    if value.tzinfo is None and not local:
+        value = value.replace(tzinfo=timezone.utc)
+    return value.timestamp()
+
+
+def _parse_iso(value):
+    # datetime.fromisoformat is only available from python 3.7
+    value = value.replace(' ', 'T')
+    return datetime.strptime(value, '%Y-%m-%dT%H:%M:%S.%f' if '.' in value else '%Y-%m-%dT%H:%M:%S')
+
+
+def _to_iso(timestamp, local=False):
+    if timestamp is None:
+        return None
+    if local:
+        return datetime.fromtimestamp(timestamp).isoformat()
+    return datetime.utcfromtimestamp(timestamp).isoformat()
+
+
+def _intern(value):
+    return sys.intern(value) if isinstance(value, str) else value
+
+
+class Meme:
+    """
+    A compact record for a single scraped Reddit post. Timestamps are stored as
+    seconds since the epoch and subreddit / author names are interned, since the
+    same handful of them repeat across the whole backlog.
+    `created_utc` is serialized as local time and `recorded` / `last_updated` as UTC,
+    to match the rows already in the database.
+    """
+    __slots__ = (
+        'id',
+        'over_18',
+        'ups',
+        'highest_ups',
+        'title',
+        'url',
+        'link',
+        'author',
+        'sub',
+        'upvote_ratio',
+        'created_utc',
+        'last_updated',
+        'recorded',
+        'posted_to_slack',
+        # ranking state, see ranking.py
+        'velocity',
+        'score',
+    )
+
+    def __init__(
+        self, id, url, title='', sub='', author='', ups=0, highest_ups=None,
+        upvote_ratio=None, over_18=False, link=None, created_utc=None,
+        last_updated=None, recorded=None, posted_to_slack=False, velocity=0.0, score=0.0,
+    ):
+        self.id = id
+        self.url = url
+        self.title = title
+        self.sub = _intern(sub)
+        self.author = _intern(author)
+        self.ups = ups
+        self.highest_ups = ups if highest_ups is None else highest_ups
+        self.upvote_ratio = upvote_ratio
+        self.over_18 = bool(over_18)
+        self.link = link
+        self.created_utc = created_utc
+        self.recorded = recorded
+        self.last_updated = recorded if last_updated is None else last_updated
+        self.posted_to_slack = bool(posted_to_slack)
+        self.velocity = velocity
+        self.score = score
+
+    def __repr__(self):
+        return f'Meme(id={self.id!r}, sub={self.sub!r}, ups={self.ups!r}, url={self.url!r})'
+
+    @classmethod
+    def from_post(cls, post, now=None):
+        """
+        Creates a Meme from a praw Submission
+        :param post: a praw.models.Submission object
+        :param now: the time (seconds since the epoch) the post was scraped, defaults to now
+        """
+        now = time.time() if now is None else now
+        return cls(
+            id=post.id,
+            url=post.url,
+            title=post.title,
+            sub=post.subreddit.display_name,
+            author=str(post.author),
+            ups=post.ups,
+            upvote_ratio=post.upvote_ratio,
+            over_18=post.over_18,
+            link=post.shortlink,
+            created_utc=float(post.created_utc),
+            recorded=now,
+        )
+
+    @classmethod
+    def from_archive(cls, data, now=None):
+        """
+        Creates a Meme from a submission in a Reddit archive dump (one json object per
+        submission, as returned by the reddit api)
+        :param data: the submission's dict
+        :param now: the time (seconds since the epoch) the post was imported, defaults to now
+        """
+        now = time.time() if now is None else now
+        ups = data.get('ups', data.get('score')) or 0
+        return cls(
+            id=data['id'],
+            url=data.get('url') or '',
+            title=data.get('title') or '',
+            sub=data.get('subreddit') or '',
+            author=data.get('author') or '',
+            ups=int(ups),
+            upvote_ratio=data.get('upvote_ratio'),
+            over_18=data.get('over_18', False),
+            link=f"https://redd.it/{data['id']}",
+            created_utc=float(data['created_utc']),
+            recorded=now,
+        )
+
+    @classmethod
+    def from_row(cls, row):
+        """Creates a Meme from a row (dict) of the posts table"""
+        return cls(
+            id=row['id'],
+            url=row['url'],
+            title=row.get('title') or '',
+            sub=row.get('sub') or '',
+            author=row.get('author') or '',
+            ups=row.get('ups') or 0,
+            highest_ups=row.get('highest_ups') or 0,
+            upvote_ratio=row.get('upvote_ratio'),
+            over_18=row.get('over_18'),
+            link=row.get('link'),
+            created_utc=_to_timestamp(row.get('created_utc'), local=True),
+            last_updated=_to_timestamp(row.get('last_updated')),
+            recorded=_to_timestamp(row.get('recorded')),
+            posted_to_slack=row.get('posted_to_slack'),
+        )
+
+    @classmethod
+    def from_dict(cls, data):
+        """Creates a Meme from an entry of the pending store"""
+        meme = cls.from_row(data)
+        meme.velocity = data.get('velocity') or 0.0
+        meme.score = data.get('score') or 0.0
+        return meme
+
+    def to_row(self):
+        """Returns a dict for this meme in the format of a row of the posts table"""
+        return {
+            'id': self.id,
+            'over_18': self.over_18,
+            'ups': self.ups,
+            'highest_ups': self.highest_ups,
+            'title': self.title,
+            'url': self.url,
+            'link': self.link,
+            'author': self.author,
+            'sub': self.sub,
+            'upvote_ratio': self.upvote_ratio,
+            'created_utc': _to_iso(self.created_utc, local=True),
+            'last_updated': _to_iso(self.last_updated),
+            'recorded': _to_iso(self.recorded),
+            'posted_to_slack': self.posted_to_slack,
+        }
+
+    def to_dict(self):
+        """Returns a dict for this meme in the format of the pending store"""
+        data = self.to_row()
+        data['velocity'] = self.velocity
+        data['score'] = self.score
+        return data
+
+
+def count_postable(memes, thresholds):
+    """
+    Counts sfw memes per (lowercased) sub, and how many of those meet their sub's threshold
+    :param memes: an iterable of Meme objects
+    :param thresholds: a dict of lowercase sub -> threshold upvotes, with a 'global' fallback
+    :return: a tuple of (total, postable) Counters
+    """
+    total, postable = Counter(), Counter()
+    for meme in memes:
+        if not meme.over_18:
+            sub = meme.sub.lower()
+            sub_threshold = thresholds.get(sub, thresholds['global'])
+
+            total[sub] += 1
+            if meme.highest_ups >= sub_threshold:
+                postable[sub] += 1
+    return total, postable
+
+
+class PendingStore:
+    """
+    The memes that have been scraped but not yet posted, keyed by url and persisted at
+    `path` as a journal: one json object per line, where later lines for a url replace
+    earlier ones and `{"url": ..., "deleted": true}` lines remove a url. Scrapes only ever
+    `append`, so they never need to read the backlog, and posting only appends deletions
+    with `remove`; `save` rewrites (compacts) the whole store. Files in the older format, a
+    single json object of url -> meme, are still read and are converted on the next write.
+
+    Replicas sharing the store (see coordination.py) write to it from several processes,
+    so writes, and loads that a write is based on, are done while holding `lock()`.
+    """
+    HEADER = {'format': 'automemer-pending', 'version': 2}
+    # `remove` compacts the journal once it has this many times more lines than live memes
+    COMPACT_RATIO = 4
+
+    def __init__(self, path):
+        self.path = path
+        self.lines = 0  # journal lines seen by the last `load`
+
+    @contextmanager
+    def lock(self):
+        """
+        Holds an exclusive lock on the store, shared by every process on this host (with
+        flock on a file next to it). Not reentrant: holding it twice in one process deadlocks
+        """
+        with open(self.path + '.lock', 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield self
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _is_journal(self, f):
+        first_line = f.readline()
+        try:
+            return json.loads(first_line) == self.HEADER
+        except ValueError:
+            return False
+
+    def load(self):
+        """
+        Returns a dict of url -> Meme. Raises OSError if the store can't be read. Lines a
+        writer didn't finish (e.g. because it was killed) are skipped
+        """
+        with open(self.path, mode='r', encoding='utf-8') as f:
+            if not self._is_journal(f):
+                f.seek(0)
+                data = json.loads(f.read() or '{}')
+                self.lines = len(data)
+                return {url: Meme.from_dict(meme) for url, meme in data.items()}
+
+            memes = {}
+            self.lines = 0
+            for line in f:
+                if not line.strip():
+                    continue
+                self.lines += 1
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue
+                if entry.get('deleted'):
+                    memes.pop(entry['url'], None)
+                else:
+                    memes[entry['url']] = Meme.from_dict(entry)
+            return memes
+
+    def _ensure_journal(self):
+        try:
+            with open(self.path, mode='r', encoding='utf-8') as f:
+                is_journal = self._is_journal(f)
+        except OSError:
+            is_journal = False
+        if not is_journal:
+            # start a new journal, or convert a store in the old format
+            try:
+                existing = self.load()
+            except OSError:
+                existing = {}
+            self.save(existing)
+
+    def _append(self, entries):
+        self._ensure_journal()
+        with open(self.path, mode='ab+') as f:
+            # end a line a killed writer left unfinished, so that it is the only one lost
+            f.seek(-1, os.SEEK_END)
+            if f.read(1) != b'\n':
+                f.write(b'\n')
+            for entry in entries:
+                f.write(json.dumps(entry).encode('utf-8') + b'\n')
+
+    def append(self, memes):
+        """Adds (or replaces) memes, an iterable of Meme, without reading the rest of the store"""
+        self._append(meme.to_dict() for meme in memes)
+
+    def remove(self, urls, remaining):
+        """
+        Removes the memes with urls from a store just read with `load`, by appending deletions.
+        Once most of the journal is out of date it is compacted with `save` instead
+        :param remaining: the dict of url -> Meme left in the store
+        """
+        urls = list(urls)
+        if self.lines + len(urls) > self.COMPACT_RATIO * max(len(remaining), 1):
+            self.save(remaining)
+            return
+        self._append({'url': url, 'deleted': True} for url in urls)
+
+    def save(self, memes):
+        """Overwrites the store with memes, a dict of url -> Meme"""
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, mode='w', encoding='utf-8') as f:
+            f.write(json.dumps(self.HEADER) + '\n')
+            for meme in memes.values():
+                f.write(json.dumps(meme.to_dict()) + '\n')
+        os.replace(tmp_path, self.path)
+        self.lines = len(memes)
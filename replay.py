@@ -0,0 +1,278 @@
+"""
+Replays recorded (or synthetic) RTM traffic against a local AutoMemer, to see how the
+bot copes with more traffic than it gets today.
+
+The bot runs with a fake Slack client, a fake Reddit and a SQLite database in a
+scratch directory, so nothing is posted and the live memes/ directory isn't touched.
+
+    python3 replay.py memes/comments.log --speedup 10 --multiplier 10
+    python3 replay.py --synthetic 20 --duration 60
+"""
+import argparse
+import itertools
+import json
+import os
+import re
+import shutil
+import tempfile
+import threading
+import time
+from threading import Thread
+
+import fakes
+import profiling
+import scrape_reddit
+import storage
+import utils
+from slackbot import AutoMemer
+
+
+# keys parse_slack_output adds to events, which are stripped before replaying them
+DERIVED_KEYS = ('time', 'username', '@mention')
+SYNTHETIC_COMMANDS = ('num-memes', 'num-memes by_sub', 'list settings', 'list thresholds', 'help')
+
+
+def read_rtm_log(path):
+    """
+    Yields the inbound RTM batches (lists of events) recorded in a comments.log file,
+    skipping the outgoing messages logged in debug mode
+    """
+    decoder = json.JSONDecoder()
+    with open(path, 'r') as f:
+        content = f.read()
+    pos = 0
+    while True:
+        # entries are separated by ',\n'
+        while pos < len(content) and content[pos] in ',\r\n\t ':
+            pos += 1
+        if pos >= len(content):
+            return
+        entry, pos = decoder.raw_decode(content, pos)
+        if isinstance(entry, list):
+            yield entry
+
+
+def _event_time(event):
+    try:
+        return time.mktime(time.strptime(event['time'].split('.')[0], '%Y-%m-%dT%H:%M:%S'))
+    except (KeyError, ValueError):
+        return float(event.get('ts', 0))
+
+
+def find_bot_id(batches):
+    for batch in batches:
+        for event in batch:
+            if '@mention' in event:
+                match = re.search(r'<@(\w+)>', event.get('text', ''))
+                if match:
+                    return match.group(1)
+    return None
+
+
+def recorded_schedule(batches, channel='CREPLAY'):
+    """
+    Returns a list of (offset in seconds, batch), from the recorded times of the batches.
+    Events are moved to channel, since the bot only answers in its own channel
+    """
+    schedule, start = [], None
+    for batch in batches:
+        if not batch:
+            continue
+        when = _event_time(batch[0])
+        start = when if start is None else start
+        events = [{k: v for k, v in e.items() if k not in DERIVED_KEYS} for e in batch]
+        for e in events:
+            if 'channel' in e:
+                e['channel'] = channel
+        schedule.append((when - start, events))
+    return schedule
+
+
+def synthetic_schedule(bot_id, rate, duration, commands=SYNTHETIC_COMMANDS, channel='CREPLAY'):
+    """Returns a schedule of `rate` mentions per second for `duration` seconds, cycling through commands"""
+    schedule = []
+    commands = itertools.cycle(commands)
+    for i in range(int(rate * duration)):
+        offset = i / rate
+        schedule.append((offset, [{
+            'type': 'message',
+            'channel': channel,
+            'user': f'U{i % 50:04d}',
+            'text': f'<@{bot_id}> {next(commands)}',
+            'ts': f'{1000000000 + offset:.6f}',
+        }]))
+    return schedule
+
+
+def amplify(schedule, multiplier):
+    """Returns schedule with every batch sent `multiplier` times, spread over the gap to the next batch"""
+    if multiplier <= 1:
+        return schedule
+    amplified = []
+    for i, (offset, batch) in enumerate(schedule):
+        gap = (schedule[i + 1][0] - offset) if i + 1 < len(schedule) else 1.0
+        for copy in range(multiplier):
+            events = [dict(e, ts=f"{e.get('ts', '0')}{copy}") for e in batch]
+            amplified.append((offset + gap * copy / multiplier, events))
+    return amplified
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(pct / 100 * (len(values) - 1))))]
+
+
+class Replay:
+    """Feeds a schedule of RTM batches into a bot, timing every command it handles"""
+
+    def __init__(self, bot, speedup=1.0):
+        self.bot = bot
+        self.speedup = speedup
+        self.latencies = {}
+        self.max_threads = 0
+        self.max_queue = 0
+        self._lock = threading.Lock()
+        self._done = threading.Event()
+        bot.lock = profiling.TimedLock()
+
+    def _handle(self, output, dispatched):
+        self.bot.handle_command(output)
+        elapsed = time.perf_counter() - dispatched
+        name = ' '.join(output['@mention'].lower().split()[:1]) or '?'
+        with self._lock:
+            self.latencies.setdefault(name, []).append(elapsed)
+
+    def _sample(self):
+        while not self._done.is_set():
+            self.max_threads = max(self.max_threads, threading.active_count())
+            self.max_queue = max(self.max_queue, self.bot.messages.qsize())
+            # drain the outgoing queue as fast as the fake client allows
+            while not self.bot.messages.empty():
+                self.bot.pop_queue()
+            time.sleep(0.01)
+
+    def run(self, schedule):
+        sampler = Thread(target=self._sample)
+        sampler.daemon = True
+        sampler.start()
+
+        handlers = []
+        start = time.perf_counter()
+        for offset, batch in schedule:
+            delay = offset / self.speedup - (time.perf_counter() - start)
+            if delay > 0:
+                time.sleep(delay)
+            for output in self.bot.parse_slack_output(batch):
+                if '@mention' not in output:
+                    continue
+                t = Thread(target=self._handle, args=(output, time.perf_counter()))
+                t.daemon = True
+                t.start()
+                handlers.append(t)
+        for t in handlers:
+            t.join()
+        elapsed = time.perf_counter() - start
+        self._done.set()
+        sampler.join()
+        return elapsed
+
+    def report(self, elapsed):
+        lines = [
+            f'{"command":<20}{"count":>8}{"p50 ms":>10}{"p90 ms":>10}{"p99 ms":>10}{"max ms":>10}',
+        ]
+        everything = []
+        for name, values in sorted(self.latencies.items()):
+            everything.extend(values)
+            lines.append(self._row(name, values))
+        lines.append(self._row('all', everything))
+        lock = self.bot.lock.stats()
+        lines.extend([
+            '',
+            f'commands/s: {len(everything) / elapsed if elapsed else 0:.1f} over {elapsed:.1f}s',
+            f'max threads: {self.max_threads}',
+            f'max outgoing queue: {self.max_queue}',
+            'lock: {acquisitions} acquisitions, {contended} contended, '
+            '{total_wait:.3f}s total wait, {max_wait:.3f}s max wait'.format(**lock),
+        ])
+        return '\n'.join(lines)
+
+    @staticmethod
+    def _row(name, values):
+        ms = [v * 1000 for v in values]
+        return (
+            f'{name:<20}{len(ms):>8}{percentile(ms, 50):>10.1f}{percentile(ms, 90):>10.1f}'
+            f'{percentile(ms, 99):>10.1f}{max(ms) if ms else 0:>10.1f}'
+        )
+
+
+def make_bot(bot_id, workdir, settings=None, scraped=None, slack_latency=0.0, client=None, reddit=None, clock=None):
+    """
+    Creates an AutoMemer running in workdir against fake slack / reddit clients and a
+    SQLite database, copying in the settings and pending store files if given
+    :param client: the fake slack client, defaults to a new FakeSlackClient
+    :param reddit: the fake reddit, defaults to a new FakeReddit
+    :param clock: the bot's utils.Clock, defaults to the wall clock
+    """
+    os.chdir(workdir)
+    utils.init()
+    for src, dst in ((settings, utils.SETTINGS_PATH), (scraped, utils.SCRAPED_PATH)):
+        if src:
+            shutil.copy(src, dst)
+    with open(utils.SETTINGS_PATH, 'r') as f:
+        current = json.loads(f.read())
+    current.setdefault('subs', ['me_irl'])
+    current.setdefault('threshold_upvotes', {'global': 1})
+    with open(utils.SETTINGS_PATH, 'w') as f:
+        f.write(json.dumps(current, indent=2))
+
+    db = storage.SQLiteStorage(os.path.join(workdir, 'replay.sqlite3'))
+    db.create_tables()
+    scrape_reddit.reddit_client = utils.Deferred(lambda: reddit or fakes.FakeReddit(), name='reddit')
+    return AutoMemer(
+        bot_id,
+        'CREPLAY',
+        'xoxb-replay',
+        db,
+        client=client or fakes.FakeSlackClient(latency=slack_latency),
+        clock=clock,
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('log', nargs='?', help='a comments.log file recorded by the bot')
+    parser.add_argument('--synthetic', type=float, metavar='RATE', help='generate RATE mentions per second instead')
+    parser.add_argument('--duration', type=float, default=30, help='length of synthetic traffic, in seconds')
+    parser.add_argument('--speedup', type=float, default=1.0, help='replay recorded traffic this many times faster')
+    parser.add_argument('--multiplier', type=int, default=1, help='send every batch this many times')
+    parser.add_argument('--settings', help='a settings.json to run the bot with')
+    parser.add_argument('--scraped', help='a scraped.json to run the bot with')
+    parser.add_argument('--slack-latency', type=float, default=0.0, help='seconds each fake slack call takes')
+    args = parser.parse_args()
+
+    if args.log:
+        batches = list(read_rtm_log(args.log))
+        bot_id = find_bot_id(batches) or 'UREPLAY'
+        schedule = recorded_schedule(batches)
+    elif args.synthetic:
+        bot_id = 'UREPLAY'
+        schedule = synthetic_schedule(bot_id, args.synthetic, args.duration)
+    else:
+        parser.error('pass a log to replay or --synthetic RATE')
+    schedule = amplify(schedule, args.multiplier)
+
+    settings = os.path.abspath(args.settings) if args.settings else None
+    scraped = os.path.abspath(args.scraped) if args.scraped else None
+    workdir = tempfile.mkdtemp(prefix='automemer-replay-')
+    try:
+        replay = Replay(make_bot(bot_id, workdir, settings, scraped, args.slack_latency), speedup=args.speedup)
+        print(f'replaying {sum(len(batch) for _, batch in schedule):,} events in {workdir}')
+        print(replay.report(replay.run(schedule)))
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,113 @@
+"""
+Adaptive scrape schedule for subs.
+
+Every time a sub is scraped, the number of posts created since its previous scrape is
+used to update an estimate of how fast the sub gets new posts (a moving average, in
+posts / minute). From that rate each sub gets its own interval and fetch depth:
+
+    interval = FILL * max_depth / rate    clamped to [min_interval, max_interval]
+    depth = rate * interval / FILL        clamped to [min_depth, max_depth]
+
+so a scrape is expected to see about FILL of its depth in new posts. Slow subs are
+scraped rarely and shallowly, and fast subs often and deeply enough that new posts
+don't fall out of the listing between scrapes. The scraper wakes up every
+TICK_MINUTES and only fetches the subs that are due.
+"""
+import math
+from collections import namedtuple
+
+
+TICK_MINUTES = 5
+# defaults for the min_scrape_interval_minutes, max_scrape_interval_minutes and
+# min_num_memes settings. num_memes is the maximum depth
+MIN_INTERVAL_MINUTES = 10
+MAX_INTERVAL_MINUTES = 240
+MIN_DEPTH = 10
+MAX_DEPTH = 50
+# interval of a sub that has never been scraped
+INITIAL_INTERVAL_MINUTES = 30
+# fraction of the depth a scrape should find to be new
+FILL = 0.5
+# weight of the newest observation in the rate moving average
+SMOOTHING = 0.5
+
+Bounds = namedtuple('Bounds', ['min_interval', 'max_interval', 'min_depth', 'max_depth'])
+
+
+def bounds(all_settings):
+    """Returns the Bounds allowed by every settings dict in all_settings, as loosely as any of them allows"""
+    return Bounds(
+        min(s.get('min_scrape_interval_minutes', MIN_INTERVAL_MINUTES) for s in all_settings),
+        max(s.get('max_scrape_interval_minutes', MAX_INTERVAL_MINUTES) for s in all_settings),
+        min(s.get('min_num_memes', MIN_DEPTH) for s in all_settings),
+        max(s.get('num_memes', MAX_DEPTH) for s in all_settings),
+    )
+
+
+def _clamp(value, low, high):
+    return max(low, min(high, value))
+
+
+def depth(row, limits):
+    """Returns how many posts of a sub to fetch, given its sub_schedule row (or None)"""
+    if row is None:
+        return limits.max_depth
+    return _clamp(row['depth'], limits.min_depth, limits.max_depth)
+
+
+def is_due(row, now, limits):
+    """Returns whether a sub with sub_schedule row (or None) should be scraped at time now"""
+    if row is None or row['last_scraped'] is None:
+        return True
+    interval = _clamp(row['interval_min'], limits.min_interval, limits.max_interval)
+    # scrapes only happen on ticks, so a sub due up to half a tick from now is scraped now
+    return now >= row['last_scraped'] + (interval - TICK_MINUTES / 2) * 60
+
+
+def update(sub, row, new_posts, now, limits, smoothing=SMOOTHING):
+    """
+    Returns the updated sub_schedule row of sub, as a tuple for `set_sub_schedules`
+    :param row: the sub's previous row, or None if it has never been scraped
+    :param new_posts: how many of the posts fetched were created since the previous scrape
+    :param now: the time of the scrape, in seconds since the epoch
+    """
+    if row is None or row['last_scraped'] is None:
+        # nothing to measure a rate against yet
+        return (sub, None, INITIAL_INTERVAL_MINUTES, limits.max_depth, now, new_posts)
+
+    minutes = max((now - row['last_scraped']) / 60, 1)
+    rate = new_posts / minutes
+    if row['rate'] is not None:
+        rate = smoothing * rate + (1 - smoothing) * row['rate']
+
+    if rate > 0:
+        interval = _clamp(FILL * limits.max_depth / rate, limits.min_interval, limits.max_interval)
+    else:
+        interval = limits.max_interval
+    new_depth = _clamp(int(math.ceil(rate * interval / FILL)), limits.min_depth, limits.max_depth)
+    return (sub, rate, interval, new_depth, now, new_posts)
+
+
+def skip(sub, now, limits):
+    """
+    Returns the sub_schedule row of a sub that can't be scraped (nsfw or private), as a
+    tuple for `set_sub_schedules`, so it is only checked again after the longest interval
+    """
+    return (sub, None, limits.max_interval, limits.min_depth, now, 0)
+
+
+def count_new(memes, row):
+    """Returns how many of memes (records.Meme) were created since the scrape recorded in row"""
+    if row is None or row['last_scraped'] is None:
+        return len(memes)
+    return sum(1 for meme in memes if (meme.created_utc or 0) > row['last_scraped'])
+
+
+def describe(row, now, limits):
+    """Returns a short human readable summary of a sub's schedule at time now"""
+    if row is None or row['last_scraped'] is None:
+        return 'not scraped yet'
+    interval = _clamp(row['interval_min'], limits.min_interval, limits.max_interval)
+    due_in = max(row['last_scraped'] + interval * 60 - now, 0) / 60
+    rate = f"{row['rate'] * 60:.1f} new/hour" if row['rate'] is not None else 'rate unknown'
+    return f"every {interval:.0f} min, {depth(row, limits)} posts, {rate}, next in {due_in:.0f} min"
@@ -1,178 +1,455 @@
 import json
+import queue
+import time
+from collections import namedtuple
 from datetime import datetime
 from multiprocessing import Lock
+from threading import Event
+from threading import Thread
 
-import praw
-import prawcore.exceptions
-from tqdm import tqdm
-
+import cache
+import circuit
+import fingerprint
+import profiling
+import ranking
+import records
+import scheduling
+import storage
+import transport
 import utils
 
 
-# loading praw agent
-reddit = praw.Reddit(
-    'automemer',
-    user_agent='Python/praw:automemer:v1.0 (by /u/AutoMemer)',
-)
+def _create_reddit():
+    # praw is slow to import, so it is only imported once a client is needed
+    import praw
+
+    return praw.Reddit(
+        'automemer',
+        user_agent='Python/praw:automemer:v1.0 (by /u/AutoMemer)',
+        requestor_kwargs={'session': transport.session.get()},
+    )
+
+
+# scraped posts are handed from the fetching thread to the database writer in chunks of
+# at most CHUNK_SIZE, with at most MAX_QUEUED_CHUNKS waiting at a time
+CHUNK_SIZE = 50
+MAX_QUEUED_CHUNKS = 4
+# how many subs are combined into one `a+b+c` listing with the multireddit fetch mode
+MULTIREDDIT_SIZE = 20
+
+# whether subs are nsfw, rechecked once a day
+subreddit_info_cache = cache.TTLCache(ttl=24 * 3600)
+
+# results of `details` / `link` lookups by url or by slack message, refreshed from reddit at most once a minute
+details_cache = cache.TTLCache(ttl=60)
+
+# the praw agent, created on first use (or ahead of time with `reddit_client.start()`)
+reddit_client = utils.Deferred(_create_reddit, name='reddit')
+
+
+def get_reddit():
+    """Returns the shared praw.Reddit instance, creating it if needed"""
+    return reddit_client.get()
+
+
+def reddit_errors():
+    """The exception types meaning reddit can't be reached (rather than e.g. a sub not existing)"""
+    import prawcore.exceptions
+
+    return prawcore.exceptions.RequestException, prawcore.exceptions.ServerError
+
+
+# held while a scrape runs, so a slow scrape isn't joined by more of them
+scrape_running = Lock()
+
+
+# a channel the scraped memes are fanned out to: its settings file, its pending store
+# and the lock guarding both, and its slack id (None for memes posted to any channel)
+Channel = namedtuple('Channel', ['settings_path', 'scraped_path', 'lock', 'channel_id'])
+# namedtuple's defaults argument is only available from python 3.7
+Channel.__new__.__defaults__ = (None,)
+
+
+def load_settings(channel):
+    """Returns the settings of channel as a dict, or None if they can't be read"""
+    channel.lock.acquire()
+    utils.log_usage('scrape - load settings - lock acquired')
+    try:
+        with open(channel.settings_path, mode='r', encoding='utf-8') as f:
+            return json.loads(f.read())
+    except OSError as e:
+        utils.log_error(e)
+        return None
+    finally:
+        channel.lock.release()
+        utils.log_usage('scrape - load settings - lock released')
+
+
+@profiling.profiled('scrape')
+def scrape(db, lock=Lock(), print_output=False, channels=None, force=False, now=None, shard=None):
+    """
+    Queries Praw to scrape subs according to preferences file(s). Every sub followed by
+    any of the channels is fetched once, and its new memes are added to the pending
+    store of each channel following it. Only the subs that are due according to their
+    adaptive schedule (see scheduling.py) are fetched, each to its own depth. Nothing is
+    done while another scrape is running or while reddit is unavailable (see circuit.py).
+    :param db: a storage.Storage object
+    :param lock: a multiprocessing.Lock object guarding db
+    :param print_output: whether to print progress
+    :param channels: a list of Channel, defaults to the single channel configured in
+    utils.SETTINGS_PATH / utils.SCRAPED_PATH, guarded by lock
+    :param force: whether to fetch every sub, whether it is due or not
+    :param now: the time of the scrape, in seconds since the epoch, defaults to now
+    :param shard: a function returning whether this process fetches a sub, when replicas
+    split the subs between them (see coordination.py). Defaults to fetching every sub
+    """
+    if not circuit.reddit.available():
+        utils.log_usage(f'scrape - skipped, {circuit.reddit.describe()}')
+        return
+    if not scrape_running.acquire(False):
+        utils.log_usage('scrape - skipped, the last scrape is still running')
+        return
+    try:
+        _scrape(db, lock, print_output, channels, force, now, shard)
+    finally:
+        scrape_running.release()
 
 
-def scrape(cursor, connection, lock=Lock(), print_output=False):
-    """Queries Praw to scrape subs according to preferences file"""
+def _scrape(db, lock, print_output, channels, force, now, shard):
+    channels = channels or [Channel(utils.SETTINGS_PATH, utils.SCRAPED_PATH, lock)]
     # loading in subreddit list
     if print_output:
         print('Loading settings')
     utils.log_usage('scrape - start')
-    lock.acquire()
-    utils.log_usage('scrape - load settings - lock acquired')
-    ok = False
+    # if the settings can't be read, log the error and fall back to the default sub of me_irl
+    all_settings = [load_settings(channel) or {} for channel in channels]
+    sub_names = set()
+    for settings in all_settings:
+        sub_names.update(name.lower() for name in settings.get('subs', ['me_irl']))
+    limits = scheduling.bounds(all_settings)
+    # scores are shared between channels, so the half-life is taken from the first one
+    half_life = all_settings[0].get('score_half_life_hours', ranking.HALF_LIFE_HOURS)
+
+    now = time.time() if now is None else now
+    with lock:
+        schedules = db.get_sub_schedules()
+    due = [
+        name for name in sorted(sub_names)
+        if (shard is None or shard(name)) and (force or scheduling.is_due(schedules.get(name), now, limits))
+    ]
+    utils.log_usage(f'scrape - {len(due)}/{len(sub_names)} subs due')
+    if not due:
+        return
+
+    reddit = get_reddit()
+    depths = {}  # filtered subs, specificaly for subs that aren't nsfw, and how many posts to fetch
+    skipped = []
     try:
-        with open('memes/settings.json', mode='r', encoding='utf-8') as f:
-            settings_str = f.read()
-        ok = True
-    except OSError as e:  # logging errors and loading default sub of me_irl
+        for name in due:
+            if is_nsfw(reddit, name):
+                skipped.append(name)
+            else:
+                depths[name] = scheduling.depth(schedules.get(name), limits)
+    except (circuit.CircuitOpen,) + reddit_errors() as e:
         utils.log_error(e)
-        subreddits = [reddit.subreddit('me_irl')]
-        NUM_MEMES = 50
-    finally:
-        lock.release()
-        utils.log_usage('scrape - load settings - lock released')
-    if ok:
-        settings = json.loads(settings_str)
-        sub_names = settings.get('subs', ['me_irl'])
-        all_subreddits = [reddit.subreddit(name) for name in sorted(list(sub_names))]
-        subreddits = []  # filtered subs, specificaly for subs that aren't nsfw
-        for sub in all_subreddits:
+        return
+    if skipped:
+        # otherwise they have no schedule, and are due again at every tick
+        with lock:
+            db.set_sub_schedules([scheduling.skip(name, now, limits) for name in skipped])
+    # combining subs into multireddits is opt in, since popular subs crowd quieter ones
+    # out of a combined listing
+    if any(settings.get('fetch_mode') == 'multireddit' for settings in all_settings):
+        group_size = MULTIREDDIT_SIZE
+    else:
+        group_size = 1
+    fetches = group_listings(reddit, depths, group_size)
+
+    utils.log_usage('scrape - praw queries - start')
+    # posts are fetched in a background thread and handed over in chunks through a
+    # bounded queue, so the database is updated while fetching continues and at most
+    # MAX_QUEUED_CHUNKS chunks are held in memory
+    chunks = queue.Queue(maxsize=MAX_QUEUED_CHUNKS)
+    stop = Event()
+    failed = set()
+    producer = Thread(target=fetch_chunks, args=(fetches, chunks, stop, failed, print_output, now))
+    producer.daemon = True
+    producer.start()
+
+    followed = [{name.lower() for name in settings.get('subs', ['me_irl'])} for settings in all_settings]
+    new_posts = {name: 0 for name in depths}
+    try:
+        while True:
+            item = chunks.get()
+            if item is None:
+                break
+            name, chunk = item
+            new_posts[name] += scheduling.count_new(chunk, schedules.get(name))
+            # update the database with lock acquired
+            lock.acquire()
+            utils.log_usage('scrape - update db - lock acquired')
             try:
-                if not sub.over18:
-                    subreddits.append(sub)
-            except prawcore.exceptions.Forbidden:
-                pass
-        NUM_MEMES = settings.get('num_memes', 50)
+                fingerprint.fingerprinter.flush(db)
+                new_memes, unhashed = store_memes(db, [chunk], half_life, now)
+                # urls already posted to each channel following the sub, which it shouldn't get again
+                urls = [meme.url for meme in new_memes]
+                posted = [
+                    db.get_posted_urls(urls, channel.channel_id) if name in subs else set()
+                    for channel, subs in zip(channels, followed)
+                ]
+            finally:
+                lock.release()
+                utils.log_usage('scrape - update db - lock released')
 
-    scraped_memes_path = 'memes/scraped.json'
+            # hash the new images in the background, to catch reposts before they're posted
+            fingerprint.fingerprinter.submit(unhashed)
 
-    utils.log_usage('scrape - praw queries - start')
-    # querying praw without lock acquired, because this takes a long time
-    reddit_memes = []
-    if print_output:
-        loop_tqdm = tqdm(total=len(subreddits) * NUM_MEMES, desc=f'sub 1/{len(subreddits)} post 1/{NUM_MEMES}')
-    for sub_i, sub in enumerate(subreddits):
-        sub_memes = []
-        for post_i, post in enumerate(sub.hot(limit=NUM_MEMES)):
-            if print_output:
-                loop_tqdm.update()
-                loop_tqdm.set_description(f'sub {sub_i + 1}/{len(subreddits)} post {post_i + 1}/{NUM_MEMES}')
-            data = {
-                'over_18': post.over_18,
-                'id': post.id,
-                'ups': post.ups,
-                'title': post.title,
-                'url': post.url,
-                'link': post.shortlink,
-                'highest_ups': post.ups,
-                'posted_to_slack': False,
-                'author': str(post.author),
-                'sub': post.subreddit.display_name,
-                'upvote_ratio': post.upvote_ratio,
-                'recorded': datetime.utcnow().isoformat(),
-                'created_utc': datetime.fromtimestamp(post.created_utc).isoformat(),
-                'last_updated': datetime.utcnow().isoformat(),
-            }
-            sub_memes.append(data)
-        reddit_memes.append(sub_memes)
+            # fan the new memes out to the pending stores of the channels following their sub
+            for channel, subs, posted_urls in zip(channels, followed, posted):
+                add_to_pending(channel, [
+                    meme for meme in new_memes if meme.sub.lower() in subs and meme.url not in posted_urls
+                ])
+    finally:
+        # if the consumer failed, unblock and stop the producer
+        stop.set()
+        producer.join()
     utils.log_usage('scrape - praw queries - end')
 
+    # retune the schedule of every sub that was fetched successfully
+    with lock:
+        db.set_sub_schedules([
+            scheduling.update(name, schedules.get(name), count, now, limits)
+            for name, count in new_posts.items() if name not in failed
+        ])
     if print_output:
         print()
-        print('updating database')
-    # update scraped list and database with lock acquired
-    lock.acquire()
-    utils.log_usage('scrape - update db - lock acquired')
-    try:
-        # load scraped memes
+
+
+def is_nsfw(reddit, name):
+    """Returns whether sub name is nsfw (or can't be read), checking with reddit at most once a day"""
+    import prawcore.exceptions
+
+    def check():
         try:
-            with open(scraped_memes_path, mode='r', encoding='utf-8') as scraped:
-                new_memes = json.loads(scraped.read())  # the memes we've scraped but not yet posted
-        except OSError as e:
-            utils.log_error(e)
-            new_memes = {}
-
-        # add scraped memes to our database and scraped.json file
-        for i, sub in enumerate(subreddits):
+            with circuit.reddit.guard(reddit_errors()):
+                return reddit.subreddit(name).over18
+        except prawcore.exceptions.Forbidden:
+            return True
+
+    return subreddit_info_cache.get_or_compute(name, check)
+
+
+def group_listings(reddit, depths, group_size=MULTIREDDIT_SIZE):
+    """
+    Groups subs into combined `a+b+c` listings of at most group_size subs each
+    :param depths: a dict of sub name -> how many of its posts to fetch
+    :return: a list of (praw subreddit, dict of sub name -> depth) tuples, one per listing
+    """
+    names = sorted(depths)
+    return [
+        (reddit.subreddit('+'.join(group)), {name: depths[name] for name in group})
+        for group in (names[i:i + group_size] for i in range(0, len(names), group_size))
+    ]
+
+
+def fetch_chunks(fetches, chunks, stop, failed, print_output=False, now=None):
+    """
+    Fetches the hot posts of every listing, putting them on chunks (a queue.Queue) as
+    (sub name, list of at most CHUNK_SIZE records.Meme) tuples, followed by None once
+    done. Blocks while the queue is full, and gives up early once stop (an Event) is set.
+    The posts of a combined listing are split back by sub, and each sub only gets as many
+    as its depth, so that a busy sub can't take another's share
+    :param fetches: a list of (praw subreddit, dict of sub name -> depth) tuples, from `group_listings`
+    :param failed: a set the names of subs that couldn't be fetched are added to
+    :param now: the time of the scrape, in seconds since the epoch, defaults to now
+    """
+    # the scrape's profile only covers its own thread, where this one's requests show up as waits
+    with profiling.profiler.profile('scrape-fetch', alongside=True):
+        _fetch_chunks(fetches, chunks, stop, failed, print_output, now)
+
+
+def _fetch_chunks(fetches, chunks, stop, failed, print_output, now):
+    def put(item):
+        while not stop.is_set():
+            try:
+                chunks.put(item, timeout=0.5)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    if print_output:
+        from tqdm import tqdm
+        loop_tqdm = tqdm(total=sum(sum(depths.values()) for _, depths in fetches), desc=f'listing 1/{len(fetches)}')
+    try:
+        for fetch_i, (listing, depths) in enumerate(fetches):
+            buffers = {name: [] for name in depths}
+            counts = dict.fromkeys(depths, 0)
+            try:
+                # once reddit is down, the remaining listings fail fast and are retried at the next scrape
+                with circuit.reddit.guard(reddit_errors()):
+                    for post in listing.hot(limit=sum(depths.values())):
+                        name = str(post.subreddit).lower()
+                        if counts.get(name, 0) >= depths.get(name, 0):
+                            continue  # over its quota, or not a sub that was asked for
+                        counts[name] += 1
+                        if print_output:
+                            loop_tqdm.update()
+                            loop_tqdm.set_description(f'listing {fetch_i + 1}/{len(fetches)}')
+                        buffers[name].append(records.Meme.from_post(post, now))
+                        if len(buffers[name]) >= CHUNK_SIZE:
+                            if not put((name, buffers[name])):
+                                return
+                            buffers[name] = []
+            except Exception as e:
+                # one listing failing shouldn't lose the rest of the scrape
+                utils.log_error(e)
+                failed.update(depths)
+            for name, chunk in buffers.items():
+                if chunk and not put((name, chunk)):
+                    return
+    finally:
+        put(None)
+
+
+def store_memes(db, reddit_memes, half_life=ranking.HALF_LIFE_HOURS, now=None):
+    """
+    Adds scraped memes to the database, or updates them if they've been seen before,
+    committing once at the end
+    :param db: a storage.Storage object
+    :param reddit_memes: a list with a list of records.Meme for each sub scraped
+    :param half_life: the score half-life, in hours
+    :param now: the time of the scrape, in seconds since the epoch, defaults to now
+    :return: a list of the sfw memes, which should be added to the pending stores of the
+    channels their url hasn't been posted to (see Storage.get_posted_urls), and the list of
+    those whose image hasn't been hashed yet
+    """
+    new_memes = []
+    unhashed = []
+    with db.transaction():
+        for sub_memes in reddit_memes:
+            # the cached details of these urls are out of date now
+            details_cache.invalidate_many(post.url for post in sub_memes)
             try:
-                for post in reddit_memes[i]:
-                    previous_data = utils.get_meme_data(cursor, post['id'])
-                    if not previous_data:  # this meme is new, add it to our list
-                        utils.add_meme_data(cursor, post, connection)
-                        if not post['over_18']:
+                # log this scrape's upvotes and update velocity / rank of every post
+                ranking.record_scores(db, sub_memes, now, half_life_hours=half_life)
+                for post in sub_memes:
+                    previous_row = db.get_meme_data(post.id)
+                    if not previous_row:  # this meme is new, add it to our list
+                        db.add_meme_data(post.to_row())
+                        if not post.over_18:
                             # if the meme is sfw then add it to scraped.json
-                            new_memes[post['url']] = post
+                            new_memes.append(post)
+                            unhashed.append(post)
                     else:
-                        # this meme is old, update data in SQLite
-                        previous_data['highest_ups'] = max(
-                            post.get('ups') or 1,
-                            previous_data.get('highest_ups') or 1,
-                            previous_data.get('ups') or 1,
+                        # this meme is old, update data in the database
+                        previous_data = records.Meme.from_row(previous_row)
+                        hashed = previous_row.get('phash') is not None
+                        previous_data.highest_ups = max(
+                            post.ups or 1,
+                            previous_data.highest_ups or 1,
+                            previous_data.ups or 1,
                         )
-                        previous_data['ups'] = post['ups']
-                        previous_data['upvote_ratio'] = post['upvote_ratio']
-                        previous_data['last_updated'] = post['last_updated']
-                        utils.update_meme_data(cursor, previous_data, connection)
-
-                        # if this url hasn't ever been posted, add it to the list
-                        if not (previous_data['over_18'] or
-                                utils.has_been_posted_to_slack(cursor, previous_data)):
-                            new_memes[post['url']] = post
+                        previous_data.ups = post.ups
+                        previous_data.upvote_ratio = post.upvote_ratio
+                        previous_data.last_updated = post.last_updated
+                        previous_row = previous_data.to_row()
+                        db.update_meme_data(previous_row)
+
+                        if not previous_data.over_18:
+                            new_memes.append(post)
+                            if not hashed:
+                                unhashed.append(post)
             except Exception as e:
                 utils.log_error(e)
+    return new_memes, unhashed
 
-        # update scraped memes file
-        with open(scraped_memes_path, mode='w', encoding='utf-8') as f:
-            f.write(json.dumps(new_memes, indent=2))
 
+def add_to_pending(channel, memes):
+    """
+    Adds memes to the pending store of channel, replacing older data for the same urls.
+    The store is only appended to; memes that are too old to be worth posting are
+    dropped when the bot next loads and compacts it
+    """
+    if not memes:
+        return
+    pending = records.PendingStore(channel.scraped_path)
+    channel.lock.acquire()
+    utils.log_usage('scrape - update pending - lock acquired')
+    try:
+        # other replicas may be writing to the store too
+        with pending.lock():
+            pending.append(memes)
+    except OSError as e:
+        utils.log_error(e)
     finally:
-        lock.release()
-        utils.log_usage('scrape - update db - lock released')
+        channel.lock.release()
+        utils.log_usage('scrape - update pending - lock released')
 
 
-def update_reddit_meme(cursor, connection, meme_url, lock):
+def update_reddit_meme(db, meme_url, lock):
     """
     Retrieves every meme matching the passed url, and queries Praw to update data.
-    Returns updated data
-    :param cursor: a database cursor object
-    :param connection: a database connection object
+    Returns updated data. The lock is only held while reading and writing the database,
+    not while waiting on reddit
+    :param db: a storage.Storage object
     :param meme_url: a url to match memes' stored urls with in the database
     :param lock: a multiprocessing.Lock object
     :return: a list of memes whose urls matched the passed
     """
-    lock.acquire()
     try:
-        matching_memes = utils.get_meme_data_from_url(cursor, meme_url)
-        for meme_data in matching_memes:
-            post = reddit.submission(id=meme_data['id'])
+        with lock:
+            matching_memes = db.get_meme_data_from_url(meme_url)
+        return refresh_memes(db, matching_memes, lock)
+    except Exception as e:
+        utils.log_error(e)
+
+
+def update_posted_meme(db, channel, ts, lock):
+    """
+    Like `update_reddit_meme`, for the meme posted to slack as message ts in channel
+    :return: a list with the meme, or an empty list if no meme was posted as that message
+    """
+    try:
+        with lock:
+            meme_data = db.get_posted_meme(channel, ts)
+        return refresh_memes(db, [meme_data] if meme_data else [], lock)
+    except Exception as e:
+        utils.log_error(e)
+
+
+def refresh_memes(db, memes, lock):
+    """Updates the upvotes of memes (posts rows) from reddit, in place and in db. Returns memes"""
+    with circuit.reddit.guard(reddit_errors()):
+        for meme_data in memes:
+            post = get_reddit().submission(id=meme_data['id'])
             meme_data['ups'] = post.ups
             meme_data['highest_ups'] = max(meme_data.get('highest_ups', 0), post.ups)
             meme_data['upvote_ratio'] = post.upvote_ratio
             meme_data['last_updated'] = datetime.utcnow().isoformat()
+    with lock:
+        with db.transaction():
+            for meme_data in memes:
+                db.update_meme_data(meme_data)
+    return memes
 
-            utils.update_meme_data(cursor, meme_data, connection)
 
-        return matching_memes
-    except Exception as e:
-        utils.log_error(e)
-    finally:
-        lock.release()
+def get_meme_details(db, meme_url, lock):
+    """
+    Like `update_reddit_meme`, but serves recent results from memory and shares one
+    refresh between concurrent lookups of the same url. The result must not be modified
+    """
+    return details_cache.get_or_compute(meme_url, lambda: update_reddit_meme(db, meme_url, lock))
 
 
-if __name__ == '__main__':
-    with open('db.json', 'r') as f:
-        db_info = json.loads(f.read())
-
-    conn = utils.get_connection(
-        db_info['user'],
-        db_info['password'],
-        db_info['db'],
-        db_info['host'],
+def get_posted_meme_details(db, channel, ts, lock):
+    """Like `get_meme_details`, for the meme posted to slack as message ts in channel"""
+    # scrapes only invalidate entries by url, these are at most a minute out of date
+    return details_cache.get_or_compute(
+        ('slack', channel, ts), lambda: update_posted_meme(db, channel, ts, lock),
     )
-    cursor = conn.cursor()
-    scrape(cursor, conn, print_output=True)
+
+
+if __name__ == '__main__':
+    utils.init()
+    scrape(storage.load_storage(), print_output=True, force=True)
@@ -0,0 +1,206 @@
+"""
+Runs the bot against fake Slack / Reddit clients on a virtual clock, to see how the
+scrape scheduler, the post queue and the lock behave over days of traffic in seconds.
+
+Instead of the bot's own loops (which wait on the clock), the simulation steps the same
+work itself and jumps the clock straight to the next thing that happens: a scrape tick,
+a post minute, a synthetic command, or the next second while there are messages to send.
+Every `--report-minutes` of virtual time it prints the messages sent, the backlog, the
+Reddit requests made and the lock statistics for that interval.
+
+    python3 simulate.py --hours 48 --subs me_irl dankmemes --posts-per-hour 6
+    python3 simulate.py --hours 24 --commands-per-hour 30 --settings memes/settings.json
+"""
+import argparse
+import datetime
+import itertools
+import json
+import math
+import os
+import shutil
+import tempfile
+import time
+
+import fakes
+import profiling
+import replay
+import scheduling
+import utils
+
+
+class VirtualClock(utils.Clock):
+    """A clock that only moves when told to. Waiting and sleeping move it instead of blocking"""
+
+    def __init__(self, start):
+        self.time = start
+
+    def now(self):
+        return self.time
+
+    def datetime(self):
+        return datetime.datetime.fromtimestamp(self.time)
+
+    def sleep(self, seconds):
+        self.time += seconds
+
+    def wait(self, event, timeout):
+        if event.is_set():
+            return True
+        self.sleep(timeout)
+        return event.is_set()
+
+    def advance_to(self, when):
+        self.time = max(self.time, when)
+
+
+class Simulation:
+    """Steps a bot made by `replay.make_bot` through virtual time"""
+
+    def __init__(self, bot, clock, reddit, commands_per_hour=0, commands=replay.SYNTHETIC_COMMANDS):
+        self.bot = bot
+        self.clock = clock
+        self.reddit = reddit
+        self.commands_per_hour = commands_per_hour
+        self.commands = itertools.cycle(commands)
+        self.intervals = []
+        self._sent = 0
+        bot.lock = profiling.TimedLock()
+
+    def _busy(self):
+        """Whether the command loop has anything to do in the next second"""
+        return self.bot.client.pending() or not self.bot.messages.empty() or not self.bot.outbox.empty()
+
+    def _push_command(self):
+        self._sent += 1
+        self.bot.client.push_events([{
+            'type': 'message',
+            'channel': self.bot.channel_id,
+            'user': f'U{self._sent % 50:04d}',
+            'text': f'<@{self.bot.bot_id}> {next(self.commands)}',
+            'ts': f'{self.clock.now():.6f}',
+        }])
+
+    def _handle_commands(self):
+        self.bot.handle_commands_once()
+        for t in list(self.bot._handlers):
+            t.join()
+
+    def run(self, hours, report_minutes=60):
+        start = self.clock.now()
+        end = start + hours * 3600
+        tick = scheduling.TICK_MINUTES * 60
+        next_scrape = math.floor(start / tick) * tick + tick
+        next_post = math.floor(start / 60) * 60 + 60
+        next_command = start + 3600 / self.commands_per_hour if self.commands_per_hour else math.inf
+        next_report = start + report_minutes * 60
+        self.bot.resume_outbox()
+        self._report(start)
+
+        started = time.perf_counter()
+        while True:
+            next_second = self.clock.now() + 1 if self._busy() else math.inf
+            when = min(next_scrape, next_post, next_command, next_report, next_second)
+            if when > end:
+                break
+            self.clock.advance_to(when)
+
+            if when == next_command:
+                self._push_command()
+                next_command += 3600 / self.commands_per_hour
+            if when == next_scrape:
+                self.bot.scrape().join()
+                next_scrape += tick
+            if when == next_post:
+                self.bot.post_to_slack_once()
+                next_post += 60
+            if when == next_second or self.bot.client.pending():
+                self._handle_commands()
+            if when == next_report:
+                self._report(when)
+                next_report += report_minutes * 60
+        self.bot.flush_delivered()
+        return time.perf_counter() - started
+
+    def _report(self, when):
+        """Records the totals so far, intervals are the differences between consecutive reports"""
+        total, postable = self.bot.count_memes()
+        lock = self.bot.lock.stats()
+        self.intervals.append({
+            'time': when,
+            'posted': len(self.bot.client.posted()),
+            'backlog': sum(total.values()),
+            'postable': sum(postable.values()),
+            'requests': self.reddit.requests,
+            'commands': self._sent,
+            'acquisitions': lock['acquisitions'],
+            'contended': lock['contended'],
+            'total_wait': lock['total_wait'],
+        })
+
+    def report(self, elapsed):
+        lines = [
+            f'{"time":<18}{"messages":>10}{"backlog":>9}{"postable":>10}{"requests":>10}'
+            f'{"commands":>10}{"locks":>8}{"waits":>7}{"wait ms":>9}',
+        ]
+        for previous, current in zip(self.intervals, self.intervals[1:]):
+            delta = {key: current[key] - previous[key] for key in current}
+            lines.append(
+                f'{time.strftime("%Y-%m-%d %H:%M", time.localtime(current["time"])):<18}'
+                f'{delta["posted"]:>10,d}{current["backlog"]:>9,d}{current["postable"]:>10,d}'
+                f'{delta["requests"]:>10,d}{delta["commands"]:>10,d}{delta["acquisitions"]:>8,d}'
+                f'{delta["contended"]:>7,d}{delta["total_wait"] * 1000:>9.1f}'
+            )
+        first, last = self.intervals[0], self.intervals[-1]
+        hours = (last['time'] - first['time']) / 3600
+        lines.extend([
+            '',
+            f'{hours:.1f} virtual hours in {elapsed:.1f}s ({hours * 3600 / max(elapsed, 1e-9):,.0f}x real time)',
+            f"sent {last['posted'] - first['posted']:,} messages, "
+            f"{last['requests'] - first['requests']:,} reddit requests, "
+            f"{last['commands'] - first['commands']:,} commands",
+        ])
+        return '\n'.join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--hours', type=float, default=24, help='virtual hours to simulate')
+    parser.add_argument('--start', help='the virtual start time, YYYY-MM-DD HH:MM, defaults to last midnight')
+    parser.add_argument('--subs', nargs='+', help='the subs to scrape, defaults to those in the settings')
+    parser.add_argument('--posts-per-hour', type=float, default=4, help='new posts per sub per hour on the fake reddit')
+    parser.add_argument('--commands-per-hour', type=float, default=0, help='synthetic commands sent per hour')
+    parser.add_argument('--report-minutes', type=float, default=60, help='virtual minutes per report line')
+    parser.add_argument('--settings', help='a settings.json to run the bot with')
+    parser.add_argument('--scraped', help='a scraped.json to run the bot with')
+    parser.add_argument('--seed', type=int, default=0, help='the fake reddit random seed')
+    args = parser.parse_args()
+
+    if args.start:
+        start = time.mktime(time.strptime(args.start, '%Y-%m-%d %H:%M'))
+    else:
+        start = time.mktime(datetime.date.today().timetuple())
+    clock = VirtualClock(start)
+    reddit = fakes.FakeReddit(posts_per_hour=args.posts_per_hour, seed=args.seed, now=clock.now)
+    client = fakes.FakeSlackClient(now=clock.now, sleep=clock.sleep)
+
+    settings = os.path.abspath(args.settings) if args.settings else None
+    scraped = os.path.abspath(args.scraped) if args.scraped else None
+    workdir = tempfile.mkdtemp(prefix='automemer-simulate-')
+    try:
+        bot = replay.make_bot('USIMULATE', workdir, settings, scraped, client=client, reddit=reddit, clock=clock)
+        if args.subs:
+            with open(utils.SETTINGS_PATH, 'r') as f:
+                current = json.loads(f.read())
+            current['subs'] = args.subs
+            with open(utils.SETTINGS_PATH, 'w') as f:
+                f.write(json.dumps(current, indent=2))
+        simulation = Simulation(bot, clock, reddit, args.commands_per_hour)
+        started = time.strftime('%Y-%m-%d %H:%M', time.localtime(start))
+        print(f'simulating {args.hours:g} hours from {started} in {workdir}')
+        print(simulation.report(simulation.run(args.hours, args.report_minutes)))
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,18 +1,29 @@
-import datetime
 import html
 import json
 import os
 import queue
+import re
+import signal
 import sys
 import time
 from collections import Counter
-from collections import defaultdict
 from multiprocessing import Lock
+from threading import Event
 from threading import Thread
 
-from slackclient import SlackClient
-
+import analytics
+import circuit
+import coordination
+import export
+import fingerprint
+import profiling
+import ranking
+import records
+import scheduling
 import scrape_reddit
+import snapshot
+import storage
+import transport
 import utils
 
 
@@ -20,16 +31,25 @@ class AutoMemer:
     bot_commands = {
         'add <sub>': 'Adds <sub> to the list of subreddits scraped',
         'delete <sub>': 'Deletes <sub> from the list of subreddits scraped',
-        'details <meme_url>': (
-            'Gives details for a meme if meme_url has been scraped',
+        'details {meme_url}': (
+            'Gives details for a meme if meme_url has been scraped. Without {meme_url}, sent in the '
+            'thread of a posted meme, gives details for that meme. Reacting to a posted meme with '
+            ':mag: does the same'
+        ),
+        'export {csv|ndjson|parquet} {subreddit} {since} {until} {posted|unposted}': (
+            'Exports the scraped memes to a file and uploads it. {since} and {until} are dates '
+            'in the form YYYY-MM-DD, every filter is optional and the format defaults to csv'
         ),
         'help': 'Prints a list of commands and short descriptions',
         'increase threshold <threshold> {optional_subreddit}': (
             'Sets threshold for {optional_subreddit} to the old threshold + '
             'or - the <threshold> value passed. Defaults to global'
         ),
-        'kill': 'Kills automemer. Program is stopped, no scraping, no posting',
-        'link <url>': 'Prints the link associated with the url passed',
+        'kill': (
+            'Kills automemer. Queued messages are sent and its state is saved, then the program '
+            'is stopped, no scraping, no posting'
+        ),
+        'link {url}': 'Prints the link associated with the url passed, or with the meme whose thread it is sent in',
         'list settings': 'Prints out all settings',
         'list subreddits': 'Prints a list of subreddits currently being scraped',
         'list thresholds': 'Prints the thresholds for subs',
@@ -39,65 +59,227 @@ class AutoMemer:
             'breakdown by subreddit use `num-memes by_sub`'
         ),
         'pop {num}': 'pops {num} memes (or as many as there are) from the queue',
+        'stats {days}': (
+            'Prints upvote percentiles, thresholds and the projected number of postable memes a day '
+            'for each subreddit, over the memes scraped in the last {days} (default 14) days'
+        ),
+        'suggest thresholds {memes_per_day}': (
+            'Suggests thresholds that would give about {memes_per_day} postable memes a day, shared '
+            'equally between the subreddits. Defaults to the target_memes_per_day setting, or one per post interval'
+        ),
+        'profile <on|off|status>': (
+            'Turns profiling of scrapes, pops and commands on or off. While on, a summary of '
+            'the slowest functions is posted in the thread `profile on` was sent in. `profile status` '
+            'also shows how long requests to slack and reddit are taking'
+        ),
+        'search <terms> {in <subreddit>} {page <n>}': (
+            'Finds the scraped memes with <terms> in their title, best matches first, '
+            'optionally only from <subreddit>. Results come 10 at a time, `page <n>` shows the nth 10'
+        ),
         'set threshold <threshold> {optional_subreddit}': (
             'Sets threshold upvotes a meme must meet to be scraped. If '
             '{optional_subreddit} is specified, sets <threshold> specifically '
             'for that sub, otherwise a global threshold is set (applied to '
             'subs without a specific threshold)'
         ),
-        'scrape reddit': 'manually starts a reddit scrape, which usually occurs every 30 minutes',
+        'scrape reddit': (
+            'manually scrapes every subreddit, which otherwise are each scraped on their own schedule '
+            f'(checked every {scheduling.TICK_MINUTES} minutes)'
+        ),
     }
 
+    # how many times posting a meme is tried, and how many deliveries are recorded at once
+    OUTBOX_ATTEMPTS = 5
+    OUTBOX_BATCH = 10
+    # how many times posting a reply is tried
+    MESSAGE_ATTEMPTS = 5
+    # search results per page
+    SEARCH_PAGE_SIZE = 10
+    # reactions to a posted meme that ask for its details
+    DETAILS_REACTIONS = ('mag', 'mag_right')
+    # commands handled at once, more are turned away until some finish
+    MAX_COMMAND_THREADS = 8
+    # the dependencies (see circuit.py) of commands, which are answered straight away while one is down
+    command_dependencies = (
+        ('details', (circuit.reddit, circuit.database)),
+        ('export', (circuit.database,)),
+        ('link', (circuit.reddit, circuit.database)),
+        ('scrape reddit', (circuit.reddit,)),
+        ('search', (circuit.database,)),
+        ('stats', (circuit.database,)),
+        ('suggest thresholds', (circuit.database,)),
+    )
+
     def __init__(
-        self, bot_id, channel_id, bot_token, dbuser, dbpassword,
-        dbname, dbhost, debug=False,
+        self, bot_id, channel_id, bot_token, db, debug=False, fast_start=False,
+        settings_path=utils.SETTINGS_PATH, scraped_path=utils.SCRAPED_PATH, scraper=None, client=None,
+        snapshot_path=utils.SNAPSHOT_DIR, clock=None, coordinator=None,
     ):
+        """
+        :param db: a storage.Storage object, or a function returning one
+        :param fast_start: if True the user directory, reddit client and database are
+        set up in background threads, so the bot can connect and answer commands
+        straight away. Otherwise they are set up before __init__ returns
+        :param settings_path: the settings file of this bot's channel
+        :param scraped_path: the pending store of this bot's channel
+        :param scraper: a function scraping reddit for this bot, used when one process
+        serves several channels. Defaults to scraping this channel's subs only
+        :param client: the slack client to use, defaults to a transport.PooledSlackClient for bot_token
+        :param snapshot_path: where `shutdown` saves the bot's state, which is loaded back here
+        :param clock: a utils.Clock telling the bot the time and how to wait, defaults to the wall clock
+        :param coordinator: a coordination.Coordinator when several replicas of the bot run
+        at once, in which case only the leader posts and answers commands
+        """
+        utils.init()
         self.bot_id = bot_id
         self.at_bot = '<@' + bot_id + '>'
         self.channel_id = channel_id
-        self.client = SlackClient(bot_token)
+        self.client = client or transport.PooledSlackClient(bot_token)
         self.messages = queue.Queue()
+        # (meme id, message, attempts) of memes picked to be posted, backed by the outbox table
+        self.outbox = queue.Queue()
+        self._delivered = []
+        self.settings_path = settings_path
+        self.scraped_path = scraped_path
+        self.pending = records.PendingStore(scraped_path)
+        self.scraper = scraper
         self.lock = Lock()
         self.debug = debug
-        self.users_list = self.client.api_call('users.list')
+        self.snapshot_path = snapshot_path
+        self.clock = clock or utils.Clock()
+        self.coordinator = coordinator
+        # whether this replica posts and answers commands, see `_follow_leadership`
+        self.leading = coordinator is None
+        self.stopping = Event()
+        self._handlers = set()  # command handling threads that are still running
+        profiling.profiler.add_listener(self.post_profile_summary)
 
-        self.conn = utils.get_connection(dbuser, dbpassword, dbname, dbhost)
-        self.cursor = self.conn.cursor()
+        self._users_list = utils.Deferred(self._fetch_users_list, name='users.list')
+        self._db = utils.Deferred(db if callable(db) else lambda: db, name='db')
+        # used to open extra connections, e.g. for exports, when db is a factory
+        self._db_factory = db if callable(db) else None
+        if self.load_snapshot():
+            # serve the snapshot's users until they've been refetched
+            Thread(target=self._refresh_users_list, daemon=True).start()
+        if fast_start:
+            self._users_list.start()
+            self._db.start()
+            scrape_reddit.reddit_client.start()
+        else:
+            self._users_list.get()
+            self._db.get()
 
+        utils.ensure_json_file(settings_path)
+        utils.ensure_json_file(scraped_path)
         # how often to post to slack
         self.post_to_slack_interval = self.load_post_to_slack_interval()
 
-        # creating directories and files
-        os.makedirs('memes', exist_ok=True)
-        if not os.path.isfile(utils.SCRAPED_PATH):
-            file = open(utils.SCRAPED_PATH, 'x')
-            file.write(json.dumps({}))
-            file.close()
-        if not os.path.isfile(utils.SETTINGS_PATH):
-            file = open(utils.SETTINGS_PATH, 'x')
-            file.write(json.dumps({}))
-            file.close()
-
         utils.log_usage('Running init')
 
-    @staticmethod
-    def current_time_as_min():
-        now = datetime.datetime.now()
+    def load_snapshot(self):
+        """
+        Restores the state saved by `shutdown`, if there is a snapshot. The index of posted
+        images is only used if the database hasn't changed since. Returns whether there was one
+        """
+        started = time.perf_counter()
+        saved = snapshot.Snapshot.load(self.snapshot_path)
+        if saved is None:
+            return False
+        if saved.users_list is not None:
+            self._users_list.set(saved.users_list)
+        for msg in saved.messages:
+            self.messages.put(msg)
+        snapshot.Snapshot.clear_messages(self.snapshot_path)
+        fingerprint.fingerprinter.seed(saved.posted, (len(saved.posted_ids), saved.posted_checksum))
+        utils.log_usage(
+            f'load_snapshot - {len(saved.messages)} messages, {len(saved.posted_ids)} posted images '
+            f'from {self.snapshot_path} in {time.perf_counter() - started:.3f}s'
+        )
+        return True
+
+    def _fetch_users_list(self):
+        users_list = self.client.api_call('users.list')
+        if not users_list.get('ok'):
+            raise RuntimeError(f"users.list failed: {users_list.get('error')}")
+        return users_list
+
+    def _refresh_users_list(self):
+        try:
+            self._users_list.set(self._fetch_users_list())
+        except Exception as e:
+            utils.log_error(e)
+
+    def stop(self):
+        """Asks the bot to shut down, `run` then returns once `shutdown` is done"""
+        self.stopping.set()
+
+    def shutdown(self, timeout=30):
+        """
+        Waits (up to timeout seconds) for running commands to finish and for the outgoing
+        messages to be sent, then saves what is left and the in-memory state to a snapshot
+        """
+        utils.log_usage('shutdown - start')
+        deadline = time.time() + timeout
+        while time.time() < deadline and (
+            any(t.is_alive() for t in list(self._handlers)) or not self.messages.empty() or not self.outbox.empty()
+        ):
+            self.pop_queue()
+            # same rate limit as handle_commands_repeatedly
+            time.sleep(1)
+        # memes still in the outbox are resumed from the database on the next start
+        self.flush_delivered()
+
+        unsent = []
+        while not self.messages.empty():
+            unsent.append(self.messages.get())
+        posted = fingerprint.fingerprinter.posted_items()
+        snapshot.Snapshot(
+            users_list=self.users_list,
+            messages=unsent,
+            posted_ids=[meme_id for meme_id, _ in posted],
+            posted_hashes=[value for _, value in posted],
+            posted_checksum=fingerprint.checksum(value for _, value in posted),
+        ).save(self.snapshot_path)
+        utils.log_usage(f'shutdown - saved {len(unsent)} unsent messages and {len(posted)} posted images')
+
+    @property
+    def db(self):
+        """The bot's storage.Storage, waiting for it to be opened if needed"""
+        return self._db.get()
+
+    @property
+    def channel(self):
+        """This bot's channel, as scrape_reddit.scrape fans memes out to it"""
+        return scrape_reddit.Channel(self.settings_path, self.scraped_path, self.lock, self.channel_id)
+
+    @property
+    def users_list(self):
+        """The users.list response, or None while it is still being fetched (or retried after failing)"""
+        return self._users_list.get(block=False)
+
+    def current_time_as_min(self):
+        now = self.clock.datetime()
         midnight = now.replace(hour=0, minute=0, second=0, microsecond=0)
         return (now - midnight).seconds // 60
 
-    def run(self):
+    def run(self, scrape_repeatedly=True):
+        """
+        Connects to slack and runs the bot until one of its threads dies
+        :param scrape_repeatedly: whether this bot scrapes reddit on its own schedule. When
+        several bots share a scraper only one of them should
+        """
         utils.log_usage('run()')
         if self.client.rtm_connect():
-            print('AutoMemer connected and running!')
+            print(f'AutoMemer connected and running in {self.channel_id}!')
             utils.log_usage('run() - self.client.rtm_connect()')
 
-            # scraping thread, which scrapes reddit every 30 minutes
+            # scraping thread, which scrapes the subs that are due every scheduling.TICK_MINUTES
             t_scrape = Thread(
                 target=self.scrape_repeatedly,
             )
             t_scrape.daemon = True
-            t_scrape.start()
+            if scrape_repeatedly:
+                t_scrape.start()
 
             # command handling thread, which handles slack queries and
             # posts memes once per second
@@ -115,66 +297,126 @@ class AutoMemer:
             t_post.daemon = True
             t_post.start()
 
-            # continue execution while all 3 threads are still active
-            while t_scrape.is_alive() and t_command.is_alive() and t_post.is_alive():
-                time.sleep(1 * 60)
+            # continue execution while all 3 threads are still active, or until stopped
+            while (t_scrape.is_alive() or not scrape_repeatedly) and t_command.is_alive() and t_post.is_alive():
+                if self.clock.wait(self.stopping, 1 * 60):
+                    break
 
             print(
                 f't_scrape.is_alive = {t_scrape.is_alive()}, '
                 f't_command.is_alive = {t_command.is_alive()}, '
                 f't_post.is_alive = {t_post.is_alive()}',
             )
+            if self.stopping.is_set():
+                self.shutdown()
         else:
             print('Connection failed. Invalid Slack token or bot ID?')
 
     def scrape_repeatedly(self):
-        """Scrapes reddit forever, once per interval, until the thread is killed"""
-        # sleep until it is an interval of 30 minutes
+        """
+        Scrapes reddit forever, until the thread is killed. Wakes up every
+        scheduling.TICK_MINUTES, and each scrape only fetches the subs that are due
+        """
+        tick = scheduling.TICK_MINUTES
+        # sleep until it is an interval of the tick
         cur_time = self.current_time_as_min()
-        time.sleep((30 - (cur_time % 30)) * 60)
+        if self.clock.wait(self.stopping, (tick - (cur_time % tick)) * 60):
+            return
         while True:
             # scrape reddit
-            t = Thread(
-                target=scrape_reddit.scrape,
-                args=(self.cursor, self.conn, self.lock),
-            )
-            t.daemon = True
-            t.start()
+            self.scrape()
 
-            # sleep for 30 minutes
-            time.sleep(30 * 60)
+            if self.clock.wait(self.stopping, tick * 60):
+                return
+
+    def scrape(self, force=False):
+        """
+        Starts a reddit scrape in a daemon thread
+        :param force: whether to fetch every sub, rather than only those that are due
+        """
+        t = Thread(target=self.scraper or self._scrape_channel, kwargs={'force': force})
+        t.daemon = True
+        t.start()
+        return t
+
+    def _scrape_channel(self, force=False):
+        scrape_reddit.scrape(
+            self.db, self.lock, channels=[self.channel], force=force, now=self.clock.now(),
+            shard=self.coordinator.owns if self.coordinator else None,
+        )
 
     def handle_commands_repeatedly(self):
         """
         Handles all commands from slack forever (until killed), and posts memes
         at most once per second when there are any
         """
-        while True:
-            slack_outputs = self.parse_slack_output(self.client.rtm_read())
-            for output in slack_outputs:
-                # handle all the commands
-                t = Thread(
-                    target=self.handle_command,
-                    args=(output,),
-                )
-                t.daemon = True
-                t.start()
-
-            # pop a meme if there is one
-            self.pop_queue()
+        if self.leading:
+            self.resume_outbox()
+        while not self.stopping.is_set():
+            self.handle_commands_once()
 
             # sleep for 1 second to rate limit slack api queries
-            time.sleep(1)
+            self.clock.sleep(1)
+
+    def handle_commands_once(self):
+        """Starts a thread handling each new command from slack, and posts a message if there is one"""
+        self._follow_leadership()
+        slack_outputs = self.parse_slack_output(self.client.rtm_read())
+        if not self.leading:
+            # a standby only keeps its connection open, the leader answers
+            return
+        self._handlers = {t for t in self._handlers if t.is_alive()}
+        for output in slack_outputs:
+            if len(self._handlers) >= self.MAX_COMMAND_THREADS and output.get('@mention', '').lower() != 'kill':
+                # while commands are stuck (e.g. on the lock) don't keep adding threads behind them
+                if '@mention' in output:
+                    self._reply(output, f">{output['@mention']}\nI'm busy with other commands, try again in a minute")
+                continue
+            # handle all the commands
+            t = Thread(
+                target=self.handle_command,
+                args=(output,),
+            )
+            t.daemon = True
+            t.start()
+            self._handlers.add(t)
+
+        # pop a meme if there is one
+        self.pop_queue()
+
+    def _follow_leadership(self):
+        """
+        Takes over the outbox when this replica becomes the leader, and hands it back (to
+        the database) when it stops being the leader
+        """
+        if self.coordinator is None or self.coordinator.is_leader() == self.leading:
+            return
+        self.leading = not self.leading
+        utils.log_usage(f"leadership - {'leading' if self.leading else 'standing by'} in {self.channel_id}")
+        if self.leading:
+            # deliver what the last leader picked but didn't get to
+            self.resume_outbox()
+        else:
+            # the undelivered memes are still in the outbox table, for the next leader
+            self.flush_delivered()
+            while not self.outbox.empty():
+                self.outbox.get_nowait()
 
     def post_to_slack_repeatedly(self):
         """Adds memes to our post queue once per post interval, forever (until killed)"""
-        while True:
-            cur_time = self.current_time_as_min()
-            if cur_time % self.post_to_slack_interval == 0 and cur_time >= 60 * 9:
-                self.add_new_memes_to_queue()
+        while not self.stopping.is_set():
+            self.post_to_slack_once()
 
             # sleep 1 minute
-            time.sleep(1 * 60)
+            self.clock.wait(self.stopping, 1 * 60)
+
+    def post_to_slack_once(self):
+        """Adds memes to our post queue if it is time to, returns whether it was"""
+        cur_time = self.current_time_as_min()
+        if self.leading and cur_time % self.post_to_slack_interval == 0 and cur_time >= 60 * 9:
+            self.add_new_memes_to_queue()
+            return True
+        return False
 
     def handle_command(self, output):
         """
@@ -186,11 +428,18 @@ class AutoMemer:
         if command is None:
             return
 
+        with profiling.profiler.profile('handle_command'):
+            self._respond_to_command(output, command)
+
+    def _respond_to_command(self, output, command):
         utils.log_usage('handle_command')
         response = f'>{command}\n'
         command = command.lower()
+        down = self._unavailable_dependency(command)
         # specific command responses
-        if command.startswith('add'):
+        if down is not None:
+            response += f"{down.name} isn't responding, try again in {max(down.retry_in(), 1):.0f}s"
+        elif command.startswith('add'):
             response += self._command_add_sub(output)
         elif command.startswith('delete') or command.startswith('remove'):
             response += self._command_delete_sub(output)
@@ -198,6 +447,8 @@ class AutoMemer:
             response += self._command_details(output)
         elif command == 'help':
             response += self._command_help()
+        elif command.startswith('export'):
+            response += self._command_export(output)
         elif command.startswith('increase threshold'):
             response += self._command_set_threshold(output, mode='+')
         elif command.startswith('list thresholds'):
@@ -208,6 +459,8 @@ class AutoMemer:
             response += self._command_list_settings()
         elif command == 'list subreddits':
             response += self._command_list_subs()
+        elif command.startswith('search'):
+            response += self._command_search(output)
         elif command.startswith('set threshold'):
             response += self._command_set_threshold(output)
         elif command.startswith('set post interval'):
@@ -221,12 +474,16 @@ class AutoMemer:
                 response += reply
         elif command.startswith('num-memes'):
             response += self._command_num_memes(output)
+        elif command.startswith('profile'):
+            response += self._command_profile(output)
+        elif command.startswith('stats'):
+            response += self._command_stats(output)
+        elif command.startswith('suggest thresholds'):
+            response += self._command_suggest_thresholds(output)
         elif command == 'kill':
-            self.client.api_call(
-                'chat.postMessage', channel=MEME_SPAM_CHANNEL,
-                text='have it your way', as_user=True,
-            )
-            sys.exit(0)
+            # sent while shutting down, along with anything else still queued
+            response = 'have it your way'
+            self.stop()
         elif command.startswith('echo '):
             response = ''.join(output.get('@mention').split()[1:])
         elif 'less memes' in command:
@@ -234,12 +491,7 @@ class AutoMemer:
         elif 'fewer time' in command:
             response = '*less'
         elif command == 'scrape reddit':
-            t = Thread(
-                target=scrape_reddit.scrape,
-                args=(self.cursor, self.conn, self.lock),
-            )
-            t.daemon = True
-            t.start()
+            self.scrape(force=True)
             response = '+:+1:'
         else:  # a default response
             response = (
@@ -247,7 +499,10 @@ class AutoMemer:
                 .format(command)
             )
 
-        # construct the response
+        self._reply(output, response)
+
+    def _reply(self, output, response):
+        """Queues response to be posted in the thread of output"""
         msg = {
             'channel': output['channel'],
             'text': response,
@@ -259,10 +514,17 @@ class AutoMemer:
             msg['thread_ts'] = output['ts']
         self.messages.put(msg)
 
+    def _unavailable_dependency(self, command):
+        """Returns the breaker of a dependency command needs that is down, if there is one"""
+        for prefix, breakers in self.command_dependencies:
+            if command.startswith(prefix):
+                return next((breaker for breaker in breakers if not breaker.available()), None)
+        return None
+
     def load_post_to_slack_interval(self):
         self.lock.acquire()
         try:
-            with open(utils.SETTINGS_PATH, mode='r', encoding='utf-8') as f:
+            with open(self.settings_path, mode='r', encoding='utf-8') as f:
                 settings = f.read()
             settings = json.loads(settings)
             interval = settings['scrape_interval']
@@ -273,6 +535,7 @@ class AutoMemer:
         finally:
             self.lock.release()
 
+    @profiling.profiled('add_new_memes_to_queue')
     def add_new_memes_to_queue(self, limit=None, user_prompt=False):
         utils.log_usage(f'add_new_memes_to_queue(limit={limit}, user_prompt={user_prompt})')
         _, postable = self.count_memes()
@@ -281,64 +544,76 @@ class AutoMemer:
         utils.log_usage(f'add_new_memes_to_queue - postable_memes={sum(postable.values())}, limit={limit}')
         self.lock.acquire()
         try:
-            with open(utils.SCRAPED_PATH, mode='r', encoding='utf-8') as f:
-                scraped = f.read()
-            scraped_memes = json.loads(scraped)
-            with open(utils.SETTINGS_PATH, mode='r', encoding='utf-8') as f:
-                settings = json.loads(f.read())
-            thresholds = settings['threshold_upvotes']
-            memes_by_sub = defaultdict(list)
-            for post, data in sorted(
-                list(scraped_memes.items()),
-                key=lambda x: x[1]['created_utc'],
-            ):
-                memes_by_sub[data['sub']].append(data)
-
-            list_of_subs = list(memes_by_sub.keys())
-            sub_ind = 0
-            while limit > 0 and any(memes_by_sub.values()):
-                # while we haven't reached the limit and have more memes to post
-                sub = list_of_subs[sub_ind]
-                sub_threshold = thresholds.get(sub.lower(), thresholds['global'])
-                while memes_by_sub[sub]:  # while there are memes from this sub
-                    meme = memes_by_sub[sub].pop(0)
-                    del scraped_memes[meme['url']]
-                    ups = int(meme.get('highest_ups'))
-                    if ups > sub_threshold:
-                        utils.set_posted_to_slack(
-                            self.cursor,
-                            meme['id'],
-                            self.conn,
-                            True,
-                        )
-
-                        limit -= 1
-                        meme_text = (
-                            '*{title}* _(from /r/{sub})_ `{ups:,d}`\n{url}'
-                            .format(
-                                title=meme.get('title').strip('*'),
-                                sub=sub.strip('_'),
-                                ups=ups,
-                                url=meme['url'],
+            # other replicas may append to the store until it is written back, see PendingStore.lock
+            with self.pending.lock():
+                scraped_memes = self.pending.load()
+                loaded_urls = set(scraped_memes)
+                with open(self.settings_path, mode='r', encoding='utf-8') as f:
+                    settings = json.loads(f.read())
+                thresholds = settings['threshold_upvotes']
+                fingerprint.fingerprinter.flush(self.db)
+                ranking.prune(
+                    scraped_memes,
+                    now=self.clock.now(),
+                    max_age_hours=settings.get('max_backlog_age_hours', ranking.MAX_BACKLOG_AGE_HOURS),
+                )
+                # hottest memes of each sub first
+                memes_by_sub = ranking.heaps_by_sub(scraped_memes.values())
+
+                list_of_subs = list(memes_by_sub.keys())
+                sub_ind = 0
+                picked = []
+                # (id, image hash) of the picked memes that have one, to check the next ones against
+                picked_hashes = []
+                while limit > 0 and any(memes_by_sub.values()):
+                    # while we haven't reached the limit and have more memes to post
+                    sub = list_of_subs[sub_ind]
+                    sub_threshold = thresholds.get(sub.lower(), thresholds['global'])
+                    while memes_by_sub[sub]:  # while there are memes from this sub
+                        meme = ranking.pop_best(memes_by_sub[sub])
+                        del scraped_memes[meme.url]
+                        ups = int(meme.highest_ups)
+                        if ups > sub_threshold:
+                            value = fingerprint.fingerprinter.image_hash(self.db, meme.id)
+                            duplicates = fingerprint.fingerprinter.find_posted_duplicates(
+                                self.db, meme.id, value, picked=picked_hashes,
                             )
-                        )
-                        self.messages.put({
-                            'channel': MEME_SPAM_CHANNEL,
-                            'text': meme_text,
-                        })
-                        break
-                sub_ind = (sub_ind + 1) % len(list_of_subs)
-
-            with open(utils.SCRAPED_PATH, mode='w', encoding='utf-8') as f:
-                f.write(json.dumps(scraped_memes, indent=2))
+                            if duplicates:
+                                utils.log_usage(f'add_new_memes_to_queue - {meme.id} is a repost of {duplicates}')
+                                continue
+                            if value is not None:
+                                picked_hashes.append((meme.id, value))
+
+                            limit -= 1
+                            meme_text = (
+                                '*{title}* _(from /r/{sub})_ `{ups:,d}`\n{url}'
+                                .format(
+                                    title=meme.title.strip('*'),
+                                    sub=sub.strip('_'),
+                                    ups=ups,
+                                    url=meme.url,
+                                )
+                            )
+                            picked.append((meme.id, meme.url, {
+                                'channel': self.channel_id,
+                                'text': meme_text,
+                            }))
+                            break
+                    sub_ind = (sub_ind + 1) % len(list_of_subs)
+
+                # only once they're committed, so a failed transaction doesn't leave them in the index
+                for meme_id in self.enqueue_memes(picked):
+                    fingerprint.fingerprinter.mark_posted(self.db, meme_id)
+                # the popped and pruned memes
+                self.pending.remove(loaded_urls.difference(scraped_memes), scraped_memes)
             if limit > 0 and user_prompt:
                 self.messages.put({
-                    'channel': MEME_SPAM_CHANNEL,
+                    'channel': self.channel_id,
                     'text': 'Sorry, we ran out of memes :(',
                 })
         except Exception as e:
             self.messages.put({
-                'channel': MEME_SPAM_CHANNEL,
+                'channel': self.channel_id,
                 'text': (
                     'There was an error :sadparrot:\n'
                     '>`{}`'.format(str(e))
@@ -348,17 +623,137 @@ class AutoMemer:
         finally:
             self.lock.release()
 
+    def post_profile_summary(self, name, path, summary, reply_to):
+        """Posts a profile summary into the thread profiling was turned on from, if any"""
+        if reply_to is None or reply_to[:2] != (self.bot_id, self.channel_id):
+            return
+        _, channel, thread_ts = reply_to
+        self.messages.put({
+            'channel': channel,
+            'thread_ts': thread_ts,
+            'text': f'`{path}`\n```\n{summary}\n```',
+        })
+
     def pop_queue(self):
+        """
+        Sends the next queued reply, or else the next meme in the outbox. Nothing is sent
+        while slack is unavailable, messages wait in their queues until it is back. A reply
+        that fails is requeued, up to MESSAGE_ATTEMPTS times
+        """
+        if not circuit.slack.available():
+            return
         if not self.messages.empty():
             msg = self.messages.get()
-            if not self.debug:
-                self.client.api_call('chat.postMessage', **msg, as_user=True)
-            else:
-                msg['api'] = 'chat.postMessage'
-                msg['as_user'] = True
-                msg['time'] = datetime.datetime.now().isoformat(),
-                with open(utils.SLACK_LOG_FILE, 'a') as f:
-                    f.write(json.dumps(msg, indent=2) + ',\n')
+            # how many times it has failed so far, kept in the queued message
+            attempts = msg.pop('_attempts', 0)
+            try:
+                self._post_message(msg)
+            except circuit.CircuitOpen:
+                # not an attempt, slack wasn't even tried
+                self.messages.put(dict(msg, _attempts=attempts))
+            except Exception as e:
+                utils.log_error(e)
+                if attempts + 1 < self.MESSAGE_ATTEMPTS:
+                    self.messages.put(dict(msg, _attempts=attempts + 1))
+                else:
+                    utils.log_usage(f"pop_queue - giving up on a message to {msg.get('channel')}: {e}")
+        elif not self.outbox.empty():
+            self.deliver_outbox()
+
+    def _post_message(self, msg):
+        """Posts msg, returning slack's response (a fake successful one in debug mode)"""
+        if not self.debug:
+            with circuit.slack.guard(transport.unavailable_errors()):
+                response = self.client.api_call('chat.postMessage', **msg, as_user=True)
+                if transport.is_unavailable(response):
+                    raise transport.Unavailable(response['error'])
+                return response
+        msg = dict(msg)
+        msg['api'] = 'chat.postMessage'
+        msg['as_user'] = True
+        msg['time'] = self.clock.datetime().isoformat(),
+        with open(utils.SLACK_LOG_FILE, 'a') as f:
+            f.write(json.dumps(msg, indent=2) + ',\n')
+        return {'ok': True, 'ts': None}
+
+    def enqueue_memes(self, picked):
+        """
+        Marks memes as posted and queues their messages in the outbox, in one transaction
+        :param picked: a list of (meme id, url, chat.postMessage arguments) tuples
+        :return: the ids of the memes queued, leaving out those that already were
+        """
+        if not picked:
+            return []
+        now = self.clock.now()
+        with self.db.transaction():
+            # memes already in the outbox were picked before a crash, before the pending store was saved
+            queued = self.db.get_outboxed(self.channel_id, [meme_id for meme_id, _, _ in picked])
+            picked = [(meme_id, url, msg) for meme_id, url, msg in picked if meme_id not in queued]
+            self.db.set_many_posted_to_slack([meme_id for meme_id, _, _ in picked])
+            self.db.add_to_outbox([
+                (self.channel_id, meme_id, json.dumps(msg), now, position)
+                for position, (meme_id, _, msg) in enumerate(picked)
+            ])
+        # `details` shouldn't show them as unposted until the cache expires
+        scrape_reddit.details_cache.invalidate_many(url for _, url, _ in picked)
+        for meme_id, _, msg in picked:
+            self.outbox.put((meme_id, msg, 0))
+        return [meme_id for meme_id, _, _ in picked]
+
+    def resume_outbox(self):
+        """Queues the memes that were picked but not delivered before the last restart"""
+        self.lock.acquire()
+        try:
+            rows = self.db.get_undelivered(self.channel_id)
+        finally:
+            self.lock.release()
+        for row in rows:
+            self.outbox.put((row['meme_id'], json.loads(row['message']), 0))
+        if rows:
+            utils.log_usage(f'resume_outbox - {len(rows)} undelivered memes')
+
+    def deliver_outbox(self):
+        """
+        Posts the next meme in the outbox. Deliveries are recorded in batches by
+        `flush_delivered`; failed posts are retried up to OUTBOX_ATTEMPTS times
+        """
+        try:
+            meme_id, msg, attempts = self.outbox.get_nowait()
+        except queue.Empty:
+            return
+        try:
+            response = self._post_message(msg)
+            error = None if response.get('ok') else response.get('error', 'unknown error')
+        except circuit.CircuitOpen:
+            # not an attempt, slack wasn't even tried
+            self.outbox.put((meme_id, msg, attempts))
+            return
+        except Exception as e:
+            utils.log_error(e)
+            response, error = {}, str(e)
+
+        if error is not None and attempts + 1 < self.OUTBOX_ATTEMPTS:
+            self.outbox.put((meme_id, msg, attempts + 1))
+            return
+        if error is not None:
+            utils.log_usage(f'deliver_outbox - giving up on {meme_id}: {error}')
+        self._delivered.append((self.clock.now(), response.get('ts'), error, self.channel_id, meme_id))
+        if len(self._delivered) >= self.OUTBOX_BATCH or self.outbox.empty():
+            self.flush_delivered()
+
+    def flush_delivered(self):
+        """Records the deliveries since the last flush in the outbox, in one batch"""
+        delivered, self._delivered = self._delivered, []
+        if not delivered:
+            return
+        self.lock.acquire()
+        try:
+            self.db.mark_delivered(delivered)
+        except Exception as e:
+            utils.log_error(e)
+            self._delivered = delivered + self._delivered
+        finally:
+            self.lock.release()
 
     def parse_slack_output(self, slack_rtm_output):
         """
@@ -367,17 +762,36 @@ class AutoMemer:
         directed at the Bot, based on its ID.
         """
         if slack_rtm_output:
+            # bots sharing a token all get every event, each only answers in its own channel
+            slack_rtm_output = [
+                output for output in slack_rtm_output if output.get('channel', self.channel_id) == self.channel_id
+            ]
             for output in slack_rtm_output:
-                output['time'] = datetime.datetime.now().isoformat()
+                output['time'] = self.clock.datetime().isoformat()
                 if 'user' in output:
                     output['username'] = self._get_name(output['user'])
                 if 'text' in output and self.at_bot in output['text']:
                     # return text after the @ mention, whitespace removed
                     output['@mention'] = output['text'].split(self.at_bot)[1].strip()
+                elif self._is_details_reaction(output):
+                    # answer as if `details` had been sent in the thread of the message reacted to
+                    output['@mention'] = 'details'
+                    output['channel'] = output['item']['channel']
+                    output['ts'] = output['thread_ts'] = output['item']['ts']
 
             self.log_slack_rtm(slack_rtm_output)
         return slack_rtm_output
 
+    def _is_details_reaction(self, output):
+        item = output.get('item') or {}
+        return (
+            output.get('type') == 'reaction_added' and
+            output.get('reaction') in self.DETAILS_REACTIONS and
+            output.get('user') != self.bot_id and
+            item.get('type') == 'message' and
+            item.get('channel') == self.channel_id
+        )
+
     def log_slack_rtm(self, message):
         if not isinstance(message, str):
             message = json.dumps(message, indent=2)
@@ -390,26 +804,16 @@ class AutoMemer:
         self.lock.acquire()
         utils.log_usage('count_memes - lock acquired')
         try:
-            with open(utils.SCRAPED_PATH, mode='r', encoding='utf-8') as f:
-                memes = f.read()
-            with open(utils.SETTINGS_PATH, mode='r', encoding='utf-8') as f:
+            # other replicas may be writing to the store, see PendingStore.lock
+            with self.pending.lock():
+                memes = self.pending.load()
+            with open(self.settings_path, mode='r', encoding='utf-8') as f:
                 settings = f.read()
-            memes = json.loads(memes)
             settings = json.loads(settings)
             thresholds = settings['threshold_upvotes']
-
-            total, postable = Counter(), Counter()
-            for post, data in memes.items():
-                if not data.get('over_18'):
-                    sub = data.get('sub', '').lower()
-                    ups = data.get('highest_ups')
-                    sub_threshold = thresholds.get(sub, thresholds['global'])
-
-                    total[sub] += 1
-                    if ups >= sub_threshold:
-                        postable[sub] += 1
-            return total, postable
-        except OSError:
+            return records.count_postable(memes.values(), thresholds)
+        except (OSError, ValueError) as e:
+            utils.log_error(e)
             return Counter(), Counter()
         finally:
             self.lock.release()
@@ -428,11 +832,11 @@ class AutoMemer:
             response += 'command must be in the form `add [name]`'
         else:
             command = command[1]
-            settings = json.loads(open(utils.SETTINGS_PATH).read())
+            settings = json.loads(open(self.settings_path).read())
             settings['subs'].append(command)
             self.lock.acquire()
             try:
-                with open(utils.SETTINGS_PATH, mode='w', encoding='utf-8') as f:
+                with open(self.settings_path, mode='w', encoding='utf-8') as f:
                     f.write(json.dumps(settings, indent=2))
             finally:
                 self.lock.release()
@@ -446,7 +850,7 @@ class AutoMemer:
             response += 'command must be in the form `delete [name]`'
         else:
             sub = command[1]
-            settings = json.loads(open(utils.SETTINGS_PATH).read())
+            settings = json.loads(open(self.settings_path).read())
             previous_subs = settings['subs']
             previous_thresholds = settings['threshold_upvotes']
             if sub not in previous_subs:
@@ -461,7 +865,7 @@ class AutoMemer:
                     del previous_thresholds[sub]
                 self.lock.acquire()
                 try:
-                    with open(utils.SETTINGS_PATH, mode='w', encoding='utf-8') as f:
+                    with open(self.settings_path, mode='w', encoding='utf-8') as f:
                         f.write(json.dumps(settings, indent=2))
                 finally:
                     self.lock.release()
@@ -472,7 +876,7 @@ class AutoMemer:
         response = ''
         self.lock.acquire()
         try:
-            with open(utils.SETTINGS_PATH, mode='r', encoding='utf-8') as f:
+            with open(self.settings_path, mode='r', encoding='utf-8') as f:
                 settings = json.loads(f.read())
         finally:
             self.lock.release()
@@ -480,13 +884,25 @@ class AutoMemer:
             if key == 'subs':
                 val = sorted(val)
             response += '`{key}`: {val}\n'.format(key=key, val=json.dumps(val, indent=2))
+
+        # the scrape schedule is shared by every channel, the limits shown are this channel's
+        limits = scheduling.bounds([settings])
+        self.lock.acquire()
+        try:
+            schedules = self.db.get_sub_schedules()
+        finally:
+            self.lock.release()
+        response += '*scrape schedule*\n'
+        now = self.clock.now()
+        for sub in sorted(name.lower() for name in settings.get('subs', ['me_irl'])):
+            response += f'_/r/{sub}_: {scheduling.describe(schedules.get(sub), now, limits)}\n'
         return response
 
     def _command_list_thresholds(self):
         response = ''
         self.lock.acquire()
         try:
-            settings = json.loads(open(utils.SETTINGS_PATH).read())
+            settings = json.loads(open(self.settings_path).read())
             thresholds = settings.get('threshold_upvotes')
             response += json.dumps(thresholds, indent=2)
         except OSError as e:
@@ -500,7 +916,7 @@ class AutoMemer:
         response = ''
         self.lock.acquire()
         try:
-            settings = json.loads(open(utils.SETTINGS_PATH).read())
+            settings = json.loads(open(self.settings_path).read())
             subs = sorted(settings.get('subs'))
             response += (
                 'The following subreddits are currently being followed: {}'.format(
@@ -539,7 +955,7 @@ class AutoMemer:
                 )
         else:
             sub = command[-1].lower()
-            with open(utils.SETTINGS_PATH, mode='r', encoding='utf-8') as f:
+            with open(self.settings_path, mode='r', encoding='utf-8') as f:
                 settings = json.loads(f.read())
             if sub not in settings['subs']:
                 response += f'{sub} is not in the list of subreddits. run `list subreddits` to view a list'
@@ -560,7 +976,7 @@ class AutoMemer:
     def _command_set_threshold_to(self, upvote_value, sub='global', mode=None):
         self.lock.acquire()
         try:
-            settings = json.loads(open(utils.SETTINGS_PATH).read())
+            settings = json.loads(open(self.settings_path).read())
             old_t = settings['threshold_upvotes'].get(sub, 'global')
             new_t = upvote_value
             if mode == '+':
@@ -570,7 +986,7 @@ class AutoMemer:
                     new_t += old_t
             new_t = max(1, new_t)
             settings['threshold_upvotes'][sub] = new_t
-            with open(utils.SETTINGS_PATH, 'w') as f:
+            with open(self.settings_path, 'w') as f:
                 f.write(json.dumps(settings, indent=2))
             return old_t, new_t
         finally:
@@ -579,24 +995,30 @@ class AutoMemer:
     def _command_details(self, output, link_only=False):
         response = ''
         command = output.get('@mention').split()
-        if len(command) != 2:
-            response += 'command must be in the form `details <meme_url>`\n'
+        if len(command) == 1 and 'thread_ts' in output:
+            # sent in the thread of a posted meme, which is looked up by its message
+            meme_data = scrape_reddit.get_posted_meme_details(
+                self.db, output['channel'], output['thread_ts'], self.lock,
+            )
+            if not meme_data:
+                return "I can't find the meme this thread is about, try `details <meme_url>`\n"
+        elif len(command) != 2:
+            return 'command must be in the form `details <meme_url>`, or `details` in the thread of a meme\n'
         else:
             meme_url = html.unescape(command[1][1:-1])
-            meme_data = scrape_reddit.update_reddit_meme(
-                self.cursor, self.conn, meme_url, self.lock,
+            meme_data = scrape_reddit.get_meme_details(
+                self.db, meme_url, self.lock,
             )
             if meme_data is None:
-                response += f'I could find any data for this url: `{meme_url}`, sorry\n'
-            else:
-                if link_only:
-                    for meme in meme_data:
-                        response += meme.get('link') + '\n'
-                else:
-                    for meme in meme_data:
-                        for key, val in sorted(meme.items()):
-                            response += f'`{key}`: {val}\n'
-                        response += '\n'
+                return f'I could find any data for this url: `{meme_url}`, sorry\n'
+        if link_only:
+            for meme in meme_data:
+                response += meme.get('link') + '\n'
+        else:
+            for meme in meme_data:
+                for key, val in sorted(meme.items()):
+                    response += f'`{key}`: {val}\n'
+                response += '\n'
         return response
 
     def _command_set_post_interval(self, command):
@@ -624,13 +1046,13 @@ class AutoMemer:
                 else:
                     self.lock.acquire()
                     try:
-                        with open(utils.SETTINGS_PATH, mode='r', encoding='utf-8') as s:
+                        with open(self.settings_path, mode='r', encoding='utf-8') as s:
                             settings = s.read()
                         settings = json.loads(settings)
                         settings['scrape_interval'] = interval
                         global scrape_interval
                         scrape_interval = interval
-                        with open(utils.SETTINGS_PATH, mode='w', encoding='utf-8') as s:
+                        with open(self.settings_path, mode='w', encoding='utf-8') as s:
                             s.write(json.dumps(settings, indent=2))
                         response += 'scrape_interval has been set to *{}*!'.format(str(interval))
                     finally:
@@ -655,6 +1077,183 @@ class AutoMemer:
 
         return response
 
+    def _command_profile(self, output):
+        command = output.get('@mention').lower().split()
+        profiler = profiling.profiler
+        if len(command) != 2 or command[1] not in ('on', 'off', 'status'):
+            return 'command must be in the form `profile <on|off|status>`'
+
+        if command[1] == 'on':
+            profiler.enable(reply_to=(self.bot_id, output['channel'], output.get('thread_ts', output['ts'])))
+            return (
+                'Profiling is on :stopwatch: summaries will be posted in this thread, '
+                f'profiles are written to `{profiler.profiles_dir}`'
+            )
+        elif command[1] == 'off':
+            profiler.disable()
+            return 'Profiling is off'
+        else:
+            profiles = profiler.list_profiles()
+            response = 'Profiling is *{}*, {:,d} profiles in `{}`'.format(
+                'on' if profiler.enabled else 'off',
+                len(profiles),
+                profiler.profiles_dir,
+            )
+            if profiles:
+                response += '\nmost recent: `{}`'.format(profiles[-1])
+            breakers = (circuit.reddit, circuit.slack, circuit.database)
+            response += '\n' + ', '.join(breaker.describe() for breaker in breakers)
+            http = transport.latencies.summary()
+            if http:
+                response += '\nhttp requests:\n```\n{}\n```'.format(http)
+            return response
+
+    def _command_export(self, output):
+        command = output.get('@mention').split()[1:]
+        fmt, filters, dates = 'csv', {}, []
+        for word in command:
+            if word.lower() in export.FORMATS:
+                fmt = word.lower()
+            elif word.lower() in ('posted', 'unposted'):
+                filters['posted'] = word.lower() == 'posted'
+            elif re.fullmatch(r'\d{4}-\d{2}-\d{2}', word):
+                dates.append(word)
+            elif 'sub' not in filters:
+                filters['sub'] = word
+            else:
+                filters = None
+                break
+        if filters is None or len(dates) > 2:
+            return (
+                'command must be in the form '
+                '`export {csv|ndjson|parquet} {subreddit} {since} {until} {posted|unposted}`'
+            )
+        if 'sub' in filters and filters['sub'].lower() not in self._followed_subs():
+            # otherwise a typo silently exports nothing
+            return f"{filters['sub']} is not in the list of subreddits. run `list subreddits` to view a list"
+        filters.update(zip(('since', 'until'), dates))
+
+        path = export.default_path(fmt)
+        utils.log_usage(f'handle_command - export - {path} - start')
+        try:
+            if self._db_factory is not None:
+                # stream on a connection of our own, so the bot's isn't blocked meanwhile
+                db = self._db_factory()
+                try:
+                    count = export.export(db, path, fmt, **filters)
+                finally:
+                    db.close()
+            else:
+                self.lock.acquire()
+                try:
+                    count = export.export(self.db, path, fmt, **filters)
+                finally:
+                    self.lock.release()
+        except ValueError as e:
+            return str(e)
+        utils.log_usage(f'handle_command - export - {path} - {count} rows')
+
+        try:
+            with open(path, 'rb') as f, circuit.slack.guard(transport.unavailable_errors()):
+                response = self.client.api_call(
+                    'files.upload',
+                    channels=output['channel'],
+                    thread_ts=output.get('thread_ts', output['ts']),
+                    file=f,
+                    filename=os.path.basename(path),
+                )
+                if transport.is_unavailable(response):
+                    raise transport.Unavailable(response['error'])
+        except (circuit.CircuitOpen,) + transport.unavailable_errors() as e:
+            utils.log_error(e)
+            return f"Exported {count:,} memes to `{path}`, but couldn't upload it: {e}"
+        return f'Exported {count:,} memes to `{path}`'
+
+    def _followed_subs(self):
+        """Returns the (lowercase) names of the subs this channel follows"""
+        self.lock.acquire()
+        try:
+            with open(self.settings_path, mode='r', encoding='utf-8') as f:
+                settings = json.loads(f.read())
+        finally:
+            self.lock.release()
+        return {sub.lower() for sub in settings.get('subs', [])}
+
+    def _load_stats(self, days):
+        self.lock.acquire()
+        try:
+            with open(self.settings_path, mode='r', encoding='utf-8') as f:
+                settings = json.loads(f.read())
+            stats = analytics.PostStats.load(self.db, days=days, now=self.clock.now())
+        finally:
+            self.lock.release()
+        return settings, stats
+
+    def _command_stats(self, output):
+        command = output.get('@mention').lower().split()
+        try:
+            days = float(command[1]) if len(command) > 1 else analytics.WINDOW_DAYS
+        except ValueError:
+            return 'command must be in the form `stats {days}`'
+        settings, stats = self._load_stats(days)
+        subs = {sub.lower() for sub in settings.get('subs', [])}
+        total, postable = self.count_memes()
+        return (
+            analytics.format_stats(stats, settings, subs=subs) +
+            f'\nbacklog: {sum(total.values()):,} memes, {sum(postable.values()):,} postable'
+        )
+
+    def _command_suggest_thresholds(self, output):
+        command = output.get('@mention').lower().split()
+        try:
+            per_day = float(command[2]) if len(command) > 2 else None
+        except ValueError:
+            return 'command must be in the form `suggest thresholds {memes_per_day}`'
+        settings, stats = self._load_stats(analytics.WINDOW_DAYS)
+        return analytics.format_suggestions(stats, settings, settings.get('subs', []), per_day)
+
+    def _command_search(self, output):
+        usage = 'command must be in the form `search <terms> {in <subreddit>} {page <n>}`'
+        words = output.get('@mention').split()[1:]
+        page, sub = 1, None
+        if len(words) > 2 and words[-2].lower() == 'page':
+            try:
+                page = int(words[-1])
+            except ValueError:
+                return usage
+            words = words[:-2]
+        if len(words) > 2 and words[-2].lower() == 'in':
+            sub = words[-1].lower()
+            words = words[:-2]
+        if not words or page < 1:
+            return usage
+        if sub is not None and sub not in self._followed_subs():
+            # otherwise a typo silently finds nothing
+            return f'{sub} is not in the list of subreddits. run `list subreddits` to view a list'
+
+        terms = ' '.join(words)
+        size = self.SEARCH_PAGE_SIZE
+        self.lock.acquire()
+        try:
+            # one extra row tells whether there is a next page
+            rows = self.db.search_posts(terms, sub=sub, limit=size + 1, offset=(page - 1) * size)
+        finally:
+            self.lock.release()
+        where = f' in {sub}' if sub else ''
+        if not rows:
+            return f'no memes found for `{terms}`{where}' + (f' on page {page}' if page > 1 else '')
+
+        lines = []
+        for i, row in enumerate(rows[:size], start=(page - 1) * size + 1):
+            title = html.escape(row.get('title') or '', quote=False)
+            lines.append(
+                f"{i}. <{row.get('link')}|{title}> ({row.get('sub')}, {row.get('highest_ups') or 0:,d} upvotes, "
+                f"{str(row.get('created_utc'))[:10]})"
+            )
+        if len(rows) > size:
+            lines.append(f'more with `search {terms}{where} page {page + 1}`')
+        return '\n'.join(lines)
+
     def _command_num_memes(self, output):
         utils.log_usage('handle_command - num-memes - start')
         response = ''
@@ -714,31 +1313,149 @@ class AutoMemer:
 # ----------------------- SPECIFIC COMMANDS ---------------------------
 
 
+class MemerRuntime:
+    """
+    Serves several channels, possibly in different workspaces, from one process. Every
+    channel gets its own AutoMemer with its own settings, thresholds and pending store,
+    but reddit is scraped once for all of them: each sub followed by any channel is
+    fetched a single time and its memes are fanned out to the channels following it.
+    """
+
+    def __init__(self, channel_configs, db_factory, fast_start=False, debug=False, coordinator=None):
+        """
+        :param channel_configs: a list of dicts with a bot_id, channel_id and bot_token, and
+        optionally a settings_path and scraped_path (defaulting to memes/<channel_id>/)
+        :param db_factory: a function returning a new storage.Storage, called once per bot
+        and once for the shared scraper
+        :param coordinator: a coordination.Coordinator shared by the bots, when several
+        replicas of this process run at once
+        """
+        self.coordinator = coordinator
+        self.stopping = Event()
+        self.lock = Lock()  # guards self.db, which only the shared scraper uses
+        self.db = utils.Deferred(db_factory, name='scraper-db')
+        self.bots = []
+        for config in channel_configs:
+            channel_dir = os.path.join('memes', config['channel_id'])
+            self.bots.append(AutoMemer(
+                config['bot_id'],
+                config['channel_id'],
+                config['bot_token'],
+                db_factory,
+                debug=debug,
+                fast_start=fast_start,
+                settings_path=config.get('settings_path', os.path.join(channel_dir, 'settings.json')),
+                scraped_path=config.get('scraped_path', os.path.join(channel_dir, 'scraped.json')),
+                scraper=self.scrape,
+                snapshot_path=config.get('snapshot_path', os.path.join(channel_dir, 'snapshot')),
+                coordinator=coordinator,
+            ))
+        if fast_start:
+            self.db.start()
+
+    @classmethod
+    def from_file(cls, path, db_factory, **kwargs):
+        with open(path, 'r') as f:
+            return cls(json.loads(f.read()), db_factory, **kwargs)
+
+    def scrape(self, force=False):
+        scrape_reddit.scrape(
+            self.db.get(), self.lock, channels=[bot.channel for bot in self.bots], force=force,
+            shard=self.coordinator.owns if self.coordinator else None,
+        )
+
+    def stop(self):
+        self.stopping.set()
+        for bot in self.bots:
+            bot.stop()
+
+    def scrape_repeatedly(self):
+        """Scrapes the subs that are due every scheduling.TICK_MINUTES, until stopped"""
+        tick = scheduling.TICK_MINUTES * 60
+        while not self.stopping.wait(tick - time.time() % tick):
+            self.scrape()
+
+    def run(self):
+        """
+        Runs every bot, and the scrape schedule they share, until they've all stopped. A bot
+        stopped by `kill` only stops itself, but if one fails the others are shut down too
+        """
+        threads = []
+        for bot in self.bots:
+            t = Thread(target=bot.run, kwargs={'scrape_repeatedly': False})
+            t.daemon = True
+            t.start()
+            threads.append(t)
+        t_scrape = Thread(target=self.scrape_repeatedly)
+        t_scrape.daemon = True
+        t_scrape.start()
+
+        while any(t.is_alive() for t in threads) and not self.stopping.is_set():
+            if any(not t.is_alive() and not bot.stopping.is_set() for bot, t in zip(self.bots, threads)):
+                break
+            time.sleep(1)
+        self.stop()
+        for t in threads:
+            t.join()
+
+
 if __name__ == '__main__':
+    fast_start = os.environ.get('FAST_START', '1') != '0'
+    # `kill -USR1 <pid>` toggles profiling without going through slack
+    signal.signal(signal.SIGUSR1, profiling.profiler.toggle)
+
+    # with REPLICATED=1, several copies of the bot can run at once and elect a leader, see coordination.py
+    coordinator = None
+    if os.environ.get('REPLICATED') == '1':
+        coordinator = coordination.Coordinator(
+            storage.load_storage,
+            replica_id=os.environ.get('REPLICA_ID'),
+            shard_scrapes=os.environ.get('SHARD_SCRAPES') == '1',
+        ).start()
+
+    CHANNELS_FILE = os.environ.get('CHANNELS_FILE')
+    if CHANNELS_FILE:
+        # serve every channel listed in CHANNELS_FILE from this process
+        utils.init()
+        runtime = MemerRuntime.from_file(
+            CHANNELS_FILE, storage.load_storage, fast_start=fast_start, coordinator=coordinator,
+        )
+        # `kill <pid>` shuts every bot down gracefully, like the kill command
+        signal.signal(signal.SIGTERM, lambda *args: runtime.stop())
+        try:
+            runtime.run()
+        except Exception as e:
+            utils.log_error(e)
+        if coordinator is not None:
+            coordinator.stop()
+        sys.exit(0)
+
     BOT_ID = os.environ.get('BOT_ID')
     MEME_SPAM_CHANNEL = os.environ.get('MEME_SPAM_CHANNEL')
     BOT_TOKEN = os.environ.get('SLACK_BOT_TOKEN')
 
-    with open('db.json', 'r') as f:
-        db_info = json.loads(f.read())
-
     meme_bot = AutoMemer(
         BOT_ID,
         MEME_SPAM_CHANNEL,
         BOT_TOKEN,
-        db_info['user'],
-        db_info['password'],
-        db_info['db'],
-        db_info['host'],
+        storage.load_storage,
+        fast_start=fast_start,
+        coordinator=coordinator,
     )
+    signal.signal(signal.SIGTERM, lambda *args: meme_bot.stop())
     try:
         meme_bot.run()
     except Exception as e:
         utils.log_error(e)
     else:
-        meme_bot.client.api_call(
-            'chat.postMessage',
-            channel=MEME_SPAM_CHANNEL,
-            text='exiting gracefully',
-            as_user=True,
-        )
+        # standby replicas leave the channel alone
+        if meme_bot.leading:
+            meme_bot.client.api_call(
+                'chat.postMessage',
+                channel=MEME_SPAM_CHANNEL,
+                text='exiting gracefully',
+                as_user=True,
+            )
+    finally:
+        if coordinator is not None:
+            coordinator.stop()
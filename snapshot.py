@@ -0,0 +1,117 @@
+"""
+A snapshot of the bot's in-memory state, written on a graceful shutdown and read back on
+startup so the bot is back to full service without rebuilding everything.
+
+A snapshot is a directory holding:
+
+- `meta.json`: the format version, when it was written, how many entries it holds and a
+  checksum of the posted image hashes
+- `users.json`: the last users.list response
+- `messages.json`: outgoing messages that couldn't be sent before shutting down
+- `posted_ids.npy` / `posted_hashes.npy`: the index of posted images (see fingerprint.py)
+  as fixed width NumPy arrays, which are memory mapped rather than read when loaded
+
+It is written to a temporary directory first and swapped in, so a crash while writing
+leaves the previous snapshot in place.
+"""
+import json
+import os
+import shutil
+import time
+
+import utils
+
+
+FORMAT_VERSION = 1
+# reddit ids are short base36 strings
+ID_WIDTH = 16
+
+
+class Snapshot:
+    """The state written by `AutoMemer.shutdown`"""
+
+    def __init__(self, users_list=None, messages=(), posted_ids=(), posted_hashes=(), created=None,
+                 posted_checksum=None):
+        """
+        :param posted_ids: the ids of posted memes with a hashed image
+        :param posted_hashes: their (unsigned) image hashes, in the same order
+        :param posted_checksum: the fingerprint.checksum of posted_hashes, None if unknown
+        """
+        self.users_list = users_list
+        self.messages = list(messages)
+        self.posted_ids = posted_ids
+        self.posted_hashes = posted_hashes
+        self.created = time.time() if created is None else created
+        self.posted_checksum = posted_checksum
+
+    def posted(self):
+        """Yields (id, unsigned hash) for every posted image"""
+        for meme_id, value in zip(self.posted_ids, self.posted_hashes):
+            yield (meme_id.decode() if isinstance(meme_id, bytes) else str(meme_id)), int(value)
+
+    def save(self, path):
+        import numpy as np
+
+        tmp_path = path + '.tmp'
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        os.makedirs(tmp_path)
+        np.save(os.path.join(tmp_path, 'posted_ids.npy'), np.array(self.posted_ids, dtype=f'S{ID_WIDTH}'))
+        np.save(os.path.join(tmp_path, 'posted_hashes.npy'), np.array(self.posted_hashes, dtype=np.uint64))
+        with open(os.path.join(tmp_path, 'users.json'), 'w') as f:
+            f.write(json.dumps(self.users_list))
+        with open(os.path.join(tmp_path, 'messages.json'), 'w') as f:
+            f.write(json.dumps(self.messages))
+        # meta.json is written last, a snapshot without it is incomplete
+        with open(os.path.join(tmp_path, 'meta.json'), 'w') as f:
+            f.write(json.dumps({
+                'version': FORMAT_VERSION,
+                'created': self.created,
+                'posted': len(self.posted_ids),
+                'posted_checksum': self.posted_checksum,
+                'messages': len(self.messages),
+            }, indent=2))
+
+        old_path = path + '.old'
+        shutil.rmtree(old_path, ignore_errors=True)
+        if os.path.exists(path):
+            os.rename(path, old_path)
+        os.rename(tmp_path, path)
+        shutil.rmtree(old_path, ignore_errors=True)
+
+    @classmethod
+    def load(cls, path):
+        """
+        Returns the Snapshot at path, or None if there is none or it can't be used (written
+        by another version, incomplete or corrupt)
+        """
+        import numpy as np
+
+        try:
+            with open(os.path.join(path, 'meta.json'), 'r') as f:
+                meta = json.loads(f.read())
+            if meta.get('version') != FORMAT_VERSION:
+                utils.log_usage(f"snapshot - {path} has version {meta.get('version')}, ignoring it")
+                return None
+            with open(os.path.join(path, 'users.json'), 'r') as f:
+                users_list = json.loads(f.read())
+            with open(os.path.join(path, 'messages.json'), 'r') as f:
+                messages = json.loads(f.read())
+            posted_ids = np.load(os.path.join(path, 'posted_ids.npy'), mmap_mode='r')
+            posted_hashes = np.load(os.path.join(path, 'posted_hashes.npy'), mmap_mode='r')
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            utils.log_error(e)
+            return None
+        if len(posted_ids) != meta['posted'] or len(posted_hashes) != meta['posted']:
+            utils.log_usage(f'snapshot - {path} is inconsistent, ignoring it')
+            return None
+        return cls(users_list, messages, posted_ids, posted_hashes, meta['created'], meta.get('posted_checksum'))
+
+    @staticmethod
+    def clear_messages(path):
+        """Empties the messages of the snapshot at path once they've been requeued, so they are only sent once"""
+        tmp_path = os.path.join(path, 'messages.json.tmp')
+        with open(tmp_path, 'w') as f:
+            f.write('[]')
+        os.replace(tmp_path, os.path.join(path, 'messages.json'))
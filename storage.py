@@ -0,0 +1,970 @@
+import json
+import re
+import sqlite3
+import threading
+from abc import ABC
+from abc import abstractmethod
+from contextlib import contextmanager
+from functools import lru_cache
+
+import circuit
+import utils
+
+
+def _qmark(match):
+    if match.group(1) == '%':
+        return '%'
+    return ':' + match.group(2) if match.group(2) else '?'
+
+
+@lru_cache(maxsize=None)
+def _to_qmark(query):
+    """Translates a pyformat (%s / %(name)s, %% for a literal %) query into sqlite's qmark / named style"""
+    return re.sub(r'%(%|\((\w+)\)s|s)', _qmark, query)
+
+
+# the columns of the posts table written by the scraper, in table order
+POST_COLUMNS = (
+    'id', 'over_18', 'ups', 'highest_ups', 'title', 'url', 'link', 'author', 'sub',
+    'upvote_ratio', 'created_utc', 'last_updated', 'recorded', 'posted_to_slack',
+)
+
+
+# the OperationalErrors meaning the database can't be reached, rather than a bad query.
+# On mysql the client errors (2000-2999) and these server ones: too many connections,
+# server shutdown and connection killed
+MYSQL_UNAVAILABLE_CODES = frozenset((1040, 1053, 1927))
+# on sqlite, by message
+SQLITE_UNAVAILABLE_MESSAGES = (
+    'database is locked', 'database table is locked', 'unable to open database', 'disk i/o error',
+)
+
+
+def _dict_factory(cursor, row):
+    return {column[0]: value for column, value in zip(cursor.description, row)}
+
+
+class Storage(ABC):
+    """
+    Wraps a database connection and the queries the bot makes against the `posts`
+    table. Queries are written once in pyformat style; subclasses translate them for
+    their driver. Every statement is committed on its own unless it runs inside
+    `transaction()`. Statements go through `breaker` (see circuit.py), so while the
+    database is unreachable they fail straight away with circuit.CircuitOpen.
+    """
+    engine = None
+    # an INSERT that skips rows whose key is already there
+    insert_ignore = None
+    # the larger of two values
+    greatest = None
+
+    def __init__(self, breaker=circuit.database):
+        self.breaker = breaker
+        self.connection = self.connect()
+        self.cursor = self.connection.cursor()
+        self._transaction_lock = threading.RLock()
+
+    @abstractmethod
+    def connect(self):
+        """Returns a new DB-API connection"""
+
+    @abstractmethod
+    def _unavailable_errors(self):
+        """The driver's exception types meaning the database can't be reached"""
+
+    def _is_unavailable(self, error):
+        """
+        Whether error, one of `_unavailable_errors`, means the database can't be reached,
+        rather than e.g. a bad query
+        """
+        return True
+
+    def _reconnect(self):
+        """Called before probing a database that was unreachable"""
+
+    def sql(self, query):
+        """Returns query in the paramstyle of this backend"""
+        return query
+
+    def execute(self, query, params=()):
+        with self.breaker.guard(self._unavailable_errors(), self._is_unavailable) as probe:
+            if probe:
+                self._reconnect()
+            self.cursor.execute(self.sql(query), params)
+        return self.cursor
+
+    def executemany(self, query, seq_of_params):
+        with self.breaker.guard(self._unavailable_errors(), self._is_unavailable) as probe:
+            if probe:
+                self._reconnect()
+            self.cursor.executemany(self.sql(query), seq_of_params)
+        return self.cursor
+
+    def _stream_cursor(self):
+        """Returns a new cursor that fetches rows from the server as they are read"""
+        return self.connection.cursor()
+
+    def stream(self, query, params=(), batch_size=1000):
+        """
+        Yields the rows of query one at a time, fetching batch_size rows at a time so that
+        the result set is never held in memory. On MySQL the connection can't run other
+        queries until the generator is exhausted or closed, so long exports should use a
+        connection of their own
+        """
+        cursor = self._stream_cursor()
+        try:
+            cursor.execute(self.sql(query), params)
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    return
+                yield from rows
+        finally:
+            cursor.close()
+
+    @abstractmethod
+    def _begin(self):
+        """Starts a transaction on the connection"""
+
+    @contextmanager
+    def transaction(self):
+        """Runs the enclosed statements in one transaction, committing once at the end"""
+        with self._transaction_lock:
+            self._begin()
+            try:
+                yield self
+            except BaseException:
+                self.connection.rollback()
+                raise
+            else:
+                self.connection.commit()
+
+    def commit(self):
+        self.connection.commit()
+
+    def close(self):
+        self.connection.close()
+
+    def create_tables(self):
+        self.execute('''
+            CREATE TABLE IF NOT EXISTS posts (
+                id              TEXT,
+                over_18         BOOLEAN,
+                ups             INTEGER,
+                highest_ups     INTEGER,
+                title           TEXT,
+                url             TEXT,
+                link            TEXT,
+                author          TEXT,
+                sub             TEXT,
+                upvote_ratio    FLOAT,
+                created_utc     DATETIME,
+                last_updated    DATETIME,
+                recorded        TEXT,
+                posted_to_slack BOOLEAN
+            );
+        ''')
+        # perceptual hash of the post's image, see fingerprint.py
+        self.add_column('posts', 'phash', 'BIGINT')
+        # append-only log of every upvote count seen while scraping
+        self.execute('''
+            CREATE TABLE IF NOT EXISTS score_history (
+                id              VARCHAR(16),
+                ups             INTEGER,
+                upvote_ratio    FLOAT,
+                recorded        DOUBLE
+            );
+        ''')
+        # the latest velocity / rank of each meme, see ranking.py
+        self.execute('''
+            CREATE TABLE IF NOT EXISTS meme_scores (
+                id              VARCHAR(16) PRIMARY KEY,
+                sub             VARCHAR(64),
+                url             TEXT,
+                ups             INTEGER,
+                velocity        DOUBLE,
+                score           DOUBLE,
+                last_seen       DOUBLE
+            );
+        ''')
+        # memes picked to be posted and their messages, until slack has them, see AutoMemer.deliver_outbox
+        self.execute('''
+            CREATE TABLE IF NOT EXISTS outbox (
+                channel         VARCHAR(32),
+                meme_id         VARCHAR(16),
+                message         TEXT,
+                created         DOUBLE,
+                position        INTEGER,
+                delivered       DOUBLE,
+                ts              VARCHAR(32),
+                error           TEXT,
+                PRIMARY KEY (channel, meme_id)
+            );
+        ''')
+        # when and how deeply each sub is scraped, see scheduling.py
+        self.execute('''
+            CREATE TABLE IF NOT EXISTS sub_schedule (
+                sub             VARCHAR(64) PRIMARY KEY,
+                rate            DOUBLE,
+                interval_min    DOUBLE,
+                depth           INTEGER,
+                last_scraped    DOUBLE,
+                last_new        INTEGER
+            );
+        ''')
+        # which replica holds each lease and until when, see coordination.py
+        self.execute('''
+            CREATE TABLE IF NOT EXISTS leases (
+                name            VARCHAR(64) PRIMARY KEY,
+                holder          VARCHAR(128),
+                expires         DOUBLE
+            );
+        ''')
+        # the last heartbeat of every running replica
+        self.execute('''
+            CREATE TABLE IF NOT EXISTS replicas (
+                replica_id      VARCHAR(128) PRIMARY KEY,
+                heartbeat       DOUBLE
+            );
+        ''')
+
+    def add_column(self, table, column, definition):
+        """Adds a column to an existing table, unless it is already there"""
+        columns = [c[0] for c in self.execute(f'SELECT * FROM {table} LIMIT 0').description]
+        if column not in columns:
+            self.execute(f'ALTER TABLE {table} ADD COLUMN {column} {definition}')
+
+    def get_meme_data(self, meme_id):
+        """
+        Queries the database for data associated with the passed Reddit post id.
+        :param meme_id: the id associated with a post on reddit / a row in the database
+        :return: a dictionary with the data for the appropriate post if it exists, else None
+        """
+        return self.execute(
+            '''
+            SELECT *
+            FROM posts
+            WHERE id = %s
+            ''',
+            (meme_id,),
+        ).fetchone()
+
+    def get_meme_data_from_url(self, url):
+        """
+        Queries the database for data associated with the given url
+        :param url: a url for an image / post on Reddit
+        :return: a list of dictionaries corresponding to each post having the appropriate url,
+        or an empty list if no data matches.
+        """
+        return list(self.execute(
+            '''
+            SELECT *
+            FROM posts
+            WHERE url = %s
+            ''',
+            (url,),
+        ).fetchall())
+
+    def add_meme_data(self, meme_dict):
+        """
+        Inserts data for the passed dict into the database.
+        :param meme_dict: a dictionary with data for a given meme, in the format of `Meme.to_row`
+        """
+        self.execute(
+            '''
+            INSERT INTO posts (
+                id, over_18, ups, highest_ups, title, url, link, author, sub,
+                upvote_ratio, created_utc, last_updated, recorded, posted_to_slack
+            ) VALUES (
+                %(id)s,
+                %(over_18)s,
+                %(ups)s,
+                %(highest_ups)s,
+                %(title)s,
+                %(url)s,
+                %(link)s,
+                %(author)s,
+                %(sub)s,
+                %(upvote_ratio)s,
+                %(created_utc)s,
+                %(last_updated)s,
+                %(recorded)s,
+                %(posted_to_slack)s
+            );
+            ''',
+            meme_dict,
+        )
+
+    def add_posts(self, rows):
+        """
+        Inserts many posts in one batch (a multi-row insert on MySQL)
+        :param rows: a list of tuples with a value for each of POST_COLUMNS
+        """
+        columns = ', '.join(POST_COLUMNS)
+        placeholders = ', '.join(['%s'] * len(POST_COLUMNS))
+        self.executemany(f'INSERT INTO posts ({columns}) VALUES ({placeholders})', rows)
+
+    def get_existing_ids(self, meme_ids):
+        """Returns the set of meme_ids that are already in the posts table"""
+        if not meme_ids:
+            return set()
+        placeholders = ', '.join(['%s'] * len(meme_ids))
+        rows = self.execute(
+            f'''
+            SELECT id
+            FROM posts
+            WHERE id IN ({placeholders})
+            ''',
+            tuple(meme_ids),
+        ).fetchall()
+        return {row['id'] for row in rows}
+
+    def update_meme_data(self, meme_dict):
+        """
+        Updates the following fields in database for the row corresponding to meme_dict[id] :
+        ups, last_updated, upvote_ratio, and highest_ups if meme_dict's is higher. Other
+        fields (e.g. posted_to_slack) may have changed since meme_dict was read, so they're
+        left alone
+        :param meme_dict: a dictionary with appropriate data for a meme
+        """
+        self.execute(
+            f'''
+            UPDATE posts
+            SET ups = %s, highest_ups = {self.greatest}(COALESCE(highest_ups, 0), %s), last_updated = %s,
+                upvote_ratio = %s
+            WHERE id = %s
+            ''',
+            (
+                meme_dict['ups'],
+                meme_dict['highest_ups'],
+                meme_dict['last_updated'],
+                meme_dict['upvote_ratio'],
+                meme_dict['id'],
+            ),
+        )
+
+    def set_posted_to_slack(self, meme_id, val):
+        """
+        Updates the value of row meme_id to have a posted_to_slack value of val. Should typically be used
+        to specify a meme has been posted (aka val = True). Callers invalidate the meme's url in
+        scrape_reddit.details_cache
+        :param meme_id: the (Reddit / database row) id of the meme to update
+        :param val: a boolean represnting whether the meme has been posted to reddit
+        """
+        self.execute(
+            '''
+            UPDATE posts
+            SET posted_to_slack = %s
+            WHERE id = %s
+            ''',
+            (val, meme_id),
+        )
+
+    def set_many_posted_to_slack(self, meme_ids, val=True):
+        """Like `set_posted_to_slack`, for many memes in one batch"""
+        self.executemany(
+            '''
+            UPDATE posts
+            SET posted_to_slack = %s
+            WHERE id = %s
+            ''',
+            [(val, meme_id) for meme_id in meme_ids],
+        )
+
+    def add_to_outbox(self, rows):
+        """
+        Queues messages to be posted in one batch
+        :param rows: a list of (channel, meme_id, message, created, position) tuples, message
+        being the json of the chat.postMessage arguments
+        """
+        self.executemany(
+            '''
+            INSERT INTO outbox (channel, meme_id, message, created, position)
+            VALUES (%s, %s, %s, %s, %s)
+            ''',
+            rows,
+        )
+
+    def get_outboxed(self, channel, meme_ids):
+        """Returns the set of meme_ids that have ever been queued in the outbox of channel"""
+        if not meme_ids:
+            return set()
+        placeholders = ', '.join(['%s'] * len(meme_ids))
+        rows = self.execute(
+            f'''
+            SELECT meme_id
+            FROM outbox
+            WHERE channel = %s AND meme_id IN ({placeholders})
+            ''',
+            (channel,) + tuple(meme_ids),
+        ).fetchall()
+        return {row['meme_id'] for row in rows}
+
+    def get_undelivered(self, channel):
+        """Returns the outbox rows of channel that haven't been delivered, oldest first"""
+        return self.execute(
+            '''
+            SELECT channel, meme_id, message
+            FROM outbox
+            WHERE channel = %s AND delivered IS NULL
+            ORDER BY created, position
+            ''',
+            (channel,),
+        ).fetchall()
+
+    def mark_delivered(self, rows):
+        """
+        Marks outbox messages as delivered (or given up on) in one batch
+        :param rows: a list of (delivered, ts, error, channel, meme_id) tuples
+        """
+        self.executemany(
+            '''
+            UPDATE outbox
+            SET delivered = %s, ts = %s, error = %s
+            WHERE channel = %s AND meme_id = %s
+            ''',
+            rows,
+        )
+
+    def get_posted_meme(self, channel, ts):
+        """
+        Returns the posts row of the meme posted as the slack message ts in channel, or None.
+        The outbox keeps the ts of every meme it delivered
+        """
+        return self.execute(
+            '''
+            SELECT posts.*
+            FROM outbox JOIN posts ON posts.id = outbox.meme_id
+            WHERE outbox.channel = %s AND outbox.ts = %s
+            ''',
+            (channel, ts),
+        ).fetchone()
+
+    def get_posted_urls(self, urls, channel=None):
+        """
+        Returns the set of urls among urls that have been posted, to channel if given or else
+        anywhere. Memes posted before the outbox existed count as posted to every channel
+        """
+        if not urls:
+            return set()
+        placeholders = ', '.join(['%s'] * len(urls))
+        if channel is None:
+            rows = self.execute(
+                f'''
+                SELECT DISTINCT url
+                FROM posts
+                WHERE posted_to_slack AND url IN ({placeholders})
+                ''',
+                tuple(urls),
+            ).fetchall()
+            return {row['url'] for row in rows}
+        rows = self.execute(
+            f'''
+            SELECT DISTINCT posts.url
+            FROM posts LEFT JOIN outbox ON outbox.meme_id = posts.id
+            WHERE posts.url IN ({placeholders}) AND posts.posted_to_slack
+            GROUP BY posts.id, posts.url
+            HAVING COUNT(outbox.meme_id) = 0 OR SUM(outbox.channel = %s) > 0
+            ''',
+            tuple(urls) + (channel,),
+        ).fetchall()
+        return {row['url'] for row in rows}
+
+    def has_been_posted_to_slack(self, meme_dict):
+        """
+        Returns whether the passed meme has been posted to slack. NOTE: while `set_posted_to_slack`
+        only sets a single row (based on Reddit / database row id) this function returns True
+        if any row with the same url as the passed meme has been posted to slack.
+        :param meme_dict: a dictionary with a url to check
+        """
+        values = self.execute(
+            '''
+            SELECT posted_to_slack
+            FROM posts
+            WHERE url = %s
+            ''',
+            (meme_dict['url'],),
+        ).fetchall()
+        return any(v['posted_to_slack'] for v in values)
+
+    def set_phashes(self, rows):
+        """
+        Stores the perceptual hashes of memes in one batch
+        :param rows: a list of (phash, id) tuples, phash as a signed 64 bit integer
+        """
+        self.executemany(
+            '''
+            UPDATE posts
+            SET phash = %s
+            WHERE id = %s
+            ''',
+            rows,
+        )
+
+    def get_phash(self, meme_id):
+        """Returns the perceptual hash of meme_id, or None if it hasn't been hashed"""
+        row = self.execute(
+            '''
+            SELECT phash
+            FROM posts
+            WHERE id = %s
+            ''',
+            (meme_id,),
+        ).fetchone()
+        return row['phash'] if row else None
+
+    def get_posted_phashes(self):
+        """Returns a list of (id, phash) for every posted meme that has been hashed"""
+        rows = self.execute(
+            '''
+            SELECT id, phash
+            FROM posts
+            WHERE posted_to_slack AND phash IS NOT NULL
+            ''',
+        ).fetchall()
+        return [(row['id'], row['phash']) for row in rows]
+
+    def summarize_posted_phashes(self, modulus):
+        """
+        Returns the number of posted memes that have been hashed, and the sum of their hashes
+        each taken modulo modulus (always positive, like python's %), as a tuple
+        """
+        row = self.execute(
+            '''
+            SELECT COUNT(*) AS posted, SUM((phash %% %s + %s) %% %s) AS checksum
+            FROM posts
+            WHERE posted_to_slack AND phash IS NOT NULL
+            ''',
+            (modulus, modulus, modulus),
+        ).fetchone()
+        return row['posted'], int(row['checksum'] or 0)
+
+    def add_score_history(self, rows):
+        """
+        Appends upvote observations to the score history in one batch
+        :param rows: a list of (id, ups, upvote_ratio, recorded) tuples, recorded in seconds since the epoch
+        """
+        self.executemany(
+            '''
+            INSERT INTO score_history (id, ups, upvote_ratio, recorded)
+            VALUES (%s, %s, %s, %s)
+            ''',
+            rows,
+        )
+
+    def get_meme_scores(self, meme_ids):
+        """
+        Returns the meme_scores rows for meme_ids as a dict of id -> row, memes that
+        have never been scored are left out
+        """
+        if not meme_ids:
+            return {}
+        placeholders = ', '.join(['%s'] * len(meme_ids))
+        rows = self.execute(
+            f'''
+            SELECT *
+            FROM meme_scores
+            WHERE id IN ({placeholders})
+            ''',
+            tuple(meme_ids),
+        ).fetchall()
+        return {row['id']: row for row in rows}
+
+    def set_meme_scores(self, rows):
+        """
+        Inserts or replaces the ranking state of memes in one batch
+        :param rows: a list of (id, sub, url, ups, velocity, score, last_seen) tuples
+        """
+        self.executemany(
+            '''
+            REPLACE INTO meme_scores (id, sub, url, ups, velocity, score, last_seen)
+            VALUES (%s, %s, %s, %s, %s, %s, %s)
+            ''',
+            rows,
+        )
+
+    def iter_posts(self, sub=None, since=None, until=None, posted=None, batch_size=1000):
+        """
+        Streams the rows of the posts table matching every filter given, see `stream`
+        :param sub: only posts from this sub
+        :param since: only posts created at or after this iso date (or datetime)
+        :param until: only posts created before this iso date (or datetime)
+        :param posted: only posts that have (True) or haven't (False) been posted to slack
+        """
+        conditions, params = [], []
+        if sub is not None:
+            conditions.append('LOWER(sub) = %s')
+            params.append(sub.lower())
+        if since is not None:
+            conditions.append('created_utc >= %s')
+            params.append(str(since))
+        if until is not None:
+            conditions.append('created_utc < %s')
+            params.append(str(until))
+        if posted is not None:
+            conditions.append('posted_to_slack' if posted else 'NOT COALESCE(posted_to_slack, 0)')
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ''
+        return self.stream(f'SELECT * FROM posts {where}', tuple(params), batch_size)
+
+    def get_ups_histogram(self, since):
+        """
+        Returns the number of sfw posts created since `since` (an iso date) for each sub
+        and highest_ups, as a list of dicts with the keys sub, highest_ups and posts
+        """
+        return self.execute(
+            '''
+            SELECT sub, highest_ups, COUNT(*) AS posts
+            FROM posts
+            WHERE created_utc >= %s AND NOT COALESCE(over_18, 0)
+            GROUP BY sub, highest_ups
+            ''',
+            (since,),
+        ).fetchall()
+
+    @abstractmethod
+    def search_posts(self, terms, sub=None, limit=10, offset=0):
+        """
+        Full-text searches the titles of posts, best matches first
+        :param terms: the words to look for
+        :param sub: only posts from this sub
+        :return: a list of posts rows, each with a `score` (higher is a better match)
+        """
+
+    def get_sub_schedules(self):
+        """Returns every sub_schedule row as a dict of sub -> row"""
+        rows = self.execute(
+            '''
+            SELECT *
+            FROM sub_schedule
+            ''',
+        ).fetchall()
+        return {row['sub']: row for row in rows}
+
+    def set_sub_schedules(self, rows):
+        """
+        Inserts or replaces the scrape schedule of subs in one batch
+        :param rows: a list of (sub, rate, interval_min, depth, last_scraped, last_new) tuples
+        """
+        self.executemany(
+            '''
+            REPLACE INTO sub_schedule (sub, rate, interval_min, depth, last_scraped, last_new)
+            VALUES (%s, %s, %s, %s, %s, %s)
+            ''',
+            rows,
+        )
+
+    def acquire_lease(self, name, holder, now, ttl):
+        """
+        Takes or renews the lease name for holder until now + ttl, unless another holder
+        has it and it hasn't expired. Returns whether holder has the lease
+        """
+        with self.transaction():
+            self.execute(
+                f'''
+                {self.insert_ignore} INTO leases (name, holder, expires)
+                VALUES (%s, NULL, 0)
+                ''',
+                (name,),
+            )
+            cursor = self.execute(
+                '''
+                UPDATE leases
+                SET holder = %s, expires = %s
+                WHERE name = %s AND (holder = %s OR holder IS NULL OR expires < %s)
+                ''',
+                (holder, now + ttl, name, holder, now),
+            )
+            return cursor.rowcount == 1
+
+    def release_lease(self, name, holder):
+        """Gives up the lease name if holder has it, so another replica can take it straight away"""
+        self.execute(
+            '''
+            UPDATE leases
+            SET holder = NULL, expires = 0
+            WHERE name = %s AND holder = %s
+            ''',
+            (name, holder),
+        )
+
+    def heartbeat(self, replica_id, now):
+        """Records that replica_id is alive at now"""
+        self.execute(
+            '''
+            REPLACE INTO replicas (replica_id, heartbeat)
+            VALUES (%s, %s)
+            ''',
+            (replica_id, now),
+        )
+
+    def get_live_replicas(self, since):
+        """Returns the ids of the replicas with a heartbeat at or after since, sorted"""
+        rows = self.execute(
+            '''
+            SELECT replica_id
+            FROM replicas
+            WHERE heartbeat >= %s
+            ORDER BY replica_id
+            ''',
+            (since,),
+        ).fetchall()
+        return [row['replica_id'] for row in rows]
+
+    def remove_replica(self, replica_id):
+        self.execute(
+            '''
+            DELETE FROM replicas
+            WHERE replica_id = %s
+            ''',
+            (replica_id,),
+        )
+
+
+class MySQLStorage(Storage):
+    """Storage on a MySQL server, through pymysql"""
+    engine = 'mysql'
+    insert_ignore = 'INSERT IGNORE'
+    greatest = 'GREATEST'
+
+    def __init__(self, user, password, db, host, charset='utf8mb4', **kwargs):
+        self.user = user
+        self.password = password
+        self.db = db
+        self.host = host
+        self.charset = charset
+        self.kwargs = kwargs
+        super().__init__()
+
+    def _unavailable_errors(self):
+        import pymysql
+
+        return pymysql.err.OperationalError, pymysql.err.InterfaceError
+
+    def _is_unavailable(self, error):
+        import pymysql
+
+        if isinstance(error, pymysql.err.InterfaceError):
+            return True
+        # OperationalError also covers deadlocks and lock wait timeouts, which are retried instead
+        code = error.args[0] if error.args else None
+        return code in MYSQL_UNAVAILABLE_CODES or (isinstance(code, int) and 2000 <= code < 3000)
+
+    def _reconnect(self):
+        self.connection.ping(reconnect=True)
+
+    def connect(self):
+        import pymysql
+
+        return pymysql.connect(
+            user=self.user,
+            password=self.password,
+            db=self.db,
+            host=self.host,
+            cursorclass=pymysql.cursors.DictCursor,
+            charset=self.charset,
+            autocommit=True,
+            **self.kwargs,
+        )
+
+    def _stream_cursor(self):
+        import pymysql
+
+        # unbuffered, rows are read off the socket as they are fetched
+        return self.connection.cursor(pymysql.cursors.SSDictCursor)
+
+    def _begin(self):
+        self.connection.begin()
+
+    def create_tables(self):
+        super().create_tables()
+        # ids are TEXT, so only a prefix can be indexed, which is all of any reddit id
+        if not self.execute("SHOW INDEX FROM posts WHERE Key_name = 'posts_id'").fetchall():
+            self.execute('CREATE INDEX posts_id ON posts (id(16))')
+        # the channels each meme was posted to, see get_posted_urls
+        if not self.execute("SHOW INDEX FROM outbox WHERE Key_name = 'outbox_meme_id'").fetchall():
+            self.execute('CREATE INDEX outbox_meme_id ON outbox (meme_id)')
+        # the slack message each meme was posted as, see get_posted_meme
+        if not self.execute("SHOW INDEX FROM outbox WHERE Key_name = 'outbox_ts'").fetchall():
+            self.execute('CREATE INDEX outbox_ts ON outbox (channel, ts)')
+        # innodb keeps the full-text index up to date on every insert, see search_posts
+        if not self.execute("SHOW INDEX FROM posts WHERE Key_name = 'posts_title_ft'").fetchall():
+            self.execute('ALTER TABLE posts ADD FULLTEXT INDEX posts_title_ft (title)')
+
+    def search_posts(self, terms, sub=None, limit=10, offset=0):
+        words = re.findall(r'\w+', terms)
+        if not words:
+            return []
+        condition = 'AND LOWER(sub) = %(sub)s' if sub is not None else ''
+        return self.execute(
+            f'''
+            SELECT *, MATCH (title) AGAINST (%(terms)s IN BOOLEAN MODE) AS score
+            FROM posts
+            WHERE MATCH (title) AGAINST (%(terms)s IN BOOLEAN MODE) {condition}
+            ORDER BY score DESC, created_utc DESC
+            LIMIT %(limit)s OFFSET %(offset)s
+            ''',
+            {
+                # like the sqlite index, every word must match, as a prefix
+                'terms': ' '.join(f'+{word}*' for word in words),
+                'sub': sub and sub.lower(),
+                'limit': limit,
+                'offset': offset,
+            },
+        ).fetchall()
+
+
+class SQLiteStorage(Storage):
+    """
+    Storage in a local sqlite3 file, for small deployments and for benchmarking without
+    a MySQL server. The connection runs in autocommit mode with WAL journaling, and
+    relies on sqlite3's statement cache so every query is only compiled once.
+    """
+    engine = 'sqlite'
+    insert_ignore = 'INSERT OR IGNORE'
+    greatest = 'MAX'
+
+    pragmas = (
+        ('journal_mode', 'WAL'),
+        ('synchronous', 'NORMAL'),
+        ('temp_store', 'MEMORY'),
+        ('cache_size', -20000),  # negative values are in KiB, so ~20MB
+        ('mmap_size', 256 * 1024 * 1024),
+        ('busy_timeout', 5000),
+    )
+
+    def __init__(self, path=utils.SQLITE_FILE, cached_statements=256):
+        self.path = path
+        self.cached_statements = cached_statements
+        super().__init__()
+
+    def connect(self):
+        connection = sqlite3.connect(
+            self.path,
+            isolation_level=None,  # autocommit, transactions are started explicitly
+            check_same_thread=False,  # the bot shares one connection, guarded by its lock
+            cached_statements=self.cached_statements,
+        )
+        connection.row_factory = _dict_factory
+        for pragma, value in self.pragmas:
+            connection.execute(f'PRAGMA {pragma} = {value}')
+        return connection
+
+    def _unavailable_errors(self):
+        return (sqlite3.OperationalError,)
+
+    def _is_unavailable(self, error):
+        # OperationalError also covers bad queries, missing tables and a missing FTS5
+        message = str(error).lower()
+        return any(reason in message for reason in SQLITE_UNAVAILABLE_MESSAGES)
+
+    def sql(self, query):
+        return _to_qmark(query)
+
+    def _begin(self):
+        self.cursor.execute('BEGIN')
+
+    def create_tables(self):
+        super().create_tables()
+        self.execute('CREATE INDEX IF NOT EXISTS posts_id ON posts (id)')
+        self.execute('CREATE INDEX IF NOT EXISTS posts_url ON posts (url)')
+        self.execute('CREATE INDEX IF NOT EXISTS score_history_id ON score_history (id, recorded)')
+        self.execute('CREATE INDEX IF NOT EXISTS outbox_undelivered ON outbox (channel, delivered)')
+        self.execute('CREATE INDEX IF NOT EXISTS outbox_meme_id ON outbox (meme_id)')
+        self.execute('CREATE INDEX IF NOT EXISTS outbox_ts ON outbox (channel, ts)')
+        # covers get_ups_histogram, which then never reads the table itself
+        self.execute('CREATE INDEX IF NOT EXISTS posts_sub_ups ON posts (sub, highest_ups, created_utc, over_18)')
+        self.create_search_index()
+
+    def create_search_index(self):
+        """
+        Creates the FTS5 index over post titles used by search_posts, kept up to date by
+        triggers on posts and filled from the posts already there. Without FTS5 in this
+        build of sqlite, search_posts falls back to scanning the titles
+        """
+        if self._has_search_index():
+            return
+        try:
+            with self.transaction():
+                self.execute('''
+                    CREATE VIRTUAL TABLE posts_fts USING fts5 (
+                        title, content='posts', content_rowid='rowid', tokenize='unicode61 remove_diacritics 2'
+                    )
+                ''')
+                self.execute('''
+                    CREATE TRIGGER posts_fts_insert AFTER INSERT ON posts BEGIN
+                        INSERT INTO posts_fts (rowid, title) VALUES (new.rowid, new.title);
+                    END
+                ''')
+                self.execute('''
+                    CREATE TRIGGER posts_fts_delete AFTER DELETE ON posts BEGIN
+                        INSERT INTO posts_fts (posts_fts, rowid, title) VALUES ('delete', old.rowid, old.title);
+                    END
+                ''')
+                # scores are updated all the time, titles never, so only title updates touch the index
+                self.execute('''
+                    CREATE TRIGGER posts_fts_update AFTER UPDATE OF title ON posts BEGIN
+                        INSERT INTO posts_fts (posts_fts, rowid, title) VALUES ('delete', old.rowid, old.title);
+                        INSERT INTO posts_fts (rowid, title) VALUES (new.rowid, new.title);
+                    END
+                ''')
+                self.execute("INSERT INTO posts_fts (posts_fts) VALUES ('rebuild')")
+        except sqlite3.OperationalError as e:
+            utils.log_error(e)
+
+    def _has_search_index(self):
+        row = self.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'posts_fts'").fetchone()
+        return row is not None
+
+    def search_posts(self, terms, sub=None, limit=10, offset=0):
+        words = re.findall(r'\w+', terms)
+        if not words:
+            return []
+        params = []
+        if self._has_search_index():
+            # every word must match, as a prefix, quoted so nothing is read as fts5 syntax
+            params.append(' '.join(f'"{word}"*' for word in words))
+            query = '''
+                SELECT posts.*, -bm25(posts_fts) AS score
+                FROM posts_fts JOIN posts ON posts.rowid = posts_fts.rowid
+                WHERE posts_fts MATCH %s
+            '''
+        else:
+            params.extend(f'%{word}%' for word in words)
+            query = f'''
+                SELECT posts.*, 0 AS score
+                FROM posts
+                WHERE {' AND '.join(['title LIKE %s'] * len(words))}
+            '''
+        if sub is not None:
+            query += ' AND LOWER(posts.sub) = %s'
+            params.append(sub.lower())
+        query += ' ORDER BY score DESC, posts.created_utc DESC LIMIT %s OFFSET %s'
+        params.extend((limit, offset))
+        return self.execute(query, tuple(params)).fetchall()
+
+
+def open_storage(db_info):
+    """
+    Opens the storage described by db_info, the contents of db.json. The `engine` key
+    picks the backend, `mysql` (the default, using user/password/db/host) or `sqlite`
+    (using an optional `path`)
+    """
+    db_info = dict(db_info)
+    engine = db_info.pop('engine', MySQLStorage.engine)
+    if engine == SQLiteStorage.engine:
+        return SQLiteStorage(db_info.get('path', utils.SQLITE_FILE))
+    elif engine == MySQLStorage.engine:
+        return MySQLStorage(
+            db_info.pop('user'),
+            db_info.pop('password'),
+            db_info.pop('db'),
+            db_info.pop('host'),
+            **db_info,
+        )
+    raise ValueError(f'unknown database engine {engine!r}, expected mysql or sqlite')
+
+
+def load_storage(path='db.json'):
+    """Opens the storage configured in the json file at path"""
+    with open(path, 'r') as f:
+        return open_storage(json.loads(f.read()))
@@ -0,0 +1,129 @@
+import threading
+
+import pytest
+
+import cache
+
+
+class FakeTime:
+    def __init__(self):
+        self.time = 1000.0
+
+    def __call__(self):
+        return self.time
+
+
+@pytest.fixture
+def now():
+    return FakeTime()
+
+
+@pytest.fixture
+def ttl_cache(now):
+    return cache.TTLCache(ttl=60, max_size=3, now=now)
+
+
+def compute_in_thread(ttl_cache, key, compute):
+    """Starts get_or_compute(key, compute) in a thread, returns the thread and a list its result is added to"""
+    results = []
+    thread = threading.Thread(target=lambda: results.append(ttl_cache.get_or_compute(key, compute)))
+    thread.start()
+    return thread, results
+
+
+def test_entries_expire_after_ttl(ttl_cache, now):
+    ttl_cache.put('a', 1)
+    now.time += 59
+    assert ttl_cache.get('a') == 1
+    now.time += 1
+    assert ttl_cache.get('a') is None
+
+
+def test_oldest_entries_are_evicted(ttl_cache):
+    for key in 'abcd':
+        ttl_cache.put(key, key)
+    assert ttl_cache.get('a') is None
+    assert [ttl_cache.get(key) for key in 'bcd'] == ['b', 'c', 'd']
+
+
+def test_none_results_are_not_cached(ttl_cache):
+    calls = []
+    for _ in range(2):
+        assert ttl_cache.get_or_compute('a', lambda: calls.append(1)) is None
+    assert len(calls) == 2
+
+
+def test_concurrent_callers_share_one_computation(ttl_cache):
+    started, release = threading.Event(), threading.Event()
+    calls = []
+
+    def compute():
+        calls.append(1)
+        started.set()
+        release.wait(5)
+        return 'value'
+
+    owner, owner_results = compute_in_thread(ttl_cache, 'a', compute)
+    started.wait(5)
+    waiters = [compute_in_thread(ttl_cache, 'a', compute) for _ in range(5)]
+    release.set()
+    for thread, _ in [(owner, owner_results)] + waiters:
+        thread.join(5)
+    assert calls == [1]
+    assert owner_results + sum((results for _, results in waiters), []) == ['value'] * 6
+    assert (ttl_cache.misses, ttl_cache.hits) == (1, 5)
+    assert ttl_cache.get_or_compute('a', compute) == 'value'
+    assert calls == [1]
+
+
+def test_waiters_get_the_computation_error(ttl_cache):
+    started, release = threading.Event(), threading.Event()
+    errors = []
+
+    def compute():
+        started.set()
+        release.wait(5)
+        raise KeyError('a')
+
+    def call():
+        try:
+            ttl_cache.get_or_compute('a', compute)
+        except KeyError as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=call)]
+    threads[0].start()
+    started.wait(5)
+    threads.append(threading.Thread(target=call))
+    threads[1].start()
+    release.set()
+    for thread in threads:
+        thread.join(5)
+    assert len(errors) == 2
+    assert ttl_cache.get('a') is None
+
+
+def test_invalidated_in_flight_results_are_not_cached(ttl_cache):
+    started, release = threading.Event(), threading.Event()
+
+    def compute():
+        started.set()
+        release.wait(5)
+        return 'old'
+
+    thread, results = compute_in_thread(ttl_cache, 'a', compute)
+    started.wait(5)
+    # the data changed while it was being read, so what is being computed is out of date
+    ttl_cache.invalidate('a')
+    release.set()
+    thread.join(5)
+    assert results == ['old']
+    assert ttl_cache.get('a') is None
+    assert ttl_cache.get_or_compute('a', lambda: 'new') == 'new'
+
+
+def test_invalidate_many(ttl_cache):
+    for key in 'abc':
+        ttl_cache.put(key, key)
+    ttl_cache.invalidate_many(['a', 'c', 'x'])
+    assert [ttl_cache.get(key) for key in 'abc'] == [None, 'b', None]
@@ -0,0 +1,128 @@
+import pytest
+
+import circuit
+
+
+class FakeTime:
+    def __init__(self):
+        self.time = 1000.0
+
+    def __call__(self):
+        return self.time
+
+
+class Down(Exception):
+    pass
+
+
+@pytest.fixture
+def now():
+    return FakeTime()
+
+
+@pytest.fixture
+def breaker(now):
+    return circuit.CircuitBreaker('test', failure_threshold=3, reset_timeout=10, max_reset_timeout=40, now=now)
+
+
+def fail(breaker):
+    with pytest.raises(Down):
+        with breaker.guard((Down,)):
+            raise Down()
+
+
+def succeed(breaker):
+    with breaker.guard((Down,)) as probe:
+        return probe
+
+
+def test_opens_after_threshold_consecutive_failures(breaker):
+    fail(breaker)
+    fail(breaker)
+    assert breaker.state == circuit.CLOSED
+    fail(breaker)
+    assert breaker.state == circuit.OPEN
+    with pytest.raises(circuit.CircuitOpen):
+        succeed(breaker)
+
+
+def test_success_resets_the_failure_count(breaker):
+    fail(breaker)
+    fail(breaker)
+    succeed(breaker)
+    fail(breaker)
+    fail(breaker)
+    assert breaker.state == circuit.CLOSED
+
+
+def test_other_errors_count_as_successes(breaker):
+    fail(breaker)
+    fail(breaker)
+    with pytest.raises(KeyError):
+        with breaker.guard((Down,)):
+            raise KeyError()
+    fail(breaker)
+    assert breaker.state == circuit.CLOSED
+
+
+def test_half_open_lets_a_single_probe_through(breaker, now):
+    for _ in range(3):
+        fail(breaker)
+    now.time += 10
+    assert breaker.state == circuit.HALF_OPEN
+    assert breaker.available()
+
+    with breaker.guard((Down,)) as probe:
+        assert probe
+        # everyone else is turned away while the probe is out
+        assert not breaker.available()
+        with pytest.raises(circuit.CircuitOpen):
+            succeed(breaker)
+    assert breaker.state == circuit.CLOSED
+    assert succeed(breaker) is False
+
+
+def test_failed_probes_double_the_reset_timeout_up_to_the_max(breaker, now):
+    for _ in range(3):
+        fail(breaker)
+    now.time += 10
+    for expected in (20, 40, 40):
+        fail(breaker)
+        assert breaker.state == circuit.OPEN
+        assert breaker.retry_in() == expected
+        now.time += expected - 1
+        assert breaker.state == circuit.OPEN
+        now.time += 1
+        assert breaker.state == circuit.HALF_OPEN
+
+
+def test_a_successful_probe_restores_the_reset_timeout(breaker, now):
+    for _ in range(3):
+        fail(breaker)
+    now.time += 10
+    fail(breaker)
+    now.time += 20
+    assert succeed(breaker) is True
+    assert breaker.reset_timeout == 10
+    assert breaker.retry_in() == 0
+    assert breaker.describe() == 'test: closed'
+
+
+def test_describe_open_breaker(breaker, now):
+    for _ in range(3):
+        fail(breaker)
+    now.time += 4
+    assert breaker.describe() == 'test: open, retrying in 6s'
+
+
+def test_errors_that_are_not_outages_do_not_count(breaker):
+    for _ in range(5):
+        with pytest.raises(Down):
+            with breaker.guard((Down,), unavailable=lambda e: e.args == ('outage',)):
+                raise Down('bad request')
+    assert breaker.state == circuit.CLOSED
+    for _ in range(3):
+        with pytest.raises(Down):
+            with breaker.guard((Down,), unavailable=lambda e: e.args == ('outage',)):
+                raise Down('outage')
+    assert breaker.state == circuit.OPEN
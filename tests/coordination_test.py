@@ -0,0 +1,128 @@
+import collections
+
+import pytest
+
+import coordination
+import storage
+import utils
+
+
+class FakeClock(utils.Clock):
+    def __init__(self):
+        self.time = 1000.0
+
+    def now(self):
+        return self.time
+
+    def wait(self, event, timeout):
+        return event.is_set()
+
+
+class BrokenStorage:
+    def __getattr__(self, name):
+        raise ConnectionError('the database is down')
+
+
+@pytest.fixture
+def clock():
+    return FakeClock()
+
+
+@pytest.fixture
+def make_replica(tmp_path, clock):
+    """Returns a function making a Coordinator with its own connection to one sqlite database"""
+    path = str(tmp_path / 'coordination.sqlite3')
+    storage.SQLiteStorage(path).create_tables()
+
+    def make(replica_id, **kwargs):
+        return coordination.Coordinator(
+            storage.SQLiteStorage(path), replica_id=replica_id, lease_seconds=15, heartbeat_seconds=5,
+            clock=clock, **kwargs,
+        )
+    return make
+
+
+def test_only_one_replica_leads(make_replica):
+    a, b = make_replica('a'), make_replica('b')
+    a.beat()
+    b.beat()
+    assert a.is_leader()
+    assert not b.is_leader()
+    assert not b.owns('me_irl')
+    assert a.owns('me_irl')
+
+
+def test_leader_renews_its_lease(make_replica, clock):
+    a, b = make_replica('a'), make_replica('b')
+    for _ in range(10):
+        a.beat()
+        b.beat()
+        assert a.is_leader() and not b.is_leader()
+        clock.time += 5
+
+
+def test_standby_takes_over_once_the_lease_expires(make_replica, clock):
+    a, b = make_replica('a'), make_replica('b')
+    a.beat()
+    # a dies, the lease runs out after lease_seconds
+    clock.time += 14
+    b.beat()
+    assert not b.is_leader()
+    clock.time += 2
+    b.beat()
+    assert b.is_leader()
+
+
+def test_leader_steps_down_before_its_lease_expires(make_replica, clock):
+    a, b = make_replica('a'), make_replica('b')
+    a.beat()
+    a._db.set(BrokenStorage())
+    clock.time += 5
+    a.beat()
+    # it couldn't renew, and stops leading a heartbeat before anyone else can take over
+    assert a.is_leader()
+    clock.time += 5
+    assert not a.is_leader()
+    b.beat()
+    assert not b.is_leader()
+    # and the lease it still holds in the database runs out
+    clock.time += 6
+    b.beat()
+    assert b.is_leader()
+
+
+def test_released_lease_is_taken_at_the_next_heartbeat(make_replica):
+    a, b = make_replica('a'), make_replica('b')
+    a.beat()
+    b.beat()
+    a.release()
+    assert not a.is_leader()
+    b.beat()
+    assert b.is_leader()
+
+
+def test_run_releases_the_lease_when_stopped(make_replica):
+    a, b = make_replica('a'), make_replica('b')
+    a.start()
+    a.stop()
+    b.beat()
+    assert b.is_leader()
+
+
+def test_sharded_subs_are_split_between_live_replicas(make_replica, clock):
+    replicas = [make_replica(name, shard_scrapes=True) for name in ('a', 'b', 'c')]
+    for replica in replicas:
+        replica.beat()
+    for replica in replicas:
+        replica.beat()
+    subs = [f'sub{i}' for i in range(60)]
+    owners = collections.Counter(sum(replica.owns(sub) for replica in replicas) for sub in subs)
+    assert owners == {1: len(subs)}
+    assert all(any(replica.owns(sub) for sub in subs) for replica in replicas)
+
+    # c stops beating, and its subs move to the others once it times out and they have both beaten again
+    clock.time += coordination.REPLICA_TIMEOUT_SECONDS + 1
+    for _ in range(2):
+        for replica in replicas[:2]:
+            replica.beat()
+    assert all(sum(replica.owns(sub) for replica in replicas[:2]) == 1 for sub in subs)
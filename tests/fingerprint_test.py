@@ -0,0 +1,89 @@
+import random
+
+import pytest
+
+import fingerprint
+
+
+class HashStorage:
+    """The phash queries of storage.Storage, over a dict of id -> signed hash"""
+
+    def __init__(self, phashes, posted=()):
+        self.phashes = phashes
+        self.posted = set(posted)
+        self.queries = 0
+
+    def get_phash(self, meme_id):
+        self.queries += 1
+        return self.phashes.get(meme_id)
+
+    def get_posted_phashes(self):
+        return [(meme_id, value) for meme_id, value in self.phashes.items() if meme_id in self.posted]
+
+    def summarize_posted_phashes(self, modulus):
+        values = [value for meme_id, value in self.phashes.items() if meme_id in self.posted]
+        return len(values), sum(value % modulus for value in values)
+
+
+def flip(value, bits):
+    """value with its lowest `bits` bits flipped"""
+    return value ^ ((1 << bits) - 1)
+
+
+@pytest.fixture
+def fingerprinter():
+    f = fingerprint.Fingerprinter()
+    # the tests never hash images, so Pillow isn't needed
+    f.enabled = True
+    return f
+
+
+def test_signed_round_trip():
+    for value in (0, 1, (1 << 63) - 1, 1 << 63, (1 << 64) - 1):
+        signed = fingerprint.to_signed(value)
+        assert -(1 << 63) <= signed < (1 << 63)
+        assert fingerprint.to_unsigned(signed) == value
+
+
+def test_bk_tree_search_matches_brute_force():
+    rng = random.Random(0)
+    values = [rng.getrandbits(64) for _ in range(300)]
+    values += [flip(value, 3) for value in values[:30]]
+    tree = fingerprint.BKTree()
+    for i, value in enumerate(values):
+        tree.add(value, i)
+    assert tree.size == len(values)
+    for query in values[:50]:
+        distances = [(fingerprint.hamming(query, value), i) for i, value in enumerate(values)]
+        assert sorted(tree.search(query, 6)) == sorted(match for match in distances if match[0] <= 6)
+
+
+def test_finds_posted_near_duplicates(fingerprinter):
+    posted = random.Random(1).getrandbits(64)
+    db = HashStorage({'old': fingerprint.to_signed(posted), 'new': fingerprint.to_signed(flip(posted, 4))}, ['old'])
+    value = fingerprinter.image_hash(db, 'new')
+    assert fingerprinter.find_posted_duplicates(db, 'new', value) == [(4, 'old')]
+    assert fingerprinter.find_posted_duplicates(db, 'new', flip(posted, 20)) == []
+
+
+def test_unhashed_memes_have_no_duplicates(fingerprinter):
+    db = HashStorage({})
+    assert fingerprinter.image_hash(db, 'new') is None
+    assert fingerprinter.find_posted_duplicates(db, 'new', None) == []
+
+
+def test_picked_memes_are_checked_without_queries(fingerprinter):
+    rng = random.Random(2)
+    picked = [(f'p{i}', rng.getrandbits(64)) for i in range(20)]
+    db = HashStorage({})
+    candidate = flip(picked[7][1], 2)
+    assert fingerprinter.find_posted_duplicates(db, 'new', candidate, picked=picked) == [(2, 'p7')]
+    assert db.queries == 0
+
+
+def test_mark_posted_adds_to_the_index(fingerprinter):
+    value = random.Random(3).getrandbits(64)
+    db = HashStorage({'a': fingerprint.to_signed(value)})
+    assert fingerprinter.find_posted_duplicates(db, 'b', value) == []
+    fingerprinter.mark_posted(db, 'a')
+    assert fingerprinter.find_posted_duplicates(db, 'b', value) == [(0, 'a')]
@@ -0,0 +1,116 @@
+import json
+
+import pytest
+
+import records
+import storage
+import utils
+
+
+CHANNEL = 'CREPLAY'
+
+
+@pytest.fixture
+def db(tmp_path):
+    db = storage.SQLiteStorage(str(tmp_path / 'replay.sqlite3'))
+    db.create_tables()
+    for i in range(5):
+        db.add_meme_data(records.Meme(id=f'id{i}', url=f'https://i.redd.it/{i}.jpg', title=f'meme {i}').to_row())
+    return db
+
+
+@pytest.fixture
+def make_bot(tmp_path, db):
+    """Returns a function making a bot on the same database, as if the previous one had been restarted"""
+    pytest.importorskip('slackclient')
+    import fakes
+    import replay
+
+    # utils.init only creates them once per process
+    for path in (utils.SCRAPED_PATH, utils.SETTINGS_PATH):
+        utils.ensure_json_file(path)
+
+    def make(client=None):
+        bot = replay.make_bot('UBOT', str(tmp_path), client=client or fakes.FakeSlackClient())
+        bot._db.set(db)
+        return bot
+    return make
+
+
+def picked(*ids):
+    return [(f'id{i}', f'https://i.redd.it/{i}.jpg', {'channel': CHANNEL, 'text': f'meme {i}'}) for i in ids]
+
+
+def deliver_all(bot):
+    while not bot.outbox.empty():
+        bot.pop_queue()
+
+
+class FailingClient:
+    """A slack client failing every post with error"""
+
+    def __init__(self, error):
+        self.error = error
+        self.calls = 0
+
+    def api_call(self, method, **kwargs):
+        if method == 'users.list':
+            return {'ok': True, 'members': []}
+        self.calls += 1
+        return {'ok': False, 'error': self.error}
+
+
+def test_undelivered_rows_come_back_in_order(db):
+    db.add_to_outbox([
+        (CHANNEL, 'id2', '{}', 10.0, 0), (CHANNEL, 'id0', '{}', 10.0, 1), ('COTHER', 'id1', '{}', 5.0, 0),
+    ])
+    db.add_to_outbox([(CHANNEL, 'id1', '{}', 5.0, 0)])
+    assert [row['meme_id'] for row in db.get_undelivered(CHANNEL)] == ['id1', 'id2', 'id0']
+    db.mark_delivered([(20.0, '1.0001', None, CHANNEL, 'id2')])
+    assert [row['meme_id'] for row in db.get_undelivered(CHANNEL)] == ['id1', 'id0']
+    assert db.get_outboxed(CHANNEL, ['id0', 'id2', 'id3']) == {'id0', 'id2'}
+
+
+def test_enqueued_memes_are_posted_and_recorded(make_bot, db):
+    bot = make_bot()
+    assert bot.enqueue_memes(picked(0, 1)) == ['id0', 'id1']
+    assert db.get_meme_data('id0')['posted_to_slack']
+    assert db.get_posted_urls(['https://i.redd.it/0.jpg', 'https://i.redd.it/2.jpg'], CHANNEL) == {
+        'https://i.redd.it/0.jpg',
+    }
+
+    deliver_all(bot)
+    posted = bot.client.posted(CHANNEL)
+    assert [kwargs['text'] for _, kwargs in posted] == ['meme 0', 'meme 1']
+    assert db.get_undelivered(CHANNEL) == []
+    ts = db.execute('SELECT ts FROM outbox WHERE meme_id = %s', ('id1',)).fetchone()['ts']
+    assert db.get_posted_meme(CHANNEL, ts)['id'] == 'id1'
+
+
+def test_memes_picked_again_after_a_crash_are_not_queued_twice(make_bot):
+    bot = make_bot()
+    bot.enqueue_memes(picked(0))
+    assert bot.enqueue_memes(picked(0, 1)) == ['id1']
+
+
+def test_a_restarted_bot_resumes_the_outbox(make_bot, db):
+    make_bot().enqueue_memes(picked(2, 0, 1))
+    bot = make_bot()
+    bot.resume_outbox()
+    deliver_all(bot)
+    assert [kwargs['text'] for _, kwargs in bot.client.posted(CHANNEL)] == ['meme 2', 'meme 0', 'meme 1']
+
+    restarted = make_bot()
+    restarted.resume_outbox()
+    assert restarted.outbox.empty()
+
+
+def test_failed_posts_are_given_up_on_after_outbox_attempts(make_bot, db):
+    client = FailingClient('channel_not_found')
+    bot = make_bot(client)
+    bot.enqueue_memes(picked(0))
+    deliver_all(bot)
+    assert client.calls == bot.OUTBOX_ATTEMPTS
+    row = db.execute('SELECT * FROM outbox WHERE meme_id = %s', ('id0',)).fetchone()
+    assert row['delivered'] is not None and row['error'] == 'channel_not_found'
+    assert json.loads(row['message'])['text'] == 'meme 0'
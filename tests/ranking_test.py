@@ -0,0 +1,83 @@
+import pytest
+
+import ranking
+import records
+import storage
+
+
+HOUR = 3600
+NOW = 1700000000.0
+
+
+def meme(i, ups=100, sub='me_irl', age_hours=1.0, score=0.0):
+    return records.Meme(
+        id=f'id{i}', url=f'https://i.redd.it/{i}.jpg', sub=sub, ups=ups,
+        created_utc=NOW - age_hours * HOUR, score=score,
+    )
+
+
+def test_first_velocity_is_the_average_rate_since_creation():
+    assert ranking.velocity(120, NOW, NOW - 2 * HOUR) == pytest.approx(60)
+
+
+def test_first_velocity_of_a_brand_new_post_is_bounded():
+    assert ranking.velocity(10, NOW, NOW) == pytest.approx(10 / ranking.MIN_INTERVAL_HOURS)
+    assert ranking.velocity(-5, NOW, NOW - HOUR) == 0
+
+
+def test_velocity_is_a_moving_average_of_the_rate_between_observations():
+    previous = {'ups': 100, 'velocity': 40.0, 'last_seen': NOW - HOUR}
+    # 60 upvotes in the last hour, averaged with the previous 40 / hour
+    assert ranking.velocity(160, NOW, NOW - 5 * HOUR, previous) == pytest.approx(50)
+    # losing upvotes counts as no new ones
+    assert ranking.velocity(90, NOW, NOW - 5 * HOUR, previous) == pytest.approx(20)
+
+
+def test_rank_key_orders_like_the_decayed_score_at_any_time():
+    memes = [(velocity, NOW - age * HOUR) for velocity in (0, 5, 50, 500) for age in (0, 3, 6, 24)]
+    keys = [ranking.rank_key(velocity, created) for velocity, created in memes]
+    for later in (0, 1, 12, 48):
+        now = NOW + later * HOUR
+        scores = [(1 + velocity) * 2 ** -((now - created) / (ranking.HALF_LIFE_HOURS * HOUR))
+                  for velocity, created in memes]
+        assert sorted(range(len(memes)), key=keys.__getitem__) == sorted(range(len(memes)), key=scores.__getitem__)
+
+
+def test_a_half_life_of_age_is_worth_twice_the_velocity():
+    # keys are in log2(1 + velocity)
+    old = ranking.rank_key(2 * (1 + 10) - 1, NOW - ranking.HALF_LIFE_HOURS * HOUR)
+    new = ranking.rank_key(10, NOW)
+    assert old == pytest.approx(new)
+
+
+def test_current_score_of_a_new_meme_is_its_velocity():
+    assert ranking.current_score(ranking.rank_key(30, NOW), NOW) == pytest.approx(30)
+
+
+def test_prune_drops_only_stale_memes():
+    memes = {m.url: m for m in (meme(1, age_hours=1), meme(2, age_hours=47), meme(3, age_hours=49))}
+    assert ranking.prune(memes, now=NOW, max_age_hours=48) == 1
+    assert sorted(m.id for m in memes.values()) == ['id1', 'id2']
+    assert ranking.prune(memes, now=NOW + 100 * HOUR, max_age_hours=None) == 0
+
+
+def test_heaps_pop_the_best_ranked_meme_of_each_sub_first():
+    memes = [meme(1, score=1.0), meme(2, score=3.0), meme(3, score=2.0), meme(4, sub='dankmemes', score=0.5)]
+    heaps = ranking.heaps_by_sub(memes)
+    assert [ranking.pop_best(heaps['me_irl']).id for _ in range(3)] == ['id2', 'id3', 'id1']
+    assert ranking.pop_best(heaps['dankmemes']).id == 'id4'
+
+
+def test_record_scores_keeps_the_velocity_between_scrapes(tmp_path):
+    db = storage.SQLiteStorage(str(tmp_path / 'memes.sqlite3'))
+    db.create_tables()
+    first = meme(1, ups=100, age_hours=2)
+    ranking.record_scores(db, [first], now=NOW)
+    assert first.velocity == pytest.approx(50)
+
+    again = meme(1, ups=150, age_hours=2)
+    ranking.record_scores(db, [again], now=NOW + HOUR)
+    assert again.velocity == pytest.approx(50)
+    assert again.score == pytest.approx(ranking.rank_key(50, again.created_utc))
+    stored = db.get_meme_scores(['id1'])['id1']
+    assert (stored['ups'], stored['last_seen']) == (150, NOW + HOUR)
@@ -0,0 +1,103 @@
+import json
+
+import pytest
+
+import records
+
+
+def meme(i, ups=100, sub='me_irl'):
+    return records.Meme(id=f'id{i}', url=f'https://i.redd.it/{i}.jpg', title=f'meme {i}', sub=sub, ups=ups)
+
+
+@pytest.fixture
+def store(tmp_path):
+    return records.PendingStore(str(tmp_path / 'scraped.json'))
+
+
+def test_skips_a_line_cut_short(store):
+    store.append([meme(1)])
+    with open(store.path, 'a') as f:
+        f.write('{"url": "https://i.redd.it/2.jpg", "ti')
+    assert list(store.load()) == ['https://i.redd.it/1.jpg']
+
+
+def test_appends_after_a_line_cut_short(store):
+    store.append([meme(1)])
+    with open(store.path, 'a') as f:
+        f.write('{"url": "https://i.redd.it/2.jpg", "ti')
+    store.append([meme(3)])
+    assert list(store.load()) == ['https://i.redd.it/1.jpg', 'https://i.redd.it/3.jpg']
+
+
+def urls(*ids):
+    return [f'https://i.redd.it/{i}.jpg' for i in ids]
+
+
+def test_missing_store_raises_oserror(store):
+    with pytest.raises(OSError):
+        store.load()
+
+
+def test_replays_appends_and_deletions_in_order(store):
+    store.append([meme(1), meme(2)])
+    store.append([meme(3), meme(1, ups=500)])
+    memes = store.load()
+    assert list(memes) == urls(1, 2, 3)
+    assert memes[urls(1)[0]].highest_ups == 500
+
+    store.remove(urls(2), {url: m for url, m in memes.items() if url != urls(2)[0]})
+    store.append([meme(2)])
+    memes = store.load()
+    assert sorted(memes) == sorted(urls(1, 2, 3))
+    assert store.lines == 6
+
+
+def test_round_trips_memes(store):
+    original = meme(1)
+    original.created_utc = 1700000000.0
+    original.velocity, original.score = 12.5, 3.25
+    store.append([original])
+    loaded = store.load()[original.url]
+    assert loaded.to_dict() == original.to_dict()
+
+
+def test_remove_appends_deletions_while_the_journal_is_small(store):
+    store.append([meme(i) for i in range(10)])
+    memes = store.load()
+    del memes[urls(0)[0]]
+    store.remove(urls(0), memes)
+    with open(store.path) as f:
+        assert sum(1 for _ in f) == 1 + 10 + 1
+    assert sorted(store.load()) == sorted(memes)
+
+
+def test_remove_compacts_a_mostly_stale_journal(store):
+    store.append([meme(i) for i in range(10)])
+    memes = store.load()
+    for url in urls(*range(9)):
+        del memes[url]
+    store.remove(urls(*range(9)), memes)
+    with open(store.path) as f:
+        lines = f.read().splitlines()
+    assert len(lines) == 2
+    assert list(store.load()) == urls(9)
+    assert store.lines == 1
+
+
+def test_reads_and_converts_the_old_format(store):
+    with open(store.path, 'w') as f:
+        f.write(json.dumps({m.url: m.to_dict() for m in (meme(1), meme(2))}))
+    assert list(store.load()) == urls(1, 2)
+
+    store.append([meme(3)])
+    with open(store.path) as f:
+        assert json.loads(f.readline()) == records.PendingStore.HEADER
+    assert list(store.load()) == urls(1, 2, 3)
+
+
+def test_count_postable():
+    memes = [meme(1, ups=5), meme(2, ups=50), meme(3, ups=50, sub='Dank'), meme(4, ups=500)]
+    memes[3].over_18 = True
+    total, postable = records.count_postable(memes, {'global': 10, 'dank': 100})
+    assert total == {'me_irl': 2, 'dank': 1}
+    assert postable == {'me_irl': 1}
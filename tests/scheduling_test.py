@@ -0,0 +1,94 @@
+import pytest
+
+import records
+import scheduling
+
+
+MINUTE = 60
+NOW = 1700000000.0
+LIMITS = scheduling.Bounds(min_interval=10, max_interval=240, min_depth=10, max_depth=50)
+
+
+def row(sub='me_irl', rate=None, interval_min=30, depth=50, last_scraped=NOW, last_new=0):
+    return {
+        'sub': sub, 'rate': rate, 'interval_min': interval_min, 'depth': depth,
+        'last_scraped': last_scraped, 'last_new': last_new,
+    }
+
+
+def as_row(values):
+    return dict(zip(('sub', 'rate', 'interval_min', 'depth', 'last_scraped', 'last_new'), values))
+
+
+def test_bounds_are_as_loose_as_any_channel_allows():
+    limits = scheduling.bounds([
+        {'min_scrape_interval_minutes': 20, 'num_memes': 30},
+        {'max_scrape_interval_minutes': 60, 'min_num_memes': 5},
+    ])
+    assert limits == scheduling.Bounds(min_interval=10, max_interval=240, min_depth=5, max_depth=50)
+
+
+def test_new_subs_are_due_and_fetched_fully():
+    assert scheduling.is_due(None, NOW, LIMITS)
+    assert scheduling.depth(None, LIMITS) == LIMITS.max_depth
+
+
+def test_a_sub_is_due_from_half_a_tick_before_its_interval():
+    schedule = row(interval_min=30)
+    early = (30 - scheduling.TICK_MINUTES / 2) * MINUTE
+    assert not scheduling.is_due(schedule, NOW + early - 1, LIMITS)
+    assert scheduling.is_due(schedule, NOW + early, LIMITS)
+
+
+def test_stored_intervals_are_clamped_to_the_bounds():
+    assert scheduling.is_due(row(interval_min=1000), NOW + 240 * MINUTE, LIMITS)
+    assert scheduling.depth(row(depth=500), LIMITS) == LIMITS.max_depth
+
+
+def test_first_scrape_has_no_rate():
+    assert scheduling.update('me_irl', None, 20, NOW, LIMITS) == ('me_irl', None, 30, 50, NOW, 20)
+
+
+def test_a_busy_sub_is_scraped_often_and_deeply():
+    sub, rate, interval, depth, last_scraped, last_new = scheduling.update(
+        'me_irl', row(last_scraped=NOW - 30 * MINUTE), 50, NOW, LIMITS, smoothing=1,
+    )
+    assert rate == pytest.approx(50 / 30)
+    # a scrape should find FILL of the maximum depth new
+    assert interval == pytest.approx(scheduling.FILL * 50 / rate)
+    assert depth == 50
+    assert (last_scraped, last_new) == (NOW, 50)
+
+
+def test_a_quiet_sub_is_scraped_rarely_and_shallowly():
+    updated = as_row(scheduling.update('me_irl', row(last_scraped=NOW - 60 * MINUTE), 1, NOW, LIMITS, smoothing=1))
+    assert updated['interval_min'] == LIMITS.max_interval
+    # it would only need 8 posts per scrape
+    assert updated['depth'] == LIMITS.min_depth
+    dead = as_row(scheduling.update('me_irl', row(last_scraped=NOW - 60 * MINUTE), 0, NOW, LIMITS))
+    assert (dead['interval_min'], dead['depth']) == (LIMITS.max_interval, LIMITS.min_depth)
+
+
+def test_the_rate_is_a_moving_average():
+    updated = as_row(scheduling.update('me_irl', row(rate=1.0, last_scraped=NOW - 10 * MINUTE), 0, NOW, LIMITS))
+    assert updated['rate'] == pytest.approx(0.5)
+
+
+def test_skipped_subs_wait_the_longest_interval():
+    skipped = as_row(scheduling.skip('nsfw_sub', NOW, LIMITS))
+    assert not scheduling.is_due(skipped, NOW + 200 * MINUTE, LIMITS)
+    assert scheduling.is_due(skipped, NOW + 240 * MINUTE, LIMITS)
+
+
+def test_count_new_only_counts_posts_since_the_last_scrape():
+    memes = [records.Meme(id=str(i), url=str(i), created_utc=NOW + offset) for i, offset in enumerate((-60, 0, 60))]
+    assert scheduling.count_new(memes, None) == 3
+    assert scheduling.count_new(memes, row(last_scraped=NOW)) == 1
+
+
+def test_describe():
+    assert scheduling.describe(None, NOW, LIMITS) == 'not scraped yet'
+    schedule = row(rate=0.5, interval_min=30, depth=20, last_scraped=NOW)
+    assert scheduling.describe(schedule, NOW + 10 * MINUTE, LIMITS) == (
+        'every 30 min, 20 posts, 30.0 new/hour, next in 20 min'
+    )
@@ -0,0 +1,147 @@
+import json
+import os
+import random
+
+import pytest
+
+import fingerprint
+import records
+import snapshot
+import storage
+
+
+@pytest.fixture
+def path(tmp_path):
+    return str(tmp_path / 'snapshot')
+
+
+@pytest.fixture
+def db(tmp_path):
+    db = storage.SQLiteStorage(str(tmp_path / 'memes.sqlite3'))
+    db.create_tables()
+    return db
+
+
+def posted_images(n, seed=0):
+    rng = random.Random(seed)
+    return [(f'id{i}', rng.getrandbits(64)) for i in range(n)]
+
+
+def add_posted(db, images):
+    for meme_id, value in images:
+        db.add_meme_data(records.Meme(id=meme_id, url=f'https://i.redd.it/{meme_id}.jpg').to_row())
+    db.set_many_posted_to_slack([meme_id for meme_id, _ in images])
+    db.set_phashes([(fingerprint.to_signed(value), meme_id) for meme_id, value in images])
+
+
+def make_snapshot(images, **kwargs):
+    return snapshot.Snapshot(
+        posted_ids=[meme_id for meme_id, _ in images],
+        posted_hashes=[value for _, value in images],
+        posted_checksum=fingerprint.checksum(value for _, value in images),
+        **kwargs,
+    )
+
+
+class Seed:
+    """The posted function of a snapshot, recording whether the fingerprinter used it"""
+
+    def __init__(self, saved):
+        self.saved = saved
+        self.used = False
+
+    def __call__(self):
+        self.used = True
+        return self.saved.posted()
+
+
+def test_round_trip(path):
+    images = posted_images(5)
+    make_snapshot(images, users_list={'ok': True}, messages=[{'text': 'hi'}], created=123.0).save(path)
+    saved = snapshot.Snapshot.load(path)
+    assert saved.users_list == {'ok': True}
+    assert saved.messages == [{'text': 'hi'}]
+    assert saved.created == 123.0
+    assert list(saved.posted()) == images
+    assert saved.posted_checksum == fingerprint.checksum(value for _, value in images)
+
+
+def test_saving_replaces_the_previous_snapshot(path):
+    make_snapshot(posted_images(5)).save(path)
+    make_snapshot(posted_images(2, seed=1)).save(path)
+    assert list(snapshot.Snapshot.load(path).posted()) == posted_images(2, seed=1)
+    assert not os.path.exists(path + '.old') and not os.path.exists(path + '.tmp')
+
+
+def test_missing_snapshot(path):
+    assert snapshot.Snapshot.load(path) is None
+
+
+def test_other_versions_are_ignored(path):
+    make_snapshot(posted_images(1)).save(path)
+    meta_path = os.path.join(path, 'meta.json')
+    with open(meta_path) as f:
+        meta = json.load(f)
+    meta['version'] = snapshot.FORMAT_VERSION + 1
+    with open(meta_path, 'w') as f:
+        json.dump(meta, f)
+    assert snapshot.Snapshot.load(path) is None
+
+
+def test_inconsistent_snapshots_are_ignored(path):
+    make_snapshot(posted_images(3)).save(path)
+    meta_path = os.path.join(path, 'meta.json')
+    with open(meta_path) as f:
+        meta = json.load(f)
+    meta['posted'] = 4
+    with open(meta_path, 'w') as f:
+        json.dump(meta, f)
+    assert snapshot.Snapshot.load(path) is None
+
+
+def test_clear_messages(path):
+    make_snapshot([], messages=[{'text': 'hi'}]).save(path)
+    snapshot.Snapshot.clear_messages(path)
+    assert snapshot.Snapshot.load(path).messages == []
+
+
+def test_checksum_matches_the_database(db):
+    images = posted_images(50)
+    add_posted(db, images)
+    assert db.summarize_posted_phashes(fingerprint.CHECKSUM_MODULUS) == (
+        50, fingerprint.checksum(value for _, value in images),
+    )
+
+
+@pytest.fixture
+def fingerprinter():
+    f = fingerprint.Fingerprinter()
+    f.enabled = True
+    return f
+
+
+def test_a_matching_snapshot_seeds_the_index(db, path, fingerprinter):
+    images = posted_images(20)
+    add_posted(db, images)
+    make_snapshot(images).save(path)
+    saved = snapshot.Snapshot.load(path)
+
+    seed = Seed(saved)
+    fingerprinter.seed(seed, (len(saved.posted_ids), saved.posted_checksum))
+    assert fingerprinter.find_posted_duplicates(db, 'new', images[3][1]) == [(0, 'id3')]
+    assert seed.used
+
+
+def test_an_out_of_date_snapshot_is_replaced_by_the_database(db, path, fingerprinter):
+    images = posted_images(20)
+    make_snapshot(images).save(path)
+    # as many posted images as the snapshot has, but one of them changed since
+    changed = images[:-1] + [('other', posted_images(1, seed=1)[0][1])]
+    add_posted(db, changed)
+    saved = snapshot.Snapshot.load(path)
+
+    seed = Seed(saved)
+    fingerprinter.seed(seed, (len(saved.posted_ids), saved.posted_checksum))
+    assert fingerprinter.find_posted_duplicates(db, 'new', images[-1][1]) == []
+    assert fingerprinter.find_posted_duplicates(db, 'new', changed[-1][1]) == [(0, 'other')]
+    assert not seed.used
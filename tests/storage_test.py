@@ -0,0 +1,55 @@
+import sqlite3
+
+import pytest
+
+import circuit
+import storage
+
+
+@pytest.fixture
+def db(tmp_path):
+    db = storage.SQLiteStorage(str(tmp_path / 'memes.sqlite3'))
+    db.breaker = circuit.CircuitBreaker('test-db', failure_threshold=2)
+    db.create_tables()
+    return db
+
+
+@pytest.mark.parametrize(
+    ('query', 'expected'),
+    (
+        ('SELECT * FROM posts WHERE id = %s', 'SELECT * FROM posts WHERE id = ?'),
+        ('WHERE sub = %(sub)s AND id = %(id)s', 'WHERE sub = :sub AND id = :id'),
+        ("WHERE title LIKE '%%cat%%' AND id = %s", "WHERE title LIKE '%cat%' AND id = ?"),
+        ('SELECT 1', 'SELECT 1'),
+    ),
+)
+def test_to_qmark(query, expected):
+    assert storage._to_qmark(query) == expected
+
+
+def test_storage_is_abstract():
+    with pytest.raises(TypeError):
+        storage.Storage()
+
+
+def test_bad_queries_do_not_open_the_breaker(db):
+    for _ in range(5):
+        with pytest.raises(sqlite3.OperationalError):
+            db.execute('SELECT no_such_column FROM posts')
+    assert db.breaker.state == circuit.CLOSED
+
+
+def test_a_locked_database_opens_the_breaker(db, tmp_path):
+    other = sqlite3.connect(str(tmp_path / 'memes.sqlite3'), isolation_level=None)
+    other.execute('BEGIN EXCLUSIVE')
+    db.connection.execute('PRAGMA busy_timeout = 0')
+    try:
+        for _ in range(2):
+            with pytest.raises(sqlite3.OperationalError, match='locked'):
+                db.execute('INSERT INTO sub_schedule (sub) VALUES (%s)', ('me_irl',))
+    finally:
+        other.execute('ROLLBACK')
+        other.close()
+    assert db.breaker.state == circuit.OPEN
+    with pytest.raises(circuit.CircuitOpen):
+        db.execute('SELECT 1')
@@ -0,0 +1,172 @@
+"""
+The HTTP session shared by the Slack and Reddit clients.
+
+Both clients otherwise open connections with their own default handling: the Slack
+client makes every call with a one-off `requests.post` (a new TCP + TLS handshake each
+time) and without a timeout, so a hung call blocks its thread for good. The shared
+session keeps a pool of keep-alive connections per host, applies connect / read
+timeouts to every request, and retries connection errors and 5xx responses of idempotent
+requests with exponential backoff. POSTs are only retried when they never reached the
+server, so a slow `chat.postMessage` isn't sent twice.
+
+How long the requests to each host take is recorded in `latencies`, which `profile
+status` prints.
+"""
+import collections
+import json
+import threading
+import time
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from slackclient import SlackClient
+from urllib3.util.retry import Retry
+
+import utils
+
+
+# seconds to wait for a connection, and then for each read from it
+CONNECT_TIMEOUT = 3.05
+READ_TIMEOUT = 30
+# connections kept open per host, one for each of the bot's threads that make calls
+POOL_SIZE = 10
+RETRIES = 3
+# retries wait 0.5s, 1s, 2s, ...
+BACKOFF_FACTOR = 0.5
+RETRY_STATUSES = (500, 502, 503, 504)
+# latency samples kept per host
+LATENCY_SAMPLES = 500
+
+SLACK_API_URL = 'https://slack.com/api/'
+
+
+class HostLatencies:
+    """The durations of the most recent requests to each host, and how many failed"""
+
+    def __init__(self, size=LATENCY_SAMPLES):
+        self.size = size
+        self._lock = threading.Lock()
+        self._samples = {}
+        self._errors = collections.Counter()
+
+    def record(self, host, seconds, failed=False):
+        with self._lock:
+            self._samples.setdefault(host, collections.deque(maxlen=self.size)).append(seconds)
+            if failed:
+                self._errors[host] += 1
+
+    def summary(self):
+        """Returns a plain text table of request counts and latency percentiles per host, or '' before any request"""
+        with self._lock:
+            samples = {host: sorted(values) for host, values in self._samples.items()}
+            errors = dict(self._errors)
+        if not samples:
+            return ''
+        lines = [f'{"host":<28}{"requests":>10}{"errors":>8}{"p50 ms":>9}{"p90 ms":>9}{"max ms":>9}']
+        for host, values in sorted(samples.items()):
+            ms = [v * 1000 for v in values]
+            lines.append(
+                f'{host[:27]:<28}{len(ms):>10,d}{errors.get(host, 0):>8,d}'
+                f'{ms[int(0.5 * (len(ms) - 1))]:>9.0f}{ms[int(0.9 * (len(ms) - 1))]:>9.0f}{ms[-1]:>9.0f}'
+            )
+        return '\n'.join(lines)
+
+
+# shared by every session
+latencies = HostLatencies()
+
+
+class PooledSession(requests.Session):
+    """A requests.Session with a default timeout, recording the latency of every request"""
+
+    def __init__(self, timeout=(CONNECT_TIMEOUT, READ_TIMEOUT), latencies=latencies):
+        super().__init__()
+        self.timeout = timeout
+        self.latencies = latencies
+
+    def request(self, method, url, **kwargs):
+        if kwargs.get('timeout') is None:
+            kwargs['timeout'] = self.timeout
+        host = urlsplit(url).hostname or '?'
+        start = time.perf_counter()
+        try:
+            response = super().request(method, url, **kwargs)
+        except requests.RequestException:
+            self.latencies.record(host, time.perf_counter() - start, failed=True)
+            raise
+        self.latencies.record(host, time.perf_counter() - start, failed=response.status_code >= 500)
+        return response
+
+
+def make_session(pool_size=POOL_SIZE, retries=RETRIES, backoff_factor=BACKOFF_FACTOR):
+    """Returns a new PooledSession, retrying failed requests `retries` times"""
+    session = PooledSession()
+    retry = Retry(
+        total=retries,
+        backoff_factor=backoff_factor,
+        status_forcelist=RETRY_STATUSES,
+        # hand the last response to the caller rather than raising, the clients handle errors themselves
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+# the session shared by the slack and reddit clients
+session = utils.Deferred(make_session, name='http session')
+
+
+class Unavailable(Exception):
+    """Raised for an answer meaning the host can't take requests right now, see `is_unavailable`"""
+
+
+def unavailable_errors():
+    """The exception types meaning a host couldn't be reached, didn't answer in time or is overloaded"""
+    return requests.ConnectionError, requests.Timeout, Unavailable
+
+
+def is_unavailable(response):
+    """Whether a slack api response is a server error or rate limit, rather than an answer to the call"""
+    error = response.get('error') or ''
+    return error == 'ratelimited' or error.startswith('http 5')
+
+
+class PooledSlackClient(SlackClient):
+    """
+    A SlackClient making its web api calls through the shared session. The RTM
+    connection itself (rtm.connect and the websocket) is still made by SlackClient
+    """
+
+    def __init__(self, token, session=None, **kwargs):
+        super().__init__(token, **kwargs)
+        self.token = token
+        self._session = session
+
+    @property
+    def session(self):
+        return self._session or session.get()
+
+    def api_call(self, method, timeout=None, **kwargs):
+        if method.startswith('rtm.'):
+            return super().api_call(method, timeout=timeout, **kwargs)
+        files = {'file': kwargs.pop('file')} if 'file' in kwargs else None
+        # like SlackClient, lists and dicts (e.g. attachments) are sent as json
+        data = {k: json.dumps(v) if isinstance(v, (list, dict)) else v for k, v in kwargs.items()}
+        response = self.session.post(
+            SLACK_API_URL + method,
+            headers={'Authorization': f'Bearer {self.token}'},
+            data=data,
+            files=files,
+            timeout=timeout,
+        )
+        if response.status_code >= 500:
+            return {'ok': False, 'error': f'http {response.status_code}'}
+        if response.status_code == 429:
+            return {'ok': False, 'error': 'ratelimited'}
+        try:
+            return response.json()
+        except ValueError:
+            return {'ok': False, 'error': f'http {response.status_code}'}
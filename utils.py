@@ -1,34 +1,59 @@
 import datetime
+import json
 import logging
 import os
 import threading
+import time
 import traceback
 from logging import handlers
 from pathlib import Path
 
-import pymysql
-
 
 SCRAPED_PATH = 'memes/scraped.json'
 SETTINGS_PATH = 'memes/settings.json'
 SQLITE_FILE = 'memes/memes.sqlite3'
+SNAPSHOT_DIR = 'memes/snapshot'
 ERROR_LOG_FILE = 'memes/errors.log'
 SLACK_LOG_FILE = 'memes/comments.log'
 USAGE_LOG_FILE = 'memes/usage.log'
 
-# set up logging
-os.makedirs('memes', exist_ok=True)
-Path(ERROR_LOG_FILE).touch()
-Path(USAGE_LOG_FILE).touch()
 logger = logging.getLogger(__name__)
-rfh = handlers.RotatingFileHandler(
-    ERROR_LOG_FILE,
-    maxBytes=1024 * 1024 * 20,
-    backupCount=1,
-)
-rfh.setLevel(logging.DEBUG)
-rfh.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
-logger.addHandler(rfh)
+_init_lock = threading.Lock()
+_initialized = False
+
+
+def ensure_json_file(path, default=None):
+    """Creates a json file (and its directory) at path holding default, unless it already exists"""
+    if not os.path.isfile(path):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        with open(path, 'x') as f:
+            f.write(json.dumps({} if default is None else default))
+
+
+def init():
+    """
+    Creates the memes directory, its default files and the error log handler. Safe
+    to call more than once; entry points call this instead of it happening on import
+    """
+    global _initialized
+    with _init_lock:
+        if _initialized:
+            return
+        os.makedirs('memes', exist_ok=True)
+        Path(ERROR_LOG_FILE).touch()
+        Path(USAGE_LOG_FILE).touch()
+        for path in (SCRAPED_PATH, SETTINGS_PATH):
+            ensure_json_file(path)
+
+        rfh = handlers.RotatingFileHandler(
+            ERROR_LOG_FILE,
+            maxBytes=1024 * 1024 * 20,
+            backupCount=1,
+        )
+        rfh.setLevel(logging.DEBUG)
+        rfh.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
+        logger.addHandler(rfh)
+        _initialized = True
 
 
 def log_error(error):
@@ -45,165 +70,87 @@ def log_usage(log_str):
         f.write(f'{time_str} - {threading.get_ident()} - {log_str}\n')
 
 
-def get_connection(
-    user,
-    password,
-    db,
-    host,
-    cursorclass=pymysql.cursors.DictCursor,
-    autocommit=True,
-    charset='utf8mb4',
-    **kwargs,
-):
-
-    return pymysql.connect(
-        user=user,
-        password=password,
-        db=db,
-        host=host,
-        cursorclass=cursorclass,
-        charset=charset,
-        autocommit=autocommit,
-        **kwargs,
-    )
-
-
-def get_meme_data(cursor, meme_id):
-    """
-    Queries SQLite for data associated with the passed Reddit post id.
-    :param cursor: a database cursor object
-    :param meme_id: the id associated with a post on reddit / a row in the database
-    :return: a dictionary with the data for the appropriate post if it exists, else an empty dict
-    """
-    cursor.execute(
-        '''
-        SELECT *
-        FROM posts
-        WHERE id = %s
-        ''',
-        (meme_id,),
-    )
-    return cursor.fetchone()
-
-
-def get_meme_data_from_url(cursor, url):
-    """
-    Queries SQLite for data associated with the given url
-    :param cursor: a database cursor object
-    :param url: a url for an image / post on Reddit
-    :return: a list of dictionaries corresponding to each post having the appropriate url,
-    or an empty list if no data matches.
-    """
-    cursor.execute(
-        '''
-        SELECT *
-        FROM posts
-        WHERE url = %s
-        ''',
-        (url,),
-    )
-    return cursor.fetchall()
-
-
-def add_meme_data(cursor, meme_dict, connection):
-    """
-    Inserts data for the passed dict into the database. Will always insert if
-    the data doesn't exist, will update existing data if replace=True, and do nothing
-    if replace=False
-    :param cursor: a database cursor object
-    :param meme_dict: a dictionary with data for a given meme
-    :param connection: a database connection object
-    :param replace: whether to replace existing data or do nothing when existing data is found
-    """
-    cursor.execute(
-        '''
-        INSERT INTO posts VALUES (
-            %(id)s,
-            %(over_18)s,
-            %(ups)s,
-            %(highest_ups)s,
-            %(title)s,
-            %(url)s,
-            %(link)s,
-            %(author)s,
-            %(sub)s,
-            %(upvote_ratio)s,
-            %(created_utc)s,
-            %(last_updated)s,
-            %(recorded)s,
-            %(posted_to_slack)s
-        );
-        ''',
-        meme_dict,
-    )
-    connection.commit()
-
-
-def update_meme_data(cursor, meme_dict, connection):
-    """
-    Updates the following fields in database for the row corresponding to meme_dict[id] :
-    ups, highest_ups, last_updated, posted_to_slack
-    :param cursor: a database cursor object
-    :param meme_dict: a dictionary with appropriate data for a meme
-    :param connection: a database connection object
-    """
-    cursor.execute(
-        '''
-        UPDATE posts
-        SET ups = %s, highest_ups = %s, last_updated = %s, posted_to_slack = %s,
-            upvote_ratio = %s
-        WHERE id = %s
-        ''',
-        (
-            meme_dict['ups'],
-            meme_dict['highest_ups'],
-            meme_dict['last_updated'],
-            meme_dict['posted_to_slack'],
-            meme_dict['upvote_ratio'],
-            meme_dict['id'],
-        ),
-    )
-
-
-def set_posted_to_slack(cursor, meme_id, connection, val):
-    """
-    Updates the value of row meme_id to have a posted_to_slack value of val. Should typically be used
-    to specify a meme has been posted (aka val = True)
-    :param cursor: a database cursor object
-    :param meme_id: the (Reddit / database row) id of the meme to update
-    :param connection: a database connection object
-    :param val: a boolean represnting whether the meme has been posted to reddit
-    """
-    cursor.execute(
-        '''
-        UPDATE posts
-        SET posted_to_slack = %s
-        WHERE id = %s
-        ''',
-        (val, meme_id),
-    )
-    connection.commit()
-
-
-def has_been_posted_to_slack(cursor, meme_dict):
+class Clock:
+    """The wall clock. Simulations substitute a virtual one, see simulate.py"""
+
+    def now(self):
+        """The current time, in seconds since the epoch"""
+        return time.time()
+
+    def datetime(self):
+        """The current local time, as a naive datetime"""
+        return datetime.datetime.now()
+
+    def sleep(self, seconds):
+        time.sleep(seconds)
+
+    def wait(self, event, timeout):
+        """Waits up to timeout seconds for event (a threading.Event), returning whether it is set"""
+        return event.wait(timeout)
+
+
+class Deferred:
     """
-    Returns whether the passed meme has been posted to slack. NOTE: while `set_posted_to_slack`
-    only sets a single row (based on Reddit / database row id) this function returns True
-    if any row with the same url as the passed meme has been posted to slack.
-    :param cursor: a database cursor object
-    :param meme_dict: a dictionary with a url to check
-    :return:
+    A value that is expensive to create (an API call, a connection), created either
+    lazily on the first `get()` or in a background thread with `start()`. If creating it
+    fails, the next `get()` tries again, in this thread, or with block=False in a
+    background thread at most every retry_seconds.
     """
-    cursor.execute(
-        '''
-        SELECT posted_to_slack
-        FROM posts
-        WHERE url = %s
-        ''',
-        (meme_dict['url'],),
-    )
-    values = cursor.fetchall()
-    for v in values:
-        if v['posted_to_slack']:
-            return True
-    return False
+
+    def __init__(self, factory, name=None, retry_seconds=30):
+        self.factory = factory
+        self.name = name or getattr(factory, '__name__', 'deferred')
+        self.retry_seconds = retry_seconds
+        self._lock = threading.Lock()
+        self._ready = threading.Event()
+        self._value = None
+        self._starting = False  # whether a background thread is creating the value
+        self._failed = None  # when the last background attempt failed, None if it hasn't
+
+    def start(self):
+        """Starts creating the value in a daemon thread, returns self"""
+        self._starting = True
+        t = threading.Thread(target=self._resolve_quietly, name=f'deferred-{self.name}')
+        t.daemon = True
+        t.start()
+        return self
+
+    def ready(self):
+        return self._ready.is_set()
+
+    def get(self, block=True):
+        """
+        Returns the value, creating it in this thread (or waiting for the background
+        thread) if needed. With block=False returns None instead of waiting
+        """
+        if self._ready.is_set():
+            return self._value
+        if not block:
+            if not self._starting and self._failed is not None and time.time() - self._failed >= self.retry_seconds:
+                self.start()
+            return None
+        return self._resolve()
+
+    def set(self, value):
+        """Sets the value directly, e.g. from a snapshot or a refresh"""
+        with self._lock:
+            self._value = value
+            self._ready.set()
+
+    def _resolve(self):
+        with self._lock:
+            if not self._ready.is_set():
+                log_usage(f'deferred {self.name} - start')
+                self._value = self.factory()
+                self._ready.set()
+                log_usage(f'deferred {self.name} - ready')
+        return self._value
+
+    def _resolve_quietly(self):
+        try:
+            self._resolve()
+        except Exception as e:
+            self._failed = time.time()
+            log_error(e)
+        finally:
+            self._starting = False